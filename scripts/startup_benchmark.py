@@ -0,0 +1,94 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "snyk_sync", "cli.py")
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(
+        description="Times cold starts of snyk-sync, each run is a new interpreter like a cron or CI invocation"
+    )
+    parser.add_argument("--runs", help="Number of runs per command", type=int, default=10)
+    parser.add_argument("--cli", help="Path to snyk_sync/cli.py", default=CLI)
+    parser.add_argument(
+        "--import-time", help="Show the slowest imports of the first command", action="store_true", default=False
+    )
+    parser.add_argument(
+        "commands",
+        help="Arguments for cli.py, one quoted string per command after --, eg: -- '--conf snyk-sync.yaml status'",
+        nargs="*",
+        default=["--help", "status --help"],
+    )
+
+    return parser.parse_args()
+
+
+def run(cli: str, command: str, extra: list = []) -> subprocess.CompletedProcess:
+    # cli.py imports its neighbours by name, so it has to be run from its own directory
+    return subprocess.run(
+        [sys.executable, *extra, os.path.basename(cli), *command.split()],
+        cwd=os.path.dirname(os.path.abspath(cli)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+
+def time_command(cli: str, command: str, runs: int) -> list:
+    timings = list()
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = run(cli, command)
+        timings.append(time.perf_counter() - start)
+
+        if result.returncode != 0:
+            print(f"'{command}' exited with {result.returncode}:\n{result.stderr}")
+            sys.exit(1)
+
+    return timings
+
+
+def import_times(cli: str, command: str, top: int = 15):
+    """
+    Prints the modules with the longest cumulative import time, from python -X importtime
+    """
+    result = run(cli, command, ["-X", "importtime"])
+
+    imports = list()
+
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line.split("|")
+        imports.append((int(cumulative), name.rstrip()))
+
+    imports.sort(reverse=True)
+
+    print(f"\nSlowest imports for '{command}' (cumulative):")
+    for cumulative, name in imports[:top]:
+        print(f"\t{cumulative / 1000:8.1f} ms\t{name}")
+
+
+args = parse_command_line_args()
+
+width = max([len(c) for c in args.commands] + [len("command")]) + 2
+
+print(f"{'command':<{width}}{'min':>10}{'median':>10}{'max':>10}")
+
+for command in args.commands:
+    timings = time_command(args.cli, command, args.runs)
+
+    print(
+        f"{command:<{width}}{min(timings) * 1000:>8.0f}ms{statistics.median(timings) * 1000:>8.0f}ms"
+        f"{max(timings) * 1000:>8.0f}ms"
+    )
+
+if args.import_time and args.commands:
+    import_times(args.cli, args.commands[0])
@@ -1,72 +1,729 @@
+import base64
+import functools
+import hashlib
+import json
 import logging
+import sys
+import threading
 import time
-from datetime import datetime
+import urllib.parse
+from datetime import timezone
 from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
 
+import requests
 from __version__ import __version__
 from github import Github
+from github import GithubIntegration
+from github import UnknownObjectException
+from github.ContentFile import ContentFile
+from github.PaginatedList import PaginatedList
+from github.Repository import Repository
+from github.Requester import HTTPRequestsConnectionClass
+from github.Requester import HTTPSRequestsConnectionClass
+from github.Requester import Requester
 from pydantic import BaseModel
 from snyk import SnykClient  # type: ignore
+from snyk.errors import SnykHTTPError
+from sqlite_cache import HTTPCache
 
 
 logger = logging.getLogger(__name__)
 
 
+class RateBucket:
+    """
+    One of GitHub's rate limit resources (core, search, graphql), kept current from the X-RateLimit headers
+    on every response. Requests go out freely until less than PACE_FRACTION of the budget is left, after
+    that they're spaced out so what remains lasts until the reset, rather than running dry and stopping
+    """
+
+    PACE_FRACTION = 0.1
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limit: Optional[int] = None
+        self.remaining: Optional[int] = None
+        self.reset = 0.0
+        self.next_slot = 0.0
+        self.blocked_until = 0.0
+        self.calls = 0
+
+    def observe(self, headers: Dict, counted: bool = True):
+        with self.lock:
+            if counted:
+                self.calls += 1
+
+            if "x-ratelimit-remaining" in headers and "x-ratelimit-reset" in headers:
+                self.remaining = int(headers["x-ratelimit-remaining"])
+                self.reset = float(headers["x-ratelimit-reset"])
+
+            if "x-ratelimit-limit" in headers:
+                self.limit = int(headers["x-ratelimit-limit"])
+
+    def block(self, until: float):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, until)
+
+    def delay(self, consume: bool = True) -> float:
+        """
+        Returns how long to wait before the next request, with consume it also takes that request's slot
+        """
+        with self.lock:
+            now = time.time()
+
+            wait = max(self.blocked_until - now, 0)
+
+            if self.remaining is None or not self.limit:
+                return wait
+
+            if now >= self.reset:
+                # the window has rolled over, the next response will tell us the real numbers
+                self.remaining = self.limit
+            elif self.remaining <= 0:
+                wait = max(wait, self.reset - now)
+            elif self.remaining < self.limit * self.PACE_FRACTION:
+                slot = max(self.next_slot, now)
+                wait = max(wait, slot - now)
+
+                if consume:
+                    self.next_slot = slot + (self.reset - now) / self.remaining
+
+            if consume and self.remaining > 0:
+                self.remaining -= 1
+
+            return wait
+
+
+class TokenPool:
+    """
+    The GitHub tokens requests can be spread over. Plain tokens work for every org, a GitHub App gets an
+    installation token per org, minted the first time that org is seen and renewed before it expires
+    """
+
+    # renew installation tokens this many seconds before they expire
+    RENEW_BEFORE = 300
+
+    def __init__(
+        self,
+        tokens: List[str],
+        app_id: Optional[str] = None,
+        private_key: Optional[str] = None,
+        base_url: str = "https://api.github.com",
+    ):
+        self.tokens = list(tokens)
+        self.base_url = base_url
+        self.integration = None
+        # guards installations and owner_locks, never held over a request
+        self.lock = threading.Lock()
+        # org -> (token, expiry), token is None when the app isn't installed in that org
+        self.installations: Dict[str, Tuple[Optional[str], float]] = dict()
+        # org -> lock held while its installation token is being requested
+        self.owner_locks: Dict[str, threading.Lock] = dict()
+
+        if app_id is not None and private_key is not None:
+            self.integration = GithubIntegration(str(app_id), private_key, base_url=base_url)
+
+    @staticmethod
+    def owner_for(url: str, input) -> Optional[str]:
+        """
+        Works out which org a request is for, so an installation token for it can be used
+        """
+        parsed = urllib.parse.urlsplit(url)
+
+        path = parsed.path
+
+        if path.startswith("/api/v3/"):
+            path = path[len("/api/v3") :]
+
+        parts = path.strip("/").split("/")
+
+        if len(parts) >= 2 and parts[0] in ["orgs", "repos", "users"]:
+            return parts[1]
+
+        if parts[0] == "search":
+            query = urllib.parse.parse_qs(parsed.query).get("q", [""])[0]
+
+            for term in query.split():
+                if term.startswith("org:") or term.startswith("user:") or term.startswith("repo:"):
+                    return term.split(":", 1)[1].split("/")[0]
+
+        if parts[-1] == "graphql" and input is not None:
+            try:
+                variables = json.loads(input).get("variables") or dict()
+            except (TypeError, ValueError):
+                return None
+
+            return variables.get("org") or variables.get("owner")
+
+        return None
+
+    def cached_installation(self, owner: str) -> Tuple[bool, Optional[str], float]:
+        """
+        Returns whether we've looked the org up yet, and its installation token and expiry if we have
+        """
+        with self.lock:
+            token, expiry = self.installations.get(owner, (None, 0.0))
+
+            return owner in self.installations, token, expiry
+
+    def installation_token(self, owner: str) -> Optional[str]:
+        if self.integration is None:
+            return None
+
+        known, token, expiry = self.cached_installation(owner)
+
+        if known and (token is None or expiry - self.RENEW_BEFORE > time.time()):
+            return token
+
+        with self.lock:
+            owner_lock = self.owner_locks.setdefault(owner, threading.Lock())
+
+        # the token requests happen outside self.lock, so a slow one only holds up threads that need that org's
+        # token, and while it's being renewed the old token is still good for everyone else
+        if known and expiry > time.time():
+            if not owner_lock.acquire(blocking=False):
+                return token
+        else:
+            owner_lock.acquire()
+
+        try:
+            # another thread may have got it while we waited
+            known, token, expiry = self.cached_installation(owner)
+
+            if known and (token is None or expiry - self.RENEW_BEFORE > time.time()):
+                return token
+
+            headers = {
+                "Authorization": f"Bearer {self.integration.create_jwt()}",
+                "Accept": "application/vnd.github.v3+json",
+                "User-Agent": f"snyk-sync/{__version__}",
+            }
+
+            resp = requests.get(f"{self.base_url}/orgs/{owner}/installation", headers=headers)
+
+            if resp.status_code != 200:
+                logger.warning(f"GitHub App is not installed in {owner}, status: {resp.status_code}")
+
+                with self.lock:
+                    self.installations[owner] = (None, 0.0)
+
+                return None
+
+            auth = self.integration.get_access_token(resp.json()["id"])
+
+            expires_at = auth.expires_at.replace(tzinfo=timezone.utc).timestamp()
+
+            with self.lock:
+                self.installations[owner] = (auth.token, expires_at)
+
+            return auth.token
+        finally:
+            owner_lock.release()
+
+    def tokens_for(self, owner: Optional[str]) -> List[str]:
+        tokens = list(self.tokens)
+
+        if owner is not None:
+            app_token = self.installation_token(owner)
+
+            if app_token is not None:
+                tokens.append(app_token)
+
+        # with only a GitHub App configured there's nothing to fall back on, and a request without a token
+        # would go out anonymously at 60 an hour
+        if len(tokens) == 0:
+            raise Exception(f"No GitHub token for {owner or 'this request'}, the GitHub App is not installed there")
+
+        return tokens
+
+    def has_token(self, owner: str) -> bool:
+        return len(self.tokens) > 0 or self.installation_token(owner) is not None
+
+
 class RateLimit:
-    def __init__(self, gh: Github, pages):
-        self.core_limit = gh.get_rate_limit().core.limit
-        self.search_limit = gh.get_rate_limit().search.limit
-        # we want to know how many calls had been made before we created this object
-        # calling this a tare
-        self.core_tare = gh.get_rate_limit().core.limit - gh.get_rate_limit().core.remaining
-        self.search_tare = gh.get_rate_limit().search.limit - gh.get_rate_limit().search.remaining
-        self.gh = gh
+    """
+    Tracks GitHub's rate limits from the headers of the responses we get anyway, rather than asking the
+    rate_limit endpoint, and paces or holds back requests when a budget runs low or GitHub asks us to
+    """
+
+    # how often a request that hit a secondary rate limit is retried
+    RETRIES = 3
+
+    def __init__(self, pool: Optional["TokenPool"] = None):
+        # buckets are per token, the "" token being whatever the Github object was created with
+        self.buckets: Dict[Tuple[str, str], RateBucket] = dict()
+        self.buckets_lock = threading.Lock()
+        self.pool = pool
         self.core_calls = [0]
         self.search_calls = [0]
-        self.repo_count = 0
-        self.pages = pages
+        self.graphql_calls = [0]
+
+    def bucket(self, resource: str, token: str = "") -> RateBucket:
+        with self.buckets_lock:
+            if (resource, token) not in self.buckets:
+                self.buckets[(resource, token)] = RateBucket()
+
+            return self.buckets[(resource, token)]
+
+    def calls(self, resource: str) -> int:
+        with self.buckets_lock:
+            return sum([b.calls for (r, _), b in self.buckets.items() if r == resource])
+
+    def pick(self, resource: str, owner: Optional[str]) -> str:
+        """
+        Returns the pool token that can make a request to owner soonest, preferring the one with the most
+        budget left, or "" when there's no pool or no token for that owner
+        """
+        if self.pool is None:
+            return ""
+
+        best = ""
+        best_rank = None
+
+        for token in self.pool.tokens_for(owner):
+            bucket = self.bucket(resource, token)
+
+            # a token we haven't heard back on yet is assumed to have its whole budget
+            remaining = bucket.remaining if bucket.remaining is not None else sys.maxsize
+
+            rank = (bucket.delay(consume=False), -remaining)
+
+            if best_rank is None or rank < best_rank:
+                best = token
+                best_rank = rank
+
+        return best
+
+    @staticmethod
+    def resource_for(url: str) -> str:
+        if url.startswith("/search/") or "/search/" in url:
+            return "search"
+        if url.endswith("/graphql"):
+            return "graphql"
+        return "core"
+
+    def backoff(
+        self, resource: str, token: str, status: int, headers: Dict, body: str, attempt: int
+    ) -> Optional[float]:
+        """
+        Works out if a 403 / 429 is GitHub rate limiting us, and if so blocks the token's bucket and returns
+        how long it's held back for. Anything else gets None and is passed back to PyGithub as is
+        """
+        if status not in [403, 429]:
+            return None
+
+        now = time.time()
+
+        if "retry-after" in headers:
+            wait = float(headers["retry-after"])
+        elif headers.get("x-ratelimit-remaining") == "0" and "x-ratelimit-reset" in headers:
+            wait = max(float(headers["x-ratelimit-reset"]) - now, 0) + 1
+        elif "secondary rate limit" in body.lower() or "abuse" in body.lower():
+            # github asks for at least a minute when it doesn't say how long
+            wait = 60.0 * (2**attempt)
+        else:
+            return None
 
-    def update(self, display: bool = False):
-        core_call = self.core_limit - self.core_tare - self.gh.get_rate_limit().core.remaining
-        search_call = self.search_limit - self.search_tare - self.gh.get_rate_limit().search.remaining
+        self.bucket(resource, token).block(now + wait)
+
+        logger.warning(f"GitHub {resource} rate limit hit, backing off for {int(wait)} seconds")
 
-        self.core_calls.append(core_call)
-        self.search_calls.append(search_call)
+        return wait
+
+    def update(self, display: bool = False):
+        self.core_calls.append(self.calls("core"))
+        self.search_calls.append(self.calls("search"))
+        self.graphql_calls.append(self.calls("graphql"))
 
         if display is True:
             core_diff = self.core_calls[-1] - self.core_calls[-2]
             search_diff = self.search_calls[-1] - self.search_calls[-2]
+            graphql_diff = self.graphql_calls[-1] - self.graphql_calls[-2]
             print(f"GH RateLimit: Core Calls = {core_diff}")
             print(f"GH RateLimit: Search Calls = {search_diff}")
-
-    def add_calls(self, repo_total: int):
-        self.repo_count = repo_total
+            print(f"GH RateLimit: GraphQL Calls = {graphql_diff}")
 
     def check(self, kind="core"):
+        """
+        Waits while the bucket is held back, the requests themselves are paced by the connection class
+        """
+        with self.buckets_lock:
+            buckets = [b for (r, _), b in self.buckets.items() if r == kind]
+
+        wait = min([b.delay(consume=False) for b in buckets], default=0)
 
-        if kind == "core":
-            rl = self.gh.get_rate_limit().core
-        elif kind == "search":
-            rl = self.gh.get_rate_limit().search
+        if wait > 0:
+            time.sleep(wait)
+
+    def total(self):
+        print(f"GH RateLimit: Total Core Calls = {self.core_calls[-1]}")
+        print(f"GH RateLimit: Total Search Calls = {self.search_calls[-1]}")
+        print(f"GH RateLimit: Total GraphQL Calls = {self.graphql_calls[-1]}")
 
-        expiration = rl.reset
 
-        now = datetime.utcnow()
+class SharedSessionMixin:
+    """
+    PyGithub reuses a single connection object for every request a Github instance makes, and that object
+    holds the in-flight request as state, so it isn't safe to share between threads. Once injected, PyGithub
+    creates a connection per request instead, and this keeps them all on one requests session per host so
+    we still get keep-alive and connection pooling
+    """
 
-        reset_countdown = expiration - now
+    sessions: Dict = dict()
+    sessions_lock = threading.Lock()
 
-        remaining = rl.remaining
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)  # type: ignore
 
-        needed_requests = (self.repo_count // self.pages) + 1
+        key = (self.protocol, self.host, self.port)  # type: ignore
 
-        if needed_requests > remaining:
-            print(f"\n{needed_requests} requests needed and {remaining} remaining")
-            print(f"Sleeping: {reset_countdown.seconds} seconds")
-            time.sleep(int(reset_countdown.seconds))
+        with self.sessions_lock:
+            if key not in self.sessions:
+                self.sessions[key] = self.session  # type: ignore
+
+            self.session = self.sessions[key]
+
+
+class RateLimitMixin:
+    """
+    Feeds every response's rate limit headers to the RateLimit, waits for a slot before each request, and
+    retries requests that GitHub turned away with a secondary rate limit
+    """
+
+    rate_limit: Optional[RateLimit] = None
+
+    def getresponse(self):
+        rate_limit = self.rate_limit
+
+        # the rate_limit endpoint itself is free
+        if rate_limit is None or self.url.startswith("/rate_limit"):  # type: ignore
+            return super().getresponse()  # type: ignore
+
+        resource = RateLimit.resource_for(self.url)  # type: ignore
+        owner = TokenPool.owner_for(self.url, self.input)  # type: ignore
+
+        for attempt in range(0, RateLimit.RETRIES + 1):
+            token = rate_limit.pick(resource, owner)
+
+            if token:
+                self.headers = dict(self.headers)  # type: ignore
+                self.headers["Authorization"] = f"token {token}"
+
+            # this also waits out any backoff from the previous attempt
+            wait = rate_limit.bucket(resource, token).delay()
+
+            if wait > 0:
+                time.sleep(wait)
+
+            response = super().getresponse()  # type: ignore
+
+            headers = {k.lower(): v for k, v in response.getheaders()}
+
+            bucket = rate_limit.bucket(headers.get("x-ratelimit-resource", resource), token)
+
+            # a 304 doesn't count against the limit
+            bucket.observe(headers, counted=response.status != 304)
+
+            if attempt == RateLimit.RETRIES:
+                break
+
+            backoff = rate_limit.backoff(resource, token, response.status, headers, str(response.read()), attempt)
+
+            if backoff is None:
+                break
+
+        return response
+
+
+class SharedHTTPConnection(RateLimitMixin, SharedSessionMixin, HTTPRequestsConnectionClass):
+    pass
+
+
+class SharedHTTPSConnection(RateLimitMixin, SharedSessionMixin, HTTPSRequestsConnectionClass):
+    pass
+
+
+class CachedResponse:
+    """
+    Stands in for PyGithub's RequestsResponse when a 304 is answered from the cache
+    """
+
+    def __init__(self, status: int, headers: Dict, text: str):
+        self.status = status
+        self.headers = headers
+        self.text = text
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self):
+        return self.text
+
+
+class ConditionalCacheMixin:
+    """
+    Replays GET requests with If-None-Match / If-Modified-Since from the last response we saw for the url,
+    and hands PyGithub the cached body when GitHub answers 304, which doesn't count against the rate limit
+    """
+
+    http_cache: Optional[HTTPCache] = None
+
+    def request(self, verb, url, input, headers):
+        self.cache_key = None
+        self.cache_entry = None
+
+        if verb == "GET" and self.http_cache is not None:
+            # the token isn't part of the key, as it's only picked once the request goes out (see RateLimitMixin)
+            # GitHub only answers 304 when the ETag matches what the token actually used would get, anything else
+            # is a 200 that replaces the cached response. The media type changes the body, so it's part of the key
+            accept = headers.get("Accept", "")
+            self.cache_key = f"{self.host}:{self.port}{url}|{hashlib.sha256(accept.encode()).hexdigest()}"  # type: ignore
+            self.cache_entry = self.http_cache.get(self.cache_key)
+
+            if self.cache_entry is not None:
+                etag, last_modified, _, _ = self.cache_entry
+                headers = dict(headers)
+
+                if etag:
+                    headers["If-None-Match"] = etag
+                if last_modified:
+                    headers["If-Modified-Since"] = last_modified
+
+        super().request(verb, url, input, headers)  # type: ignore
+
+    def getresponse(self):
+        response = super().getresponse()  # type: ignore
+
+        if self.cache_key is None or self.http_cache is None:
+            return response
+
+        if response.status == 304 and self.cache_entry is not None:
+            _, _, cached_headers, body = self.cache_entry
+
+            # the rate limit headers have to come from the 304, everything else from the cached response
+            headers = dict(cached_headers)
+            headers.update({k.lower(): v for k, v in response.getheaders()})
+
+            self.http_cache.touch(self.cache_key)
+
+            return CachedResponse(200, headers, body)
+
+        if response.status == 200:
+            headers = {k.lower(): v for k, v in response.getheaders()}
+
+            if "etag" in headers or "last-modified" in headers:
+                self.http_cache.put(
+                    self.cache_key, headers.get("etag"), headers.get("last-modified"), headers, response.read()
+                )
+
+        return response
+
+
+class CachingHTTPConnection(ConditionalCacheMixin, SharedHTTPConnection):
+    pass
+
+
+class CachingHTTPSConnection(ConditionalCacheMixin, SharedHTTPSConnection):
+    pass
 
-    def total(self):
-        print(f"GH RateLimit: Total Core Calls = {self.core_calls[-1]}")
-        print(f"GH RateLimit: Total Search Calls = {self.search_calls[-1]}")
+
+def threadsafe_github(cache_dir: Optional[str] = None, rate_limit: Optional[RateLimit] = None):
+    """
+    Needs to be called before a Github object is created, as the connection class is picked at that point
+    With cache_dir set, GET responses are also cached there and replayed as conditional requests
+    With rate_limit set, every request is paced against it
+    """
+    RateLimitMixin.rate_limit = rate_limit
+
+    if cache_dir is not None:
+        ConditionalCacheMixin.http_cache = HTTPCache(cache_dir)
+        Requester.injectConnectionClasses(CachingHTTPConnection, CachingHTTPSConnection)
+    else:
+        Requester.injectConnectionClasses(SharedHTTPConnection, SharedHTTPSConnection)
+
+
+def get_repo_page(gh_repos: PaginatedList, page: int, rate_limit: RateLimit) -> List[Repository]:
+    """
+    Fetches a single page of an org's repos, meant to be run from a worker thread
+    """
+    rate_limit.check()
+
+    return gh_repos.get_page(page)
+
+
+def get_fork_import(gh: Github, full_name: str, rate_limit: RateLimit) -> Optional[ContentFile]:
+    """
+    Fetches a fork's import.yaml, meant to be run from a worker thread, None when the fork doesn't have one
+    The repo is lazy, we already have everything about it but the file, so this is a single request
+    """
+    rate_limit.check()
+
+    try:
+        return gh.get_repo(full_name, lazy=True).get_contents(".snyk.d/import.yaml")
+    except UnknownObjectException:
+        return None
+
+
+def get_import_content(import_yaml: ContentFile, rate_limit: RateLimit) -> bytes:
+    """
+    Fetches the content of an import.yaml, meant to be run from a worker thread
+    Code search hits don't include it, so for those it's a request per file, the graphql crawl already has it
+    """
+    rate_limit.check()
+
+    return import_yaml.decoded_content
+
+
+def get_repo_pages_since(gh_repos: PaginatedList, pages: int, since: str, rate_limit: RateLimit) -> List[Repository]:
+    """
+    Walks an org's repos page by page, they're sorted by most recently updated first, and stops after the
+    first page that reaches a repo last updated at or before since, as everything after it is unchanged
+    """
+    repos: List[Repository] = list()
+
+    for page in range(0, pages):
+        page_repos = get_repo_page(gh_repos, page, rate_limit)
+
+        repos.extend(page_repos)
+
+        if len(page_repos) == 0 or str(page_repos[-1].updated_at) <= since:
+            break
+
+    return repos
+
+
+GRAPHQL_REPOS_QUERY = """
+query ($org: String!, $cursor: String) {
+  organization(login: $org) {
+    repositories(first: 100, after: $cursor, orderBy: {field: UPDATED_AT, direction: DESC}) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      nodes {
+        databaseId
+        name
+        nameWithOwner
+        url
+        isFork
+        isArchived
+        visibility
+        updatedAt
+        pushedAt
+        owner {
+          login
+        }
+        defaultBranchRef {
+          name
+        }
+        repositoryTopics(first: 20) {
+          nodes {
+            topic {
+              name
+            }
+          }
+        }
+        importYaml: object(expression: "HEAD:.snyk.d/import.yaml") {
+          ... on Blob {
+            oid
+            text
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+def graphql_repo(requester: Requester, node: Dict) -> Tuple[Repository, Optional[ContentFile]]:
+    """
+    Turns a repository node from GRAPHQL_REPOS_QUERY into the same PyGithub objects the REST crawl returns,
+    so they can go straight into SnykWatchList.add_repo and Repo.parse_import
+    """
+    default_branch = "main"
+
+    if node["defaultBranchRef"] is not None:
+        default_branch = node["defaultBranchRef"]["name"]
+
+    raw_repo = {
+        "id": node["databaseId"],
+        "name": node["name"],
+        "full_name": node["nameWithOwner"],
+        "owner": {"login": node["owner"]["login"]},
+        "html_url": node["url"],
+        "fork": node["isFork"],
+        "archived": node["isArchived"],
+        "visibility": str(node["visibility"]).lower(),
+        "default_branch": default_branch,
+        "updated_at": node["updatedAt"],
+        "pushed_at": node["pushedAt"],
+        "topics": [t["topic"]["name"] for t in node["repositoryTopics"]["nodes"]],
+    }
+
+    repo = Repository(requester, {}, raw_repo, completed=True)
+
+    import_yaml = None
+
+    blob = node["importYaml"]
+
+    # object() is null when the file doesn't exist, and text is null for binary blobs
+    if blob is not None and blob.get("text") is not None:
+        raw_yaml = {
+            "type": "file",
+            "name": "import.yaml",
+            "path": ".snyk.d/import.yaml",
+            "sha": blob["oid"],
+            "encoding": "base64",
+            "content": base64.b64encode(blob["text"].encode()).decode(),
+            "repository": raw_repo,
+        }
+
+        import_yaml = ContentFile(requester, {}, raw_yaml, completed=True)
+
+    return repo, import_yaml
+
+
+def get_repos_graphql(gh: Github, gh_org: str, since: str = "") -> List[Tuple[Repository, Optional[ContentFile]]]:
+    """
+    Crawls an org's repos 100 at a time over GraphQL, each query also returns the repo's import.yaml
+    With since set, it stops after the first page that reaches a repo last updated at or before since
+    """
+    requester: Requester = gh._Github__requester  # type: ignore
+
+    repos: List[Tuple[Repository, Optional[ContentFile]]] = list()
+
+    cursor = None
+
+    while True:
+        query = {"query": GRAPHQL_REPOS_QUERY, "variables": {"org": gh_org, "cursor": cursor}}
+
+        _, resp = requester.requestJsonAndCheck("POST", "/graphql", input=query)
+
+        if resp.get("data") is None or resp["data"].get("organization") is None:
+            raise Exception(f"GraphQL query for {gh_org} failed: {resp.get('errors')}")
+
+        if resp.get("errors"):
+            logger.warning(f"GraphQL query for {gh_org} returned errors: {resp['errors']}")
+
+        page = resp["data"]["organization"]["repositories"]
+
+        page_repos = [graphql_repo(requester, node) for node in page["nodes"]]
+
+        repos.extend(page_repos)
+
+        if not page["pageInfo"]["hasNextPage"] or len(page_repos) == 0:
+            break
+
+        if since and str(page_repos[-1][0].updated_at) <= since:
+            break
+
+        cursor = page["pageInfo"]["endCursor"]
+
+    return repos
 
 
 class V3Projects(BaseModel):
@@ -143,3 +800,81 @@ def v1_get_pages(
         return_page[list_name].extend(page[list_name])
 
     return return_page
+
+
+class SnykRateLimit:
+    """
+    Token bucket holding one Snyk token to a number of requests a minute, shared by every thread using it
+    Up to a second's worth of requests can go out at once, after that they're spaced evenly
+    """
+
+    def __init__(self, per_minute: int):
+        self.rate = per_minute / 60.0
+        self.capacity = max(self.rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+# how often a Snyk request that got a 429 or a 5xx is retried
+SNYK_RETRIES = 3
+
+
+def snyk_status(error: SnykHTTPError) -> Optional[int]:
+    """
+    The HTTP status of a failed Snyk request, pysnyk's code is whatever the error body had in its "code" field,
+    so the status is read off the response it was raised with, None when there is no response to read
+    """
+    resp = error.args[0] if len(error.args) > 0 else None
+
+    status = getattr(resp, "status_code", None)
+
+    if isinstance(status, int):
+        return status
+
+    return None
+
+
+def is_retryable(error: SnykHTTPError) -> bool:
+    status = snyk_status(error)
+
+    return status is not None and (status == 429 or status >= 500)
+
+
+def snyk_request(func, *args, rate: Optional[SnykRateLimit] = None, retries: int = SNYK_RETRIES, backoff: float = 1.0):
+    """
+    Calls a SnykClient method, paced by rate, and retries 429s and 5xx with an exponential backoff
+    Anything else, like the 422 for a tag a project already has, a 401 for a bad token, or an error we can't
+    get a status for, is raised straight away
+    """
+    for attempt in range(0, retries + 1):
+        if rate is not None:
+            rate.acquire()
+
+        try:
+            return func(*args)
+        except SnykHTTPError as e:
+            if not is_retryable(e) or attempt == retries:
+                raise
+
+            wait = backoff * (2**attempt)
+
+            logger.warning(f"Snyk API returned {snyk_status(e)}, retrying in {wait} seconds")
+
+            time.sleep(wait)
@@ -1,32 +1,37 @@
+import copy
+import hashlib
 import json
 import logging
 import os
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures import wait
 from datetime import datetime as dt
 from datetime import timedelta
 from os import environ
 from pathlib import Path
 from pprint import pprint
+from typing import TYPE_CHECKING
 from typing import Any
+from typing import Callable
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Set
+from typing import TextIO
+from typing import Tuple
 from uuid import UUID
 
-import api
+import plans
 import typer
-import yaml
 from __version__ import __version__
-from api import RateLimit
-from github import Github
-from github.ContentFile import ContentFile
-from github.PaginatedList import PaginatedList
-from models.organizations import Orgs
-from models.repositories import Repo
-from models.sync import Settings
-from models.sync import SnykWatchList
-from snyk.client import SnykClient
-from snyk.errors import SnykHTTPError
+from utils import TargetWriter
 from utils import default_settings
+from utils import iter_watchlist
 from utils import jopen
 from utils import jwrite
 from utils import load_watchlist
@@ -34,11 +39,27 @@ from utils import update_client
 from utils import yopen
 
 
+# api, PyGithub, pysnyk, the pydantic models and yaml take most of the startup time, so they're imported by the
+# commands that use them, which lets --help and status, and targets / tags on a fresh cache, run without them
+if TYPE_CHECKING:
+    import api
+    from github.ContentFile import ContentFile
+    from github.PaginatedList import PaginatedList
+    from models.organizations import Orgs
+    from models.repositories import Repo
+    from models.sync import Settings
+    from models.sync import SnykWatchList
+    from snyk.client import SnykClient
+
+
 app = typer.Typer(add_completion=False)
 
-s = Settings()
+# the options as main was given them, status is answered from these without validating them into the settings
+params: Dict[str, Any] = dict()
+
+s: "Settings"
 
-watchlist = SnykWatchList()
+watchlist: "SnykWatchList"
 
 # DEBUG_LEVEL = environ["SNYK_SYNC_DEBUG_LEVEL"] or "INFO"
 
@@ -164,13 +185,69 @@ def main(
         envvar="GITHUB_TOKEN",
         callback=settings_callback,
     ),
+    workers: int = typer.Option(
+        default=10,
+        help="Maximum number of concurrent API requests",
+        envvar="SNYK_SYNC_WORKERS",
+        callback=settings_callback,
+    ),
+    cache_backend: str = typer.Option(
+        default="json",
+        help="How the cache is stored: json or sqlite",
+        envvar="SNYK_SYNC_CACHE_BACKEND",
+        callback=settings_callback,
+    ),
+    incremental: bool = typer.Option(
+        default=False,
+        help="Only crawl GitHub repos updated since the last sync",
+        envvar="SNYK_SYNC_INCREMENTAL",
+        callback=settings_callback,
+    ),
+    full_sync_interval: float = typer.Option(
+        default=24,
+        help="With --incremental, hours between full crawls that pick up deleted repos",
+        envvar="SNYK_SYNC_FULL_SYNC_INTERVAL",
+        callback=settings_callback,
+    ),
+    crawl_engine: str = typer.Option(
+        default="rest",
+        help="How GitHub is crawled: rest or graphql",
+        envvar="SNYK_SYNC_CRAWL_ENGINE",
+        callback=settings_callback,
+    ),
+    snyk_rate_limit: int = typer.Option(
+        default=1500,
+        help="Maximum Snyk API requests a minute for each token",
+        envvar="SNYK_SYNC_SNYK_RATE_LIMIT",
+        callback=settings_callback,
+    ),
+    http_cache: bool = typer.Option(
+        default=True,
+        help="Cache GitHub responses and revalidate them with conditional requests",
+        envvar="SNYK_SYNC_HTTP_CACHE",
+        callback=settings_callback,
+    ),
 ):
 
     # We keep this as the global settings hash
     global s
     global watchlist
 
-    s = Settings.parse_obj(ctx.params)
+    params.update(ctx.params)
+
+    if params["cache_backend"] not in ["json", "sqlite"]:
+        raise typer.BadParameter(f"Unknown cache backend: {params['cache_backend']}, expected json or sqlite")
+
+    if params["crawl_engine"] not in ["rest", "graphql"]:
+        raise typer.BadParameter(f"Unknown crawl engine: {params['crawl_engine']}, expected rest or graphql")
+
+    if ctx.invoked_subcommand != "status":
+        from models.sync import Settings
+        from models.sync import SnykWatchList
+
+        s = Settings.parse_obj(params)
+
+        watchlist = SnykWatchList()
 
     if ctx.invoked_subcommand is None:
         typer.echo("Snyk Sync invoked with no subcommand, executing all", err=True)
@@ -189,6 +266,14 @@ def sync(
     """
     Force a sync of the local cache of the GitHub / Snyk data.
     """
+    import api
+    from api import RateLimit
+    from api import TokenPool
+    from github import Github
+    from models.organizations import Orgs
+    from models.repositories import Repo
+    from snyk.client import SnykClient
+    from sqlite_cache import ImportCache
 
     global watchlist
 
@@ -199,15 +284,34 @@ def sync(
     # either load the watchlist from disk
     # or return an empty one if there is none
 
-    tmp_watch: SnykWatchList = load_watchlist(s.cache_dir)
+    tmp_watch: "SnykWatchList" = load_watchlist(s.cache_dir, s.cache_backend)
 
     watchlist.repos = tmp_watch.repos
+    watchlist.watermarks = tmp_watch.watermarks
+    watchlist.last_full_sync = tmp_watch.last_full_sync
 
     GH_PAGE_LIMIT = 100
 
-    gh = Github(s.github_token, per_page=GH_PAGE_LIMIT)
+    gh_tokens = s.github_tokens()
 
-    rate_limit = RateLimit(gh, GH_PAGE_LIMIT)
+    # with a single token requests go out exactly as they always have
+    token_pool = None
+
+    if s.github_app is not None:
+        token_pool = TokenPool(gh_tokens, app_id=s.github_app["id"], private_key=s.github_app["private_key"])
+        typer.echo(f"Spreading GitHub requests over {len(gh_tokens)} tokens and GitHub App installations", err=True)
+    elif len(gh_tokens) > 1:
+        token_pool = TokenPool(gh_tokens)
+        typer.echo(f"Spreading GitHub requests over {len(gh_tokens)} tokens", err=True)
+
+    rate_limit = RateLimit(token_pool)
+
+    if s.http_cache:
+        api.threadsafe_github(cache_dir=str(s.cache_dir), rate_limit=rate_limit)
+    else:
+        api.threadsafe_github(rate_limit=rate_limit)
+
+    gh = Github(gh_tokens[0] if gh_tokens else None, per_page=GH_PAGE_LIMIT, pool_size=s.workers)
 
     client = SnykClient(str(s.snyk_token), user_agent=f"pysnyk/snyk_services/sync/{__version__}", tries=2, delay=1)
 
@@ -225,6 +329,17 @@ def sync(
     else:
         gh_orgs = list()
 
+    if token_pool is not None:
+        no_token_orgs = [o for o in gh_orgs if not token_pool.has_token(o)]
+
+        if len(no_token_orgs) > 0:
+            typer.echo(
+                f"The GitHub App is not installed in {', '.join(no_token_orgs)} and there are no github tokens "
+                "to use instead, install it there or remove them from github_orgs",
+                err=True,
+            )
+            raise typer.Exit(code=1)
+
     rate_limit.update(show_rate_limit)
 
     exclude_list: list = []
@@ -233,50 +348,128 @@ def sync(
 
     repo_ids: list = []
 
-    for gh_org_name in gh_orgs:
+    def get_org_repos(gh_org_name: str):
         gh_org = gh.get_organization(gh_org_name)
         gh_repos = gh_org.get_repos(type="all", sort="updated", direction="desc")
-        gh_repos_count = gh_repos.totalCount
+        return gh_repos, gh_repos.totalCount
+
+    # an org crawled incrementally only returns its changed repos, so we can only tell which repos were deleted
+    # from the orgs that get a full crawl
+    incremental_orgs = [
+        gh_org_name
+        for gh_org_name in gh_orgs
+        if s.incremental and not watchlist.needs_full_crawl(gh_org_name, s.full_sync_interval)
+    ]
+
+    import_yamls: list = []
+
+    if s.crawl_engine == "graphql":
+
+        # each org is one chain of cursor paged queries, so the orgs are what we spread over the pool
+        org_jobs = list()
 
-        rate_limit.add_calls(gh_repos_count)
+        with ThreadPoolExecutor(max_workers=s.workers) as gh_pool:
 
-        pages = gh_repos_count // GH_PAGE_LIMIT
+            for gh_org_name in gh_orgs:
+                since = ""
 
-        if (gh_repos_count % GH_PAGE_LIMIT) > 0:
-            pages += 1
+                if gh_org_name in incremental_orgs:
+                    since = watchlist.watermarks[gh_org_name]
 
-        with typer.progressbar(
-            length=pages, label=f"Processing {gh_repos_count} repos in {gh_org_name}: "
-        ) as gh_progress:
+                org_jobs.append(gh_pool.submit(api.get_repos_graphql, gh, gh_org_name, since))
 
-            for r_int in range(0, pages):
+            for gh_org_name, org_job in zip(gh_orgs, org_jobs):
 
-                rate_limit.check()
+                gh_org_repos = org_job.result()
 
-                for gh_repo in gh_repos.get_page(r_int):
+                typer.echo(f"Processing {len(gh_org_repos)} repos in {gh_org_name}", err=True)
+
+                for gh_repo, import_yaml in gh_org_repos:
 
                     watchlist.add_repo(gh_repo)
+                    watchlist.update_watermark(gh_org_name, str(gh_repo.updated_at))
                     repo_ids.append(gh_repo.id)
 
-                gh_progress.update(1)
+                    if import_yaml is not None:
+                        import_yamls.append(import_yaml)
+    else:
+        with ThreadPoolExecutor(max_workers=s.workers) as gh_pool:
+
+            org_repos = list(gh_pool.map(get_org_repos, gh_orgs))
+
+            # every page of every org is queued up front, but we consume them in org / page order
+            # so the watchlist ends up the same as if we had walked them one at a time
+            org_pages = list()
+
+            for gh_org_name, (gh_repos, gh_repos_count) in zip(gh_orgs, org_repos):
+                pages = gh_repos_count // GH_PAGE_LIMIT
+
+                if (gh_repos_count % GH_PAGE_LIMIT) > 0:
+                    pages += 1
+
+                if gh_org_name in incremental_orgs:
+                    # pages have to be walked in order to know where to stop, so an org is a single job
+                    page_futures = [
+                        gh_pool.submit(
+                            api.get_repo_pages_since, gh_repos, pages, watchlist.watermarks[gh_org_name], rate_limit
+                        )
+                    ]
+                else:
+                    page_futures = [
+                        gh_pool.submit(api.get_repo_page, gh_repos, r_int, rate_limit) for r_int in range(0, pages)
+                    ]
+
+                org_pages.append(page_futures)
+
+            for gh_org_name, (_, gh_repos_count), page_futures in zip(gh_orgs, org_repos, org_pages):
+
+                with typer.progressbar(
+                    length=len(page_futures), label=f"Processing {gh_repos_count} repos in {gh_org_name}: "
+                ) as gh_progress:
+
+                    for page_future in page_futures:
+
+                        for gh_repo in page_future.result():
+
+                            watchlist.add_repo(gh_repo)
+                            watchlist.update_watermark(gh_org_name, str(gh_repo.updated_at))
+                            repo_ids.append(gh_repo.id)
+
+                        gh_progress.update(1)
+
+    if len(incremental_orgs) == 0:
+        watchlist.prune(repo_ids)
+        watchlist.last_full_sync = dt.isoformat(dt.utcnow())
+    else:
+        # an org without a watermark yet, like one just added to the config, is still crawled in full
+        full_orgs = [o for o in gh_orgs if o not in incremental_orgs]
+
+        if len(full_orgs) > 0:
+            watchlist.prune(repo_ids, gh_orgs=full_orgs)
 
-    watchlist.prune(repo_ids)
+        typer.echo(f"Incremental crawl found {len(repo_ids)} updated repos", err=True)
 
     # print(exclude_list)
     rate_limit.update(show_rate_limit)
 
-    import_yamls: list = []
-    for gh_org in gh_orgs:
-        search = f"org:{gh_org} path:.snyk.d filename:import language:yaml"
-        import_repos: PaginatedList[ContentFile] = gh.search_code(query=search)
-        rate_limit.add_calls(import_repos.totalCount)
-        rate_limit.check("search")
-        filtered_repos: List = [
-            y for y in import_repos if y.repository.id not in exclude_list and y.name == "import.yaml"
-        ]
-        import_yamls.extend(filtered_repos)
+    # every import.yaml we've ever parsed, by blob sha, many repos share the same template file
+    import_cache = ImportCache(s.cache_dir)
 
-    rate_limit.update(show_rate_limit)
+    def load_import(import_yaml: "ContentFile") -> Tuple[dict, bool]:
+        """
+        Resolves an import.yaml read from the blob cache, or downloaded, parsed and added to it,
+        and whether it was cached
+        """
+        import_sha = str(import_yaml.sha)
+
+        document = import_cache.get(import_sha)
+        cached = document is not None
+
+        if document is None:
+            document = Repo.read_import(api.get_import_content(import_yaml, rate_limit))
+            import_cache.put(import_sha, document)
+
+        return Repo.resolve_import(document, s.instance), cached
 
     # we will likely want to put a limit around this, as we need to walk forked repose and try to get import.yaml
     # since github won't index a fork if it has less stars than upstream
@@ -284,71 +477,103 @@ def sync(
     forks = [f for f in watchlist.repos if f.fork]
     forks = [y for y in forks if y.id not in exclude_list]
 
-    if s.forks is True and len(forks) > 0:
-        typer.echo(f"Scanning {len(forks)} forks for import.yaml", err=True)
+    if s.forks is True and len(forks) > 0 and s.crawl_engine == "rest":
 
-        rate_limit.add_calls(len(forks) * 2)
-        rate_limit.check()
+        # a fork that hasn't been pushed to since we last looked can't have a new import.yaml
+        changed_forks = [f for f in forks if f.needs_fork_scan()]
 
-        with typer.progressbar(forks, label="Scanning: ") as forks_progress:
-            for fork in forks_progress:
-                try:
-                    f_owner = fork.source.owner
-                    f_name = fork.source.name
-                    f_repo = gh.get_repo(f"{f_owner}/{f_name}")
-
-                    f_yaml = f_repo.get_contents(".snyk.d/import.yaml")
-                    yaml_repo = watchlist.get_repo(f_repo.id)
-                    if yaml_repo:
-                        yaml_repo.parse_import(f_yaml, instance=s.instance)
-                except Exception as e:
-                    typer.echo(f"\n\n - error processing fork: {e!r}\n")
-                    typer.echo("dumping fork object:")
-                    pprint(fork)
+        typer.echo(
+            f"Scanning {len(changed_forks)} forks for import.yaml, skipping {len(forks) - len(changed_forks)} "
+            "that haven't been pushed to since the last scan",
+            err=True,
+        )
 
-        typer.echo(f"Have {len(import_yamls)} Repos with an import.yaml", err=True)
-        rate_limit.update(show_rate_limit)
+        with ThreadPoolExecutor(max_workers=s.workers) as fork_pool:
 
-    if len(import_yamls) > 0:
-        typer.echo(f"Loading import.yaml for non fork-ed repos", err=True)
+            fork_jobs = {
+                fork_pool.submit(api.get_fork_import, gh, f"{fork.source.owner}/{fork.source.name}", rate_limit): fork
+                for fork in changed_forks
+            }
 
-        with typer.progressbar(import_yamls, label="Scanning: ") as import_progress:
-            for import_yaml in import_progress:
+            with typer.progressbar(length=len(fork_jobs), label="Scanning: ") as forks_progress:
+                for fork_job in as_completed(fork_jobs):
+                    fork = fork_jobs[fork_job]
 
-                r_id = import_yaml.repository.id
+                    try:
+                        f_yaml = fork_job.result()
 
-                import_repo = watchlist.get_repo(r_id)
+                        if f_yaml is not None and str(fork.import_sha) != str(f_yaml.sha):
+                            fork.apply_import(load_import(f_yaml)[0], str(f_yaml.sha))
 
-                if import_repo and str(import_repo.import_sha) != str(import_yaml.sha):
-                    try:
-                        import_repo.parse_import(import_yaml, instance=s.instance)
+                        fork.fork_scanned_at = fork.pushed_at
                     except Exception as e:
-                        typer.echo(
-                            f"\n\n*** ERROR processing import.yaml file:"
-                            f"Please check that it is valid YAML\n {e}"
-                            f"\ndumping repo object: {import_repo}\n"
-                        )
+                        typer.echo(f"\n\n - error processing fork: {e!r}\n")
+                        typer.echo("dumping fork object:")
+                        pprint(fork)
+
+                    forks_progress.update(1)
+
+        rate_limit.update(show_rate_limit)
+
+    def search_imports() -> Iterator["ContentFile"]:
+        """
+        Yields the import.yaml search hits of every org, the pages are fetched as they're reached
+        """
+        for gh_org in gh_orgs:
+            search = f"org:{gh_org} path:.snyk.d filename:import language:yaml"
+            import_repos: "PaginatedList[ContentFile]" = gh.search_code(query=search)
+            rate_limit.check("search")
+
+            for import_yaml in import_repos:
+                if import_yaml.repository.id not in exclude_list and import_yaml.name == "import.yaml":
+                    yield import_yaml
+
+    # the graphql crawl already has every repo's import.yaml, forks included
+    import_hits: Iterable["ContentFile"] = import_yamls
+
+    if s.crawl_engine == "rest":
+        import_hits = search_imports()
+
+    typer.echo(f"Loading import.yaml for non fork-ed repos", err=True)
+
+    import_counts = apply_import_hits(import_hits, watchlist, load_import, s.workers)
+
+    import_cache.close()
+
+    typer.echo(
+        f"Loaded {import_counts['loaded']} changed import.yaml files, {import_counts['cached']} from the cache, "
+        f"{import_counts['unchanged']} unchanged, {import_counts['errors']} with errors",
+        err=True,
+    )
 
     rate_limit.update(show_rate_limit)
 
     # this calls our new Orgs object which caches and populates Snyk data locally for us
-    all_orgs = Orgs(cache=str(s.cache_dir), groups=s.snyk_groups)
+    all_orgs = Orgs(cache=str(s.cache_dir), groups=s.snyk_groups, backend=s.cache_backend)
 
     select_orgs = [str(o["orgId"]) for k, o in s.snyk_orgs.items()]
 
     typer.echo(f"Updating cache of Snyk projects", err=True)
 
-    all_orgs.refresh_orgs(client, v3client, origin="github-enterprise", selected_orgs=select_orgs)
+    all_orgs.refresh_orgs(client, v3client, origin="github-enterprise", selected_orgs=select_orgs, workers=s.workers)
 
     all_orgs.save()
 
     typer.echo("Scanning Snyk for projects originating from GitHub Enterprise Repos", err=True)
-    for repo in watchlist.repos:
-        found_projects = all_orgs.find_projects_by_repo(repo.full_name, repo.id)
-        for p in found_projects:
-            repo.add_project(p)
+    all_orgs.assign_projects(watchlist.repos)
+
+    watchlist.save(cachedir=str(s.cache_dir), backend=s.cache_backend)
+
+    typer.echo("Writing the import and tag plans", err=True)
+
+    # the org files of orgs no longer in snyk-orgs.yaml are still loaded by targets and tags, so they count too
+    cached_orgs = Orgs(cache=str(s.cache_dir), groups=s.snyk_groups, backend=s.cache_backend)
+    cached_orgs.load(with_projects=False)
+
+    plans.save_plans(
+        s.cache_dir, watchlist.repos, s.default_org, s.snyk_orgs, s.snyk_groups, org_groups_index(cached_orgs)
+    )
 
-    watchlist.save(cachedir=str(s.cache_dir))
     typer.echo("Sync completed", err=True)
 
     if show_rate_limit is True:
@@ -359,22 +584,107 @@ def sync(
     typer.echo(f"Total Repos: {len(watchlist.repos)}", err=True)
 
 
+def apply_import_hits(
+    import_hits: Iterable["ContentFile"],
+    watched: "SnykWatchList",
+    load_import: Callable[["ContentFile"], Tuple[dict, bool]],
+    workers: int,
+) -> Dict[str, int]:
+    """
+    Applies each import.yaml hit to its repo in the watchlist, load_import fetching and resolving them on a pool
+    of workers, and returns how many were loaded, cached, unchanged and failed
+    """
+    import_counts = {"loaded": 0, "cached": 0, "unchanged": 0, "errors": 0}
+
+    # sha of the import.yaml being fetched, and the repos waiting on it, a blob shared by several repos is
+    # only fetched once even when they come up in the same page
+    in_flight: Dict["Future[Tuple[dict, bool]]", Tuple[str, List[Repo]]] = dict()
+    fetching: Dict[str, "Future[Tuple[dict, bool]]"] = dict()
+
+    def apply_imports(import_jobs: Iterable["Future[Tuple[dict, bool]]"]):
+        for import_job in import_jobs:
+            import_sha, import_repos = in_flight.pop(import_job)
+            del fetching[import_sha]
+
+            for import_repo in import_repos:
+                try:
+                    r_yaml, cached = import_job.result()
+
+                    # each repo gets its own copy, as apply_import keeps the lists it's given
+                    import_repo.apply_import(copy.deepcopy(r_yaml), import_sha)
+                    import_counts["cached" if cached else "loaded"] += 1
+                except Exception as e:
+                    import_counts["errors"] += 1
+                    typer.echo(
+                        f"\n\n*** ERROR processing import.yaml file of {import_repo.full_name}: "
+                        f"Please check that it is valid YAML\n {e}"
+                        f"\ndumping repo object: {import_repo}\n"
+                    )
+
+    # hits are read a page at a time while the files are fetched and parsed by the pool, with only a couple of
+    # files per worker in flight so nothing piles up, a hit whose blob we've already read, for this repo or any
+    # other, is never fetched
+    with ThreadPoolExecutor(max_workers=workers) as import_pool:
+
+        for import_yaml in import_hits:
+
+            import_repo = watched.get_repo(import_yaml.repository.id)
+
+            if import_repo is None:
+                continue
+
+            import_sha = str(import_yaml.sha)
+
+            if str(import_repo.import_sha) == import_sha:
+                import_counts["unchanged"] += 1
+                continue
+
+            if import_sha in fetching:
+                in_flight[fetching[import_sha]][1].append(import_repo)
+                continue
+
+            if len(in_flight) >= workers * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                apply_imports(done)
+
+            fetching[import_sha] = import_pool.submit(load_import, import_yaml)
+            in_flight[fetching[import_sha]] = (import_sha, [import_repo])
+
+        apply_imports(as_completed(list(in_flight)))
+
+    return import_counts
+
+
+def org_groups_index(all_orgs: "Orgs") -> Dict[str, str]:
+    """
+    Returns org id -> group id for every org in the configured groups
+    """
+    org_groups = dict()
+
+    for group in s.snyk_groups:
+        for o in all_orgs.get_orgs_by_group(group):
+            org_groups[str(o.id)] = str(group["id"])
+
+    return org_groups
+
+
 @app.command()
 def status():
     """
     Return if the cache is out of date
     """
-    global watchlist
-    global s
+    # answered from sync.json alone, the repos are only loaded by the commands that need them
 
-    if s.force_sync:
+    if params["force_sync"]:
         typer.echo("Sync forced, ignoring cache status", err=True)
         return False
 
     typer.echo("Checking cache status", err=True)
 
-    if os.path.exists(f"{s.cache_dir}/sync.json"):
-        sync_data = jopen(f"{s.cache_dir}/sync.json")
+    cache_dir = params["cache_dir"]
+
+    if os.path.exists(f"{cache_dir}/sync.json"):
+        sync_data = jopen(f"{cache_dir}/sync.json")
     else:
         return False
 
@@ -382,25 +692,16 @@ def status():
 
     in_sync = True
 
-    if s.cache_timeout is None:
+    if params["cache_timeout"] is None:
         timeout = 0
     else:
-        timeout = float(str(s.cache_timeout))
+        timeout = float(str(params["cache_timeout"]))
 
     if last_sync < dt.utcnow() - timedelta(minutes=timeout):
         typer.echo("Cache is out of date and needs to be updated", err=True)
         in_sync = False
     else:
-        typer.echo(f"Cache is less than {s.cache_timeout} minutes old", err=True)
-
-    typer.echo("Attempting to load cache", err=True)
-
-    watchlist = load_watchlist(s.cache_dir)
-
-    typer.echo("Cache loaded successfully", err=True)
-
-    watchlist.default_org = s.default_org
-    watchlist.snyk_orgs = s.snyk_orgs
+        typer.echo(f"Cache is less than {params['cache_timeout']} minutes old", err=True)
 
     return in_sync
 
@@ -418,6 +719,15 @@ def targets(
     force_refresh: bool = typer.Option(
         False, "--force-refresh", help="Ignore if a target already has projects in snyk and force a reimport"
     ),
+    batch_size: int = typer.Option(
+        0,
+        "--batch-size",
+        help="With --save, split each group's targets into numbered files of this many targets",
+        envvar="SNYK_SYNC_TARGETS_BATCH_SIZE",
+    ),
+    ndjson: bool = typer.Option(
+        False, "--ndjson", help="Write one target per line as it's generated, instead of a json document per group"
+    ),
 ):
     """
     Returns valid input for api-import to consume
@@ -425,30 +735,98 @@ def targets(
     global s
     global watchlist
 
+    if batch_size < 0 or (batch_size > 0 and not save_targets):
+        raise typer.BadParameter("--batch-size has to be a positive number of targets and needs --save")
+
     if status() == False:
         sync()
     else:
         load_conf()
 
-    tmp_watch: SnykWatchList = load_watchlist(s.cache_dir)
+    # the plan written by sync covers the default case, the forced ones are worked out from the cache
+    plan = None
 
-    watchlist.repos = tmp_watch.repos
+    if not force_default and not force_refresh:
+        plan = plans.load_plan(s.cache_dir, plans.plan_fingerprint(s.default_org, s.snyk_orgs, s.snyk_groups))
 
-    all_orgs = Orgs(cache=str(s.cache_dir), groups=s.snyk_groups)
+    # (group id, target) pairs, which are written out as they come wherever the output allows it
+    if plan is not None:
+        target_stream = targets_from_plan(include_archived, require_metadata)
+    else:
+        target_stream = targets_from_cache(force_default, require_metadata, include_archived, force_refresh)
 
-    all_orgs.load()
+    group_names = {str(g["id"]): g["name"] for g in s.snyk_groups}
 
-    target_list = []
+    if save_targets is True:
+        typer.echo(f"Writing targets to {s.targets_dir}", err=True)
+        if os.path.isdir(f"{s.targets_dir}") is not True:
+            typer.echo(f"Creating directory to {s.targets_dir}", err=True)
+            os.mkdir(f"{s.targets_dir}")
 
-    if include_archived:
-        filtered_repos = watchlist.repos
-    else:
-        filtered_repos = [r for r in watchlist.repos if r.archived is not True]
+        writers = {g_id: TargetWriter(s.targets_dir, name, batch_size, ndjson) for g_id, name in group_names.items()}
+
+        for g_id, target in target_stream:
+            writers[g_id].add(target)
 
-    if require_metadata:
-        filtered_repos = [r for r in filtered_repos if r.import_sha != ""]
+        for writer in writers.values():
+            for file_name in writer.close():
+                typer.echo(f"Wrote {file_name} Successfully", err=True)
+    elif ndjson:
+        for g_id, target in target_stream:
+            typer.echo(json.dumps({"group": group_names[g_id], **target}, separators=(",", ":")))
     else:
-        filtered_repos = filtered_repos
+        final_targets = [{"name": g["name"], "targets": list()} for g in s.snyk_groups]
+
+        group_targets = {str(g["id"]): g_targets["targets"] for g, g_targets in zip(s.snyk_groups, final_targets)}
+
+        for g_id, target in target_stream:
+            group_targets[g_id].append(target)
+
+        typer.echo(json.dumps(final_targets, indent=2))
+
+
+def targets_from_plan(include_archived: bool, require_metadata: bool) -> Iterator[Tuple[str, dict]]:
+    """
+    Yields each group's targets, with the group's id, from the plan written by the last sync
+    """
+
+    for group in s.snyk_groups:
+        for record in plans.iter_plan(s.cache_dir, "targets", group["id"]):
+            if record["archived"] and not include_archived:
+                continue
+
+            if require_metadata and not record["has_import"]:
+                continue
+
+            target = {
+                "target": record["target"],
+                "integrationId": record["integrations"]["github-enterprise"],
+                "orgId": record["org_id"],
+            }
+
+            yield str(group["id"]), target
+
+
+def targets_from_cache(
+    force_default: bool, require_metadata: bool, include_archived: bool, force_refresh: bool
+) -> Iterator[Tuple[str, dict]]:
+    """
+    Yields the targets, with their group's id, worked out from the cached repos and orgs as they're streamed
+    Targets in orgs outside every group are left out
+    """
+    from models.organizations import Orgs
+
+    all_orgs = Orgs(cache=str(s.cache_dir), groups=s.snyk_groups, backend=s.cache_backend)
+
+    # we only need to know which orgs are in which group
+    all_orgs.load(with_projects=False)
+
+    org_groups = org_groups_index(all_orgs)
+
+    # the repos are filtered as they are streamed from the cache, and only their targets are kept
+    filtered_repos = iter_watchlist(
+        s.cache_dir, s.cache_backend, include_archived=include_archived, require_import=require_metadata
+    )
 
     for r in filtered_repos:
 
@@ -473,82 +851,60 @@ def targets(
                         "orgId": org_id,
                     }
 
-                    target_list.append(target)
-
-    final_targets = list()
+                    g_id = org_groups.get(str(org_id))
 
-    for group in s.snyk_groups:
-        orgs = all_orgs.get_orgs_by_group(group)
-
-        o_ids = [str(o.id) for o in orgs]
-
-        g_targets = {"name": group["name"], "targets": list()}
-
-        g_targets["targets"] = [t for t in target_list if str(t["orgId"]) in o_ids]
-
-        final_targets.append(g_targets)
-
-    if save_targets is True:
-        typer.echo(f"Writing targets to {s.targets_dir}", err=True)
-        if os.path.isdir(f"{s.targets_dir}") is not True:
-            typer.echo(f"Creating directory to {s.targets_dir}", err=True)
-            os.mkdir(f"{s.targets_dir}")
-        for targets in final_targets:
-            file_name = f"{s.targets_dir}/{targets.pop('name')}.json"
-            if len(targets["targets"]) > 50:
-                minimize = True
-            else:
-                minimize = False
-
-            if jwrite(targets, file_name, minimize):
-                typer.echo(f"Wrote {file_name} Successfully", err=True)
-            else:
-                typer.echo(f"Failed to Write {file_name}", err=True)
-    else:
-        typer.echo(json.dumps(final_targets, indent=2))
+                    if g_id is not None:
+                        yield g_id, target
 
 
 @app.command()
 def tags(
     update_tags: bool = typer.Option(False, "--update", help="Updates tags on projects instead of outputting them"),
     save_tags: bool = typer.Option(False, "--save", help="Write tags to disk, otherwise print to stdout"),
+    trust_cache: float = typer.Option(
+        0,
+        "--trust-cache",
+        help="With --update, post the missing tags of orgs synced in the last N minutes without fetching each project",
+        envvar="SNYK_SYNC_TAGS_TRUST_CACHE",
+    ),
 ):
     """
     Returns list of project id's and the tags said projects are missing
     """
+    from models.organizations import Orgs
+
     global s
     global watchlist
 
-    v1client = SnykClient(str(s.snyk_token), user_agent=f"pysnyk/snyk_services/sync/{__version__}", tries=1, delay=1)
-
     if status() == False:
         sync()
     else:
         load_conf()
 
-    tmp_watch = load_watchlist(s.cache_dir)
-
-    watchlist.repos = tmp_watch.repos
+    plan = plans.load_plan(s.cache_dir, plans.plan_fingerprint(s.default_org, s.snyk_orgs, s.snyk_groups))
 
-    all_orgs = Orgs(cache=str(s.cache_dir), groups=s.snyk_groups)
-
-    all_orgs.load()
-
-    needs_tags = list()
-
-    for group in s.snyk_groups:
+    all_orgs = Orgs(cache=str(s.cache_dir), groups=s.snyk_groups, backend=s.cache_backend)
 
-        group_tags = {"name": group["name"], "tags": list()}
-
-        orgs = all_orgs.get_orgs_by_group(group)
+    if plan is not None:
+        # the projects needing tags were worked out by the last sync, so only their group's slice is read
+        needs_tags = [
+            {"name": g["name"], "tags": list(plans.iter_plan(s.cache_dir, "tags", g["id"]))} for g in s.snyk_groups
+        ]
+    else:
+        # we only need to know which orgs are in which group
+        all_orgs.load(with_projects=False)
 
-        o_ids = [str(o.id) for o in orgs]
+        needs_tags = tags_from_cache(all_orgs)
 
-        group_tags["tags"] = watchlist.get_proj_tag_updates(o_ids)
+    # now we iterate over needs_tags by group and save out a per group tag file
 
-        needs_tags.append(group_tags)
+    if update_tags is True:
+        import api
+        from snyk.client import SnykClient
 
-    # now we iterate over needs_tags by group and save out a per group tag file
+        v1client = SnykClient(
+            str(s.snyk_token), user_agent=f"pysnyk/snyk_services/sync/{__version__}", tries=1, delay=1
+        )
 
     for g_tags in needs_tags:
         if g_tags["tags"]:
@@ -568,27 +924,27 @@ def tags(
                             if type(t[k]) is not str:
                                 t[k] = str(t[k])
 
-                    p_path = f"org/{p['org_id']}/project/{p['project_id']}"
-                    p_tag_path = f"{p_path}/tags"
+                # every request made with the group's token is held to the one rate
+                snyk_rate = api.SnykRateLimit(s.snyk_rate_limit)
 
-                    try:
-                        p_live = v1client.get(p_path).json()
-                    except SnykHTTPError as e:
-                        typer.echo(f"Error: retrieving project path: {p_path} error:\n{e}")
-                        break
-
-                    tags_to_post = [t for t in p["tags"] if t not in p_live["tags"]]
-
-                    if len(tags_to_post) > 0:
-                        typer.echo(f"Updating {g_tags['name']} project {p_live['name']} tags", err=True)
-                        for tag in tags_to_post:
-                            try:
-                                v1client.post(p_tag_path, tag)
-                            except SnykHTTPError as e:
-                                if e.code == 422:
-                                    typer.echo(f"Error: Tag for project already exists")
-                                else:
-                                    raise Exception(f"snyk api returned code: {e.code}")
+                # the plan for these orgs came from project tags fetched recently enough to go on
+                trusted_orgs: Set[str] = set()
+
+                if trust_cache > 0:
+                    if len(all_orgs.orgs) == 0:
+                        all_orgs.load(with_projects=False)
+
+                    trusted_orgs = {str(o.id) for o in all_orgs.orgs if o.refreshed_within(trust_cache)}
+
+                summary = update_group_tags(
+                    v1client, g_tags["name"], g_tags["tags"], s.workers, snyk_rate, trusted_orgs
+                )
+
+                typer.echo(
+                    f"{g_tags['name']}: tags applied to {summary['applied']} projects, "
+                    f"{summary['skipped']} skipped as already tagged, {summary['failed']} failed",
+                    err=True,
+                )
 
             if save_tags is True:
                 typer.echo(f"Writing {g_tags['name']} tag updates to {s.tags_dir}")
@@ -608,6 +964,207 @@ def tags(
             typer.echo(f"No {g_tags['name']} projects require tag updates", err=True)
 
 
+def tags_from_cache(all_orgs: "Orgs") -> List[dict]:
+    """
+    Works out each group's projects needing tags from the cached repos
+    """
+    watchlist.default_org = s.default_org
+    watchlist.snyk_orgs = s.snyk_orgs
+
+    org_groups = org_groups_index(all_orgs)
+
+    # only repos with tags can have projects missing tags, and they're checked as they're streamed from the
+    # cache, in one pass for every group, so only the projects needing tags are held in memory
+    tag_updates = watchlist.get_proj_tag_updates(
+        set(org_groups), iter_watchlist(s.cache_dir, s.cache_backend, require_tags=True)
+    )
+
+    needs_tags = [{"name": group["name"], "tags": list()} for group in s.snyk_groups]
+
+    group_tags = {str(group["id"]): g_tags["tags"] for group, g_tags in zip(s.snyk_groups, needs_tags)}
+
+    for fix_project in tag_updates:
+        group_tags[org_groups[fix_project["org_id"]]].append(fix_project)
+
+    return needs_tags
+
+
+def update_project_tags(
+    v1client: "SnykClient",
+    group_name: str,
+    p: dict,
+    rate: Optional["api.SnykRateLimit"] = None,
+    trusted: bool = False,
+) -> str:
+    """
+    Adds the tags a project is missing, returns applied, skipped if it had them all already,
+    or failed if the project couldn't be retrieved or a tag couldn't be added
+    When trusted, the missing tags worked out from the cache are posted without fetching the project first
+    """
+    import api
+    from snyk.errors import SnykHTTPError
+
+    p_path = f"org/{p['org_id']}/project/{p['project_id']}"
+    p_tag_path = f"{p_path}/tags"
+
+    if trusted:
+        p_name = p["project_id"]
+        tags_to_post = list(p["tags"])
+    else:
+        try:
+            p_live = api.snyk_request(v1client.get, p_path, rate=rate).json()
+        except SnykHTTPError as e:
+            typer.echo(f"Error: retrieving project path: {p_path} error:\n{e}")
+            return "failed"
+
+        p_name = p_live["name"]
+        tags_to_post = [t for t in p["tags"] if t not in p_live["tags"]]
+
+    if len(tags_to_post) == 0:
+        return "skipped"
+
+    typer.echo(f"Updating {group_name} project {p_name} tags", err=True)
+    for tag in tags_to_post:
+        try:
+            api.snyk_request(v1client.post, p_tag_path, tag, rate=rate)
+        except SnykHTTPError as e:
+            # the code pysnyk sets comes from the body, the status is what says the tag is already there
+            status = api.snyk_status(e)
+
+            if status == 422 and trusted:
+                # the cache was behind for this project, so check the rest of its tags against the live one
+                return update_project_tags(v1client, group_name, p, rate)
+            elif status == 422:
+                typer.echo(f"Error: Tag for project already exists")
+            else:
+                typer.echo(f"Error: adding tags to {p_path}, snyk api returned code: {status}")
+                return "failed"
+
+    return "applied"
+
+
+def update_group_tags(
+    v1client: "SnykClient",
+    group_name: str,
+    projects: List[dict],
+    workers: int,
+    rate: "api.SnykRateLimit",
+    trusted_orgs: Set[str] = set(),
+) -> Dict[str, int]:
+    """
+    Updates the tags on a group's projects from a pool of workers, a project that fails doesn't stop the rest
+    Returns how many projects were applied, skipped and failed
+    """
+
+    summary = {"applied": 0, "skipped": 0, "failed": 0}
+
+    with ThreadPoolExecutor(max_workers=workers) as tag_pool:
+
+        tag_jobs = {
+            tag_pool.submit(update_project_tags, v1client, group_name, p, rate, p["org_id"] in trusted_orgs): p
+            for p in projects
+        }
+
+        for tag_job in as_completed(tag_jobs):
+            try:
+                summary[tag_job.result()] += 1
+            except Exception as e:
+                typer.echo(f"Error: updating tags on project {tag_jobs[tag_job]['project_id']}: {e!r}")
+                summary["failed"] += 1
+
+    return summary
+
+
+# how long an unfinished autoconf can be carried on from, after that its integrations are looked up again
+AUTOCONF_RESUME_HOURS = 24
+
+
+def autoconf_fingerprint(orgs: List[dict]) -> str:
+    """
+    Identifies the orgs an autoconf run is looking up, a group that gained or lost orgs starts a new run
+    """
+    org_ids = sorted([str(o["id"]) for o in orgs])
+
+    return hashlib.sha256(json.dumps(org_ids).encode()).hexdigest()
+
+
+def load_autoconf_progress(progress_path: Path, fingerprint: str) -> Dict[str, dict]:
+    """
+    Returns org id -> integrations for the orgs an earlier, unfinished autoconf already looked up, as long as
+    it was looking up the same orgs and started less than AUTOCONF_RESUME_HOURS ago
+    """
+
+    org_ints: Dict[str, dict] = dict()
+
+    if not progress_path.exists():
+        return org_ints
+
+    with open(progress_path, "r") as progress:
+        try:
+            run = json.loads(progress.readline())
+            started = dt.fromisoformat(run["started"])
+        except (ValueError, KeyError, TypeError):
+            # written before the file had a header, or cut short
+            return org_ints
+
+        if run.get("orgs") != fingerprint or started < dt.utcnow() - timedelta(hours=AUTOCONF_RESUME_HOURS):
+            return org_ints
+
+        for line in progress:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # the last line can be cut short if we were stopped while writing it
+                continue
+
+            org_ints[record["id"]] = record["integrations"]
+
+    return org_ints
+
+
+def start_autoconf_progress(progress: TextIO, fingerprint: str):
+    progress.write(json.dumps({"started": dt.isoformat(dt.utcnow()), "orgs": fingerprint}) + "\n")
+    progress.flush()
+
+
+def save_autoconf_progress(progress: TextIO, org: dict, org_int: dict):
+    progress.write(json.dumps({"id": org["id"], "integrations": org_int}) + "\n")
+    progress.flush()
+
+
+def get_integrations(
+    client: "SnykClient", orgs: List[dict], workers: int, rate: "api.SnykRateLimit", progress: TextIO
+) -> Dict[str, dict]:
+    """
+    Looks up the integrations of every org from a pool of workers, returns org id -> integrations for the
+    ones that worked. Each is appended to progress as it arrives, so a rerun can carry on from there
+    """
+    import api
+
+    org_ints: Dict[str, dict] = dict()
+
+    with ThreadPoolExecutor(max_workers=workers) as int_pool:
+
+        int_jobs = {
+            int_pool.submit(api.snyk_request, client.get, f"org/{org['id']}/integrations", rate=rate): org
+            for org in orgs
+        }
+
+        with typer.progressbar(length=len(int_jobs), label="Retrieving every Orgs integration details: ") as bar:
+            for int_job in as_completed(int_jobs):
+                org = int_jobs[int_job]
+
+                try:
+                    org_ints[org["id"]] = int_job.result().json()
+                    save_autoconf_progress(progress, org, org_ints[org["id"]])
+                except Exception as e:
+                    typer.echo(f"\nError: retrieving integrations for {org['slug']}: {e!r}", err=True)
+
+                bar.update(1)
+
+    return org_ints
+
+
 @app.command()
 def autoconf(
     snykorg: str = typer.Argument(..., help="The Snyk Org Slug to use"),
@@ -618,6 +1175,10 @@ def autoconf(
 
     This requires an existing snyk-sync.yaml and snyk-orgs.yaml, which it will overwrite
     """
+    import api
+    import yaml
+    from snyk.client import SnykClient
+
     global s
 
     client = SnykClient(str(s.snyk_token), user_agent=f"pysnyk/snyk_services/sync/{__version__}")
@@ -652,19 +1213,47 @@ def autoconf(
 
     conf["snyk"]["groups"].append(group)
 
-    group_orgs = api.v1_get_pages(f"group/{my_group_id}/orgs", client, "orgs")
-
     snyk_orgs: Dict[Any, Any] = dict()
 
-    with typer.progressbar(group_orgs["orgs"], label="Retrieving every Orgs integration details: ") as orgs:
-        for org in orgs:
+    group_orgs = api.v1_get_pages(f"group/{my_group_id}/orgs", client, "orgs")["orgs"]
+
+    # every lookup is written here as it completes, and the file is only removed once the config is written
+    progress_path = Path(f"{s.snyk_orgs_file.parent}/.autoconf-{my_group_id}.ndjson")
+
+    # the file belongs to a run, it's only picked up again for the same orgs and while it's recent
+    fingerprint = autoconf_fingerprint(group_orgs)
+
+    org_ints_by_id = load_autoconf_progress(progress_path, fingerprint)
+
+    if len(org_ints_by_id) > 0:
+        typer.echo(f"Resuming, {len(org_ints_by_id)} Orgs already have their integrations retrieved", err=True)
+
+    todo_orgs = [o for o in group_orgs if o["id"] not in org_ints_by_id]
+
+    snyk_rate = api.SnykRateLimit(s.snyk_rate_limit)
+
+    with open(progress_path, "a" if len(org_ints_by_id) > 0 else "w") as progress:
+        if len(org_ints_by_id) == 0:
+            start_autoconf_progress(progress, fingerprint)
+
+        org_ints_by_id.update(get_integrations(client, todo_orgs, s.workers, snyk_rate, progress))
 
-            org_int = client.get(f"org/{org['id']}/integrations").json()
+    missing_orgs = [o for o in group_orgs if o["id"] not in org_ints_by_id]
 
-            if "github-enterprise" in org_int:
-                snyk_orgs[org["slug"]] = dict()
-                snyk_orgs[org["slug"]]["orgId"] = org["id"]
-                snyk_orgs[org["slug"]]["integrations"] = org_int
+    if len(missing_orgs) > 0:
+        typer.echo(
+            f"Unable to retrieve the integrations of {len(missing_orgs)} Orgs, run autoconf again to retry them",
+            err=True,
+        )
+        raise typer.Exit(code=1)
+
+    org_ints = [(org, org_ints_by_id[org["id"]]) for org in group_orgs]
+
+    for org, org_int in org_ints:
+        if "github-enterprise" in org_int:
+            snyk_orgs[org["slug"]] = dict()
+            snyk_orgs[org["slug"]]["orgId"] = org["id"]
+            snyk_orgs[org["slug"]]["integrations"] = org_int
 
     if s.conf.write_text(yaml.safe_dump(conf)):
         typer.echo(f"Wrote Snyk Syncconfiguration to: {s.conf.as_posix()}", err=True)
@@ -672,6 +1261,8 @@ def autoconf(
     if s.snyk_orgs_file.write_text(yaml.safe_dump(snyk_orgs)):
         typer.echo(f"Wrote Snyk Orgs data for the Group: {my_group_slug} to: {s.snyk_orgs_file.as_posix()}", err=True)
 
+    progress_path.unlink()
+
 
 def load_conf():
 
@@ -688,6 +1279,15 @@ def load_conf():
 
     s.snyk_orgs = yopen(s.snyk_orgs_file)
 
+    if "github_app" in conf_file.keys():
+        s.github_app = dict(conf_file["github_app"])
+
+        env_var = s.github_app["private_key_env_name"]
+        if env_var in environ.keys():
+            s.github_app["private_key"] = environ[env_var]
+        else:
+            raise Exception(f"Environment Variable {env_var} is not set properly and required")
+
     watchlist.default_org = s.default_org
     watchlist.snyk_orgs = s.snyk_orgs
 
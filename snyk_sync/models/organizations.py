@@ -1,27 +1,43 @@
 import json
 import logging
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from datetime import timedelta
+from typing import TYPE_CHECKING
 from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple
 from uuid import UUID
 
-from api import v1_get_pages
 from pydantic import UUID4
 from pydantic import BaseModel
 from pydantic import Field
+from pydantic import PrivateAttr
 from pydantic import validator
-from snyk.client import SnykClient
+from sqlite_cache import SQLiteCache
+from utils import clone_client
 from utils import jopen
 from utils import to_camel_case
-from utils import update_client
 
 from .repositories import Project
+from .repositories import Repo
+
+
+# api pulls in pysnyk and PyGithub, which loading the cache doesn't need, so it's only imported to refresh orgs
+if TYPE_CHECKING:
+    from snyk.client import SnykClient
 
 
 logger = logging.getLogger(__name__)
 
+# version of the single file per org cache layout, written in each file's header record
+# files in this schema hold the json() of validated models, so they are loaded back without validation,
+# any change to the Org, Target or Project fields needs this bumped
+ORG_CACHE_SCHEMA = 1
+
 
 class Target(BaseModel):
     class Config:
@@ -67,6 +83,20 @@ class Target(BaseModel):
 
         return bool(value["isPrivate"])
 
+    @classmethod
+    def from_cache(cls, data: dict) -> "Target":
+        """
+        Rebuilds a target from its own json() output without running the validators, only for records
+        read from a cache written in the current schema
+        """
+        values = dict(data)
+        values["id"] = UUID(str(values["id"]))
+
+        if values.get("org_id") is not None:
+            values["org_id"] = UUID(str(values["org_id"]))
+
+        return cls.construct(**values)
+
     @validator("repo_id", pre=True)
     def validate_repo_id(cls, value):
 
@@ -94,6 +124,31 @@ class Org(BaseModel):
     group_name: str
     origins: List[str] = list()
     last_updated: str = datetime.isoformat(datetime.utcnow())
+    # hash indexes over projects and targets, maintained by add_project / add_target
+    _project_pos: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _target_pos: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _targets_by_repo_id: Dict[str, Dict[str, Target]] = PrivateAttr(default_factory=dict)
+    _targets_by_name: Dict[str, Dict[str, Target]] = PrivateAttr(default_factory=dict)
+    _projects_by_target: Dict[str, Dict[str, Project]] = PrivateAttr(default_factory=dict)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self.reindex()
+
+    @classmethod
+    def from_cache(cls, metadata: dict, integrations: dict) -> "Org":
+        """
+        Rebuilds an org from the metadata and integrations it saved without running the validators, only for
+        records read from a cache written in the current schema. It starts with no targets or projects, so the
+        empty indexes construct() leaves it with are already correct
+        """
+        values = dict(metadata)
+        values["id"] = UUID(str(values["id"]))
+        values["group_id"] = UUID(str(values["group_id"]))
+        values["integrations"] = {k: UUID(str(v)) for k, v in integrations.items()}
+
+        return cls.construct(**values)
+
     #       "name": "myDefaultOrg",
     #  "id": "689ce7f9-7943-4a71-b704-2ba575f01089",
     #  "slug": "my-default-org",
@@ -117,7 +172,7 @@ class Org(BaseModel):
     def int_list(self):
         return list(self.integrations.keys())
 
-    def refresh_targets(self, client: SnykClient, origin: str = None, exclude_empty: bool = True, limit: int = 100):
+    def refresh_targets(self, client: "SnykClient", origin: str = None, exclude_empty: bool = True, limit: int = 100):
         """
         Retrieves all the targets from this org object, using the provided client
         Optionally matches on 'origin'
@@ -135,7 +190,7 @@ class Org(BaseModel):
             new_target.org_slug = self.slug
             self.add_target(new_target)
 
-    def refresh_projects(self, client: SnykClient, origin: str = None, target: UUID4 = None, limit: int = 100):
+    def refresh_projects(self, client: "SnykClient", origin: str = None, target: UUID4 = None, limit: int = 100):
         """
         Retrieves all the projects from this org object, using the provided client
         Optionally matches on 'origin' and/or target
@@ -167,7 +222,7 @@ class Org(BaseModel):
 
         self.origins = set(target_origins + project_origins)
 
-    def refresh_integrations(self, client: SnykClient):
+    def refresh_integrations(self, client: "SnykClient"):
         resp = client.get(f"org/{self.id}/integrations")
 
         integrations: dict = resp.json()
@@ -176,8 +231,8 @@ class Org(BaseModel):
 
     def refresh(
         self,
-        v1client: SnykClient,
-        v3client: SnykClient,
+        v1client: "SnykClient",
+        v3client: "SnykClient",
         origin: str = None,
         target: UUID4 = None,
     ):
@@ -187,15 +242,20 @@ class Org(BaseModel):
         self.refresh_integrations(v1client)
         self.last_updated = datetime.isoformat(datetime.utcnow())
 
+    def refreshed_within(self, minutes: float) -> bool:
+
+        last_updated = datetime.fromisoformat(str(self.last_updated))
+
+        return last_updated > datetime.utcnow() - timedelta(minutes=minutes)
+
     def get_target_info(self, id: UUID) -> Optional[Target]:
 
-        found_target = [t for t in self.targets if str(t.id) == str(id)]
+        idx = self._target_pos.get(str(id))
 
-        if len(found_target) == 1:
-            target = found_target[0]
-        else:
-            target = None
-        return target
+        if idx is None:
+            return None
+
+        return self.targets[idx]
 
     def get_metadata(self) -> dict:
 
@@ -211,53 +271,124 @@ class Org(BaseModel):
         return the_dict
 
     def save(self, path):
-        if os.path.isdir(f"{path}/targets") is not True:
-            os.mkdir(f"{path}/targets")
+        """
+        Writes the org to a single newline delimited json file: a header record with the metadata and
+        integrations, then one record per target and per project. It's written to a temp file first so
+        a failed save never leaves a half written cache behind
+        """
 
-        if os.path.isdir(f"{path}/projects") is not True:
-            os.mkdir(f"{path}/projects")
+        header = {
+            "schema": ORG_CACHE_SCHEMA,
+            "metadata": self.get_metadata(),
+            "integrations": json.loads(json.dumps(self.integrations, default=str)),
+            "targets": len(self.targets),
+            "projects": len(self.projects),
+        }
+
+        compact = (",", ":")
+
+        with open(f"{path}.tmp", "w") as the_file:
+            the_file.write(json.dumps(header, separators=compact) + "\n")
+
+            for target in self.targets:
+                the_file.write(f'{{"target":{target.json(separators=compact)}}}\n')
+
+            for project in self.projects:
+                the_file.write(f'{{"project":{project.json(separators=compact)}}}\n')
+
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def load(cls, path, with_projects: bool = True) -> "Org":
+        """
+        Reads an org back from the file written by save, one record at a time
+        With with_projects False only the header is read
+        The records were validated before they were saved, so they're rehydrated without validation
+        """
+
+        with open(path, "r") as the_file:
+            header = json.loads(the_file.readline())
+
+            if header.get("schema") != ORG_CACHE_SCHEMA:
+                raise Exception(f"{path} has an unknown cache schema: {header.get('schema')}")
 
-        with open(f"{path}/integrations.json", "w") as the_file:
-            json.dump(self.integrations, the_file, indent=4)
+            new_org = cls.from_cache(header["metadata"], header["integrations"])
 
-        with open(f"{path}/metadata.json", "w") as the_file:
-            json.dump(self.get_metadata(), the_file, indent=4)
+            if not with_projects:
+                return new_org
 
-        for target in self.targets:
-            with open(f"{path}/targets/{target.id}.json", "w") as the_file:
-                json.dump(json.loads(target.json()), the_file, indent=4)
+            for line in the_file:
+                record = json.loads(line)
 
-        for project in self.projects:
-            with open(f"{path}/projects/{project.id}.json", "w") as the_file:
-                json.dump(json.loads(project.json()), the_file, indent=4)
+                if "target" in record:
+                    new_org.add_target(Target.from_cache(record["target"]))
+                elif "project" in record:
+                    new_org.add_project(Project.from_cache(record["project"]))
 
-        pass
+        return new_org
+
+    def reindex(self):
+        """
+        Rebuilds every index from the project and target lists, duplicates by id collapse to the last one
+        """
+        projects = self.projects
+        targets = self.targets
+
+        self.projects = list()
+        self.targets = list()
+        self._project_pos = dict()
+        self._target_pos = dict()
+        self._targets_by_repo_id = dict()
+        self._targets_by_name = dict()
+        self._projects_by_target = dict()
+
+        for target in targets:
+            self.add_target(target)
+
+        for project in projects:
+            self.add_project(project)
 
     def add_project(self, project: Project):
 
-        add_project = True
+        key = str(project.id)
 
-        for idx, item in enumerate(self.projects):
-            if project.id == item.id:
-                add_project = False
-                self.projects[idx] = project
+        idx = self._project_pos.get(key)
 
-        if add_project:
+        if idx is not None:
+            old_project = self.projects[idx]
+            self._projects_by_target.get(str(old_project.target).lower(), {}).pop(key, None)
+            self.projects[idx] = project
+        else:
+            self._project_pos[key] = len(self.projects)
             self.projects.append(project)
 
+        self._projects_by_target.setdefault(str(project.target).lower(), {})[key] = project
+
     def add_target(self, target: Target):
 
-        add_target = True
+        key = str(target.id)
 
-        for idx, item in enumerate(self.targets):
-            if target.id == item.id:
-                add_target = False
-                self.targets[idx] = target
+        idx = self._target_pos.get(key)
 
-        if add_target:
+        if idx is not None:
+            old_target = self.targets[idx]
+            if old_target.repo_id is not None:
+                self._targets_by_repo_id.get(str(old_target.repo_id), {}).pop(key, None)
+            self._targets_by_name.get(str(old_target.name).lower(), {}).pop(key, None)
+            self.targets[idx] = target
+        else:
+            self._target_pos[key] = len(self.targets)
             self.targets.append(target)
 
-    def load(self, path):
+        if target.repo_id is not None:
+            self._targets_by_repo_id.setdefault(str(target.repo_id), {})[key] = target
+        self._targets_by_name.setdefault(str(target.name).lower(), {})[key] = target
+
+    def load_legacy(self, path):
+        """
+        Loads the targets and projects from the old cache layout, a directory per org with a json file per
+        target and per project. Only used to migrate an existing cache
+        """
         if os.path.isdir(f"{path}/targets") is not True:
             raise Exception(f"{path}/targets does not exist")
 
@@ -267,7 +398,8 @@ class Org(BaseModel):
         if os.path.isfile(f"{path}/integrations.json") is not True:
             raise Exception(f"{path}/integrations.json does not exist")
 
-        self.integrations = jopen(f"{path}/integrations.json")
+        # assigning doesn't validate, so convert them the way parse_obj would, as a reload of the migrated file does
+        self.integrations = {k: UUID(str(v)) for k, v in jopen(f"{path}/integrations.json").items()}
 
         for target_file in os.listdir(f"{path}/targets"):
             if os.path.isfile(f"{path}/targets/{target_file}") and target_file.endswith(".json"):
@@ -285,22 +417,21 @@ class Org(BaseModel):
 
     def find_targets_by_repo(self, name, id) -> List[Target]:
 
-        targets_by_id = [t for t in self.targets if t.repo_id == id]
+        targets_by_id = self._targets_by_repo_id.get(str(id), {})
 
-        targets_by_name = [t for t in self.targets if str(t.name).lower() == str(name).lower()]
+        targets_by_name = self._targets_by_name.get(str(name).lower(), {})
 
-        if len(targets_by_name) == 0 and len(targets_by_id) == 0:
-            return list()
-        else:
-            for target in targets_by_name:
-                if target.id not in [t.id for t in targets_by_id]:
-                    targets_by_id.append(target)
+        found_targets = list(targets_by_id.values())
+
+        for key, target in targets_by_name.items():
+            if key not in targets_by_id:
+                found_targets.append(target)
 
-            return targets_by_id
+        return found_targets
 
     def find_projects_by_target(self, id) -> List[Project]:
 
-        projects = [p for p in self.projects if str(p.target).lower() == str(id).lower()]
+        projects = list(self._projects_by_target.get(str(id).lower(), {}).values())
 
         return projects
 
@@ -323,18 +454,38 @@ class Orgs(BaseModel):
     orgs: List[Org] = list()
     cache: str = ""
     groups: List[dict] = list()
+    backend: str = "json"
+
+    def refresh_orgs(
+        self,
+        v1client: "SnykClient",
+        v3client: "SnykClient",
+        origin: str = None,
+        selected_orgs: list = [],
+        workers: int = 1,
+    ):
+        """
+        Refreshes every org on a thread pool per group, each group gets its own pair of clients for its token
+        The number of orgs refreshed at once is the group's 'workers' value from snyk-sync.yaml, or workers
+        """
+        from api import v1_get_pages
+
+        group_clients = dict()
 
-    def refresh_orgs(self, v1client: SnykClient, v3client: SnykClient, origin: str = None, selected_orgs: list = []):
         for group in self.groups:
             group_id = group["id"]
             group_token = group["snyk_token"]
 
-            v1client = update_client(v1client, group_token)
+            group_v1client = clone_client(v1client, group_token)
+            group_v3client = clone_client(v3client, group_token)
+
+            group_clients[str(group_id)] = (group_v1client, group_v3client)
 
             try:
-                new_orgs = v1_get_pages(f"group/{group_id}/orgs", v1client, "orgs")
+                new_orgs = v1_get_pages(f"group/{group_id}/orgs", group_v1client, "orgs")
             except:
                 print(f"Unable to load orgs from: {group['name']} with token stored at: {group['token_env_name']}")
+                continue
 
             for org in new_orgs["orgs"]:
                 if len(selected_orgs) == 0 or org["id"] in selected_orgs:
@@ -342,17 +493,27 @@ class Orgs(BaseModel):
                     org["group_name"] = new_orgs["name"]
                     self.add_org(Org.parse_obj(org))
 
-        for org in self.orgs:
-            logger.debug(f"Refreshing Org: {org.name}")
+        group_pools = {
+            str(g["id"]): ThreadPoolExecutor(max_workers=int(g.get("workers", workers))) for g in self.groups
+        }
 
-            snyk_token = self.get_token_for_org(org)
+        try:
+            refreshes = list()
 
-            v1client = update_client(v1client, snyk_token)
-            v3client = update_client(v3client, snyk_token)
+            for org in self.orgs:
+                logger.debug(f"Refreshing Org: {org.name}")
 
-            org.refresh(v1client, v3client, origin)
+                org_v1client, org_v3client = group_clients[str(org.group_id)]
 
-        pass
+                org_pool = group_pools[str(org.group_id)]
+
+                refreshes.append(org_pool.submit(org.refresh, org_v1client, org_v3client, origin))
+
+            for refresh in refreshes:
+                refresh.result()
+        finally:
+            for pool in group_pools.values():
+                pool.shutdown()
 
     def add_org(self, org: Org):
 
@@ -385,34 +546,89 @@ class Orgs(BaseModel):
         print(f"All Targets: {sum(all_targets)}")
 
     def save(self):
+        if self.backend == "sqlite":
+            with SQLiteCache(self.cache) as cache:
+                for org in self.orgs:
+                    cache.save_org(
+                        org.get_metadata(),
+                        json.loads(json.dumps(org.integrations, default=str)),
+                        [json.loads(t.json()) for t in org.targets],
+                        [json.loads(p.json()) for p in org.projects],
+                    )
+            return
+
         if os.path.isdir(f"{self.cache}/org") is not True:
             os.mkdir(f"{self.cache}/org")
 
         for org in self.orgs:
-            if os.path.isdir(f"{self.cache}/org/{org.slug}") is not True:
-                os.mkdir(f"{self.cache}/org/{org.slug}")
+            org.save(f"{self.cache}/org/{org.slug}.ndjson")
+
+    def load(self, with_projects: bool = True):
+        """
+        Loads every cached org, with_projects False only loads each org's metadata and integrations,
+        which is all that's needed to map orgs to groups
+        """
+        # until the first save after switching to sqlite, carry on loading the org files
+        if self.backend == "sqlite" and (self.has_sqlite_orgs() or not os.path.isdir(f"{self.cache}/org")):
+            with SQLiteCache(self.cache) as cache:
+                # rows written in the current schema were validated on the way in
+                trusted = cache.is_current()
+
+                for metadata, integrations, targets, projects in cache.load_orgs(with_projects=with_projects):
+                    if trusted:
+                        new_org = Org.from_cache(metadata, integrations)
+                    else:
+                        new_org = Org.parse_obj(metadata)
+                        new_org.integrations = integrations
+
+                    for target in targets:
+                        new_org.add_target(Target.from_cache(target) if trusted else Target.parse_obj(target))
 
-            org.save(f"{self.cache}/org/{org.slug}")
+                    for project in projects:
+                        new_org.add_project(Project.from_cache(project) if trusted else Project.parse_obj(project))
+
+                    self.add_org(new_org)
+            return
 
-    def load(self):
         if os.path.isdir(f"{self.cache}/org") is not True:
             raise Exception(f"{self.cache}/org does not exist")
 
-        load_orgs = list()
+        for entry in os.listdir(f"{self.cache}/org"):
+            org_path = f"{self.cache}/org/{entry}"
+
+            if os.path.isfile(org_path) and entry.endswith(".ndjson"):
+                self.add_org(Org.load(org_path, with_projects))
+            elif os.path.isdir(org_path):
+                self.migrate_org(org_path)
+
+    def has_sqlite_orgs(self) -> bool:
+        with SQLiteCache(self.cache) as cache:
+            return cache.has_saved_orgs()
+
+    def migrate_org(self, org_path: str):
+        """
+        Loads an org from the old directory per org layout, rewrites it as a single file and removes the directory
+        If the single file already exists (a migration that didn't get to remove the directory) it wins
+        """
+
+        if os.path.isfile(f"{org_path}.ndjson"):
+            shutil.rmtree(org_path)
+            return
+
+        if os.path.isfile(f"{org_path}/metadata.json") is not True:
+            raise Exception(f"{org_path}/metadata.json does not exist")
 
-        for dir in os.listdir(f"{self.cache}/org"):
-            if os.path.isdir(f"{self.cache}/org/{dir}"):
-                load_orgs.append(f"{self.cache}/org/{dir}")
+        logger.info(f"Migrating {org_path} to the single file cache layout")
 
-        for org_path in load_orgs:
-            if os.path.isfile(f"{org_path}/metadata.json") is not True:
-                raise Exception(f"{org_path}/metadata.json does not exist")
+        new_org = Org.parse_file(f"{org_path}/metadata.json")
 
-            new_org = Org.parse_file(f"{org_path}/metadata.json")
+        new_org.load_legacy(org_path)
 
-            new_org.load(org_path)
+        new_org.save(f"{org_path}.ndjson")
 
-            self.add_org(new_org)
+        shutil.rmtree(org_path)
+
+        self.add_org(new_org)
 
     def find_projects_by_repo(self, name, id) -> List[Project]:
 
@@ -423,6 +639,34 @@ class Orgs(BaseModel):
 
         return found_projects
 
+    def assign_projects(self, repos: List[Repo]):
+        """
+        Bulk version of find_projects_by_repo, builds the target by repo id / name maps across every org once
+        and then adds the matching projects to each repo in a single pass
+        """
+
+        targets_by_repo_id: Dict[str, List[Tuple[Org, Target]]] = dict()
+        targets_by_name: Dict[str, List[Tuple[Org, Target]]] = dict()
+
+        for org in self.orgs:
+            for target in org.targets:
+                if target.repo_id is not None:
+                    targets_by_repo_id.setdefault(str(target.repo_id), list()).append((org, target))
+                targets_by_name.setdefault(str(target.name).lower(), list()).append((org, target))
+
+        for repo in repos:
+            found_targets = targets_by_repo_id.get(str(repo.id), list())
+
+            name_targets = targets_by_name.get(str(repo.full_name).lower(), list())
+
+            if name_targets:
+                target_ids = {t.id for _, t in found_targets}
+                found_targets = found_targets + [(o, t) for o, t in name_targets if t.id not in target_ids]
+
+            for org, target in found_targets:
+                for project in org.find_projects_by_target(target.id):
+                    repo.add_project(project)
+
     def get_token_for_org(self, org: Org) -> str:
 
         group = [g for g in self.groups if str(g["id"]) == str(org.group_id)]
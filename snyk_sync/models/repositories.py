@@ -1,15 +1,23 @@
 from datetime import datetime
+from typing import TYPE_CHECKING
+from typing import Dict
 from typing import List
 from typing import Optional
+from typing import Tuple
+from uuid import UUID
 
 import yaml
-from github import ContentFile
 from pydantic import UUID4
 from pydantic import BaseModel
 from pydantic import Field
+from pydantic import PrivateAttr
 from pydantic import validator
 
 
+if TYPE_CHECKING:
+    from github import ContentFile
+
+
 class Source(BaseModel):
     fork: bool
     name: str
@@ -114,6 +122,19 @@ class Project(BaseModel):
 
         return value["target"]["data"]["id"]
 
+    @classmethod
+    def from_cache(cls, data: dict) -> "Project":
+        """
+        Rebuilds a project from its own json() output without running the validators, only for records
+        read from a cache written in the current schema
+        """
+        values = dict(data)
+        values["id"] = UUID(str(values["id"]))
+        values["org_id"] = UUID(str(values["org_id"]))
+        values["tags"] = [Tag.construct(**t) for t in values["tags"]]
+
+        return cls.construct(**values)
+
     def match(self, **kwargs):
         valid_keys = {x: y for x, y in kwargs.items() if x in self.__dict__}
         matches = 0
@@ -158,6 +179,9 @@ class Repo(BaseModel):
     source: Source
     id: int
     updated_at: str
+    pushed_at: str = ""
+    # the pushed_at of a fork when its import.yaml was last looked for, nothing can have changed until it moves
+    fork_scanned_at: str = ""
     import_sha: str = ""
     full_name: str
     projects: List[Project] = []
@@ -168,19 +192,61 @@ class Repo(BaseModel):
     topics: List[str] = list()
     archived: bool = False
     visibility: str = "public"
+    # project id -> position in self.projects, dropped when the list is replaced and rebuilt whenever it
+    # no longer matches the list
+    _project_pos: Dict[str, int] = PrivateAttr(default_factory=dict)
+    # the plan get_reimport last built, with the default org and snyk_orgs mapping it was built from,
+    # dropped whenever one of the fields it depends on changes
+    _plan: Optional[Tuple[str, dict, List[Branch]]] = PrivateAttr(default=None)
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+
+        if name in ("branches", "org", "tags", "projects"):
+            self._plan = None
+
+        if name == "projects":
+            self._project_pos = dict()
+
+    @classmethod
+    def from_cache(cls, data: dict) -> "Repo":
+        """
+        Rebuilds a repo and its projects from its own json() output without running the validators,
+        only for records read from a cache written in the current schema
+        """
+        values = dict(data)
+        values["source"] = Source.construct(**values["source"])
+        values["tags"] = [Tag.construct(**t) for t in values.get("tags", [])]
+        values["projects"] = [Project.from_cache(p) for p in values.get("projects", [])]
+
+        return cls.construct(**values)
 
     def get_reimport(self, default_org, snyk_orgs: dict) -> List[Branch]:
         """
         Returns a list branches and their associated projects that can be used for reimport
+        The plan is kept until the repo's branches, org, tags or projects change, or it's asked for with a
+        different default org or snyk_orgs mapping (compared by identity, load_conf always builds a new one)
         """
 
+        plan = self._plan
+
+        if plan is not None and plan[0] == default_org and plan[1] is snyk_orgs:
+            return list(plan[2])
+
         todo = self.parse_branches(default_org, snyk_orgs)
 
-        for i, br in enumerate(todo):
+        # bucket the projects once, rather than going through all of them for every branch
+        projects_by_branch: Dict[Tuple[str, str], List[Project]] = dict()
 
-            todo[i].projects = [p for p in self.projects if str(p.org_id) == br.org_id and p.branch == br.name]
+        for p in self.projects:
+            projects_by_branch.setdefault((str(p.org_id), p.branch), list()).append(p)
 
-        return todo
+        for br in todo:
+            br.projects = list(projects_by_branch.get((br.org_id, br.name), list()))
+
+        self._plan = (default_org, snyk_orgs, todo)
+
+        return list(todo)
 
     def parse_branches(self, default_org: str, snyk_orgs: dict) -> List[Branch]:
 
@@ -259,28 +325,44 @@ class Repo(BaseModel):
     def has_tags(self):
         return len(self.tags) > 0
 
-    def get_project(self, id) -> Project:
+    def project_index(self) -> Dict[str, int]:
 
-        filter_repo = [r for r in self.projects if r.id == id]
+        index = self._project_pos
 
-        return filter_repo[0]
+        if len(index) != len(self.projects):
+            index = {str(p.id): idx for idx, p in enumerate(self.projects)}
+            self._project_pos = index
 
-    def has_project(self, id) -> bool:
+        return index
 
-        filter_repo = [r for r in self.projects if r.id == id]
+    def get_project(self, id) -> Project:
+
+        return self.projects[self.project_index()[str(id)]]
 
-        return bool(len(filter_repo))
+    def has_project(self, id) -> bool:
+
+        return str(id) in self.project_index()
 
     def add_project(self, project: Project):
 
-        if self.has_project(project.id):
-            for idx, item in enumerate(self.projects):
-                if project.id == item.id:
-                    self.projects[idx] = project
+        index = self.project_index()
+
+        key = str(project.id)
 
+        idx = index.get(key)
+
+        if idx is not None and self.projects[idx].id == project.id:
+            self.projects[idx] = project
+        elif idx is not None:
+            # the list was changed underneath us, so fall back to a rebuild
+            self._project_pos = dict()
+            self.add_project(project)
         else:
+            index[key] = len(self.projects)
             self.projects.append(project)
 
+        self._plan = None
+
     def match(self, **kwargs):
         valid_keys = {x: y for x, y in kwargs.items() if x in self.source.__dict__}
         # print(valid_keys)
@@ -306,15 +388,34 @@ class Repo(BaseModel):
 
         return matches == len(valid_keys) and matches_projects
 
-    def parse_import(self, import_yaml: ContentFile.ContentFile, instance: str = None):
+    def parse_import(self, import_yaml: "ContentFile.ContentFile", instance: str = None):
+        document = self.read_import(import_yaml.decoded_content)
+
+        self.apply_import(self.resolve_import(document, instance), import_yaml.sha)
+
+    @staticmethod
+    def read_import(content):
+        """
+        Parses an import.yaml, the document can be kept and resolved for any instance later
+        """
+        return yaml.safe_load(content)
+
+    @staticmethod
+    def resolve_import(document, instance: str = None) -> dict:
+        """
+        Applies the override for our instance to a parsed import.yaml, it doesn't touch a repo
+        so it can be run from a worker thread. The document is left as it was, so it can be resolved again
+        """
         r_yaml = dict()
-        r_yaml.update(yaml.safe_load(import_yaml.decoded_content))
+        r_yaml.update(document)
 
         if "instance" in r_yaml.keys():
 
             if instance in r_yaml["instance"].keys():
 
-                override = r_yaml["instance"].pop(instance)
+                instances = dict(r_yaml["instance"])
+                override = dict(instances.pop(instance))
+                r_yaml["instance"] = instances
 
                 # this drops the repo into the default org of the calling instance
                 if "orgName" not in override.keys():
@@ -322,12 +423,18 @@ class Repo(BaseModel):
 
                 r_yaml.update(override)
 
-        self.import_sha = import_yaml.sha
+        return r_yaml
+
+    def apply_import(self, r_yaml: dict, sha: str):
+        self.import_sha = sha
 
         # print(r_url)
         if "orgName" in r_yaml.keys():
             self.org = r_yaml["orgName"]
 
+        # the file is the source of truth for tags, so a changed one replaces them rather than adding to them
+        self.tags = list()
+
         if "tags" in r_yaml.keys():
             for k, v in r_yaml["tags"].items():
                 tmp_tag = {"key": k, "value": v}
@@ -336,6 +443,12 @@ class Repo(BaseModel):
         if "branches" in r_yaml.keys():
             self.branches = r_yaml["branches"]
 
+    def needs_fork_scan(self) -> bool:
+        """
+        A fork only has to be checked for an import.yaml if it has been pushed to since the last check
+        """
+        return self.pushed_at == "" or self.fork_scanned_at != self.pushed_at
+
     def is_older(self, timestamp) -> bool:
 
         remote_ts = datetime.strptime(str(timestamp), "%Y-%m-%d %H:%M:%S")
@@ -1,21 +1,33 @@
 import json
 from datetime import datetime
+from datetime import timedelta
 from pathlib import Path
-from typing import Any
+from typing import TYPE_CHECKING
 from typing import Dict
+from typing import Iterable
 from typing import List
 from typing import Optional
 
-from github import Repository
 from pydantic import UUID4
 from pydantic import BaseModel
+from pydantic import PrivateAttr
 from pydantic import error_wrappers
+from sqlite_cache import SQLiteCache
 
 from .repositories import Branch
 from .repositories import Project
 from .repositories import Repo
 
 
+if TYPE_CHECKING:
+    from github import Repository
+
+
+# version of data.json, recorded in sync.json when they're saved together. data.json in this version holds the
+# json() of validated repos, so it's loaded back without validation, any change to the Repo fields needs this bumped
+WATCHLIST_CACHE_SCHEMA = 1
+
+
 class Settings(BaseModel):
     conf: Optional[Path]
     cache_dir: Optional[Path]
@@ -31,11 +43,28 @@ class Settings(BaseModel):
     snyk_group: Optional[UUID4]
     snyk_token: Optional[UUID4]
     github_token: Optional[str]
+    github_app: Optional[dict]
     github_orgs: List[str] = list()
     cache_timeout: Optional[float]
     instance: Optional[str]
     forks: bool = False
     force_sync: bool = False
+    workers: int = 10
+    cache_backend: str = "json"
+    incremental: bool = False
+    full_sync_interval: float = 24
+    crawl_engine: str = "rest"
+    http_cache: bool = True
+    snyk_rate_limit: int = 1500
+
+    def github_tokens(self) -> List[str]:
+        """
+        github_token can hold several comma separated tokens, which sync spreads its GitHub requests over
+        """
+        if self.github_token is None:
+            return list()
+
+        return [t.strip() for t in str(self.github_token).split(",") if t.strip() != ""]
 
     def __getitem__(self, item):
         return getattr(self, item)
@@ -48,6 +77,28 @@ class SnykWatchList(BaseModel):
     repos: List[Repo] = []
     default_org: str = ""
     snyk_orgs: dict = {}
+    # newest updated_at seen per github org, and when we last crawled every repo, both kept in sync.json
+    watermarks: Dict[str, str] = dict()
+    last_full_sync: str = ""
+    # repo id -> Repo, kept in step with self.repos so lookups don't scan the list
+    _repo_index: Dict[int, Repo] = PrivateAttr(default_factory=dict)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self.reindex()
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+
+        if name == "repos":
+            self.reindex()
+
+    def reindex(self):
+        self._repo_index = dict()
+
+        for repo in self.repos:
+            # the first repo with a given id wins, same as the old list filter
+            self._repo_index.setdefault(repo.id, repo)
 
     def match(self, **kwargs):
         data = []
@@ -58,33 +109,43 @@ class SnykWatchList(BaseModel):
 
         return data
 
-    def get_repo(self, id) -> Repo:
+    def get_repo(self, id) -> Optional[Repo]:
 
-        if self.has_repo(id):
-            filter_repo = [r for r in self.repos if r.id == id]
-
-            return filter_repo[0]
-        else:
-            return None
+        return self._repo_index.get(id)
 
     def has_repo(self, id) -> bool:
 
-        filter_repo = [r for r in self.repos if r.id == id]
+        return id in self._repo_index
 
-        return bool(len(filter_repo))
+    def save(self, cachedir, backend: str = "json"):
+        if backend == "sqlite":
+            json_repos = [json.loads(r.json(by_alias=False)) for r in self.repos]
 
-    def save(self, cachedir):
-        json_repos = [json.loads(r.json(by_alias=False)) for r in self.repos]
+            with SQLiteCache(cachedir) as cache:
+                cache.save_repos(json_repos)
+        else:
+            # one repo per line, written as we go rather than building the whole document first,
+            # which is still a plain JSON array but one that utils.jstream can read back a repo at a time
+            with open(f"{cachedir}/data.json", "w") as the_file:
+                the_file.write("[")
 
-        with open(f"{cachedir}/data.json", "w") as the_file:
-            json.dump(json_repos, the_file, indent=4)
+                for i, r in enumerate(self.repos):
+                    the_file.write("\n" if i == 0 else ",\n")
+                    the_file.write(r.json(by_alias=False))
+
+                the_file.write("\n]\n")
 
         with open(f"{cachedir}/sync.json", "w") as the_file:
-            state = {"last_sync": datetime.isoformat(datetime.utcnow())}
+            state = {
+                "last_sync": datetime.isoformat(datetime.utcnow()),
+                "last_full_sync": self.last_full_sync,
+                "watermarks": self.watermarks,
+                "schema": WATCHLIST_CACHE_SCHEMA,
+            }
 
             json.dump(state, the_file, indent=4)
 
-    def add_repo(self, repo: Repository.Repository):
+    def add_repo(self, repo: "Repository.Repository"):
         tmp_repo = {
             "fork": repo.fork,
             "name": repo.name,
@@ -106,14 +167,19 @@ class SnykWatchList(BaseModel):
 
         archived = bool(raw_repo["archived"])
 
+        # empty repos have never been pushed to
+        pushed_at = str(repo.pushed_at) if repo.pushed_at is not None else ""
+
         if len(topics) > 0:
             org_name = self.get_org_from_topics(topics)
         else:
             org_name = "default"
 
-        if self.has_repo(repo.id):
+        existing_repo = self.get_repo(repo.id)
+
+        if existing_repo is not None:
 
-            existing_repo = self.get_repo(repo.id)
+            existing_repo.pushed_at = pushed_at
 
             if existing_repo.is_older(repo.updated_at):
 
@@ -149,9 +215,11 @@ class SnykWatchList(BaseModel):
                     org=org_name,
                     branches=branches,
                     updated_at=str(repo.updated_at),
+                    pushed_at=pushed_at,
                     full_name=str(repo.full_name),
                 )
                 self.repos.append(tmp_target)
+                self._repo_index[tmp_target.id] = tmp_target
             except error_wrappers.ValidationError as e:
                 # we just want to skip repos we can't validate
                 pass
@@ -160,26 +228,25 @@ class SnykWatchList(BaseModel):
 
         pass
 
-    def get_proj_tag_updates(self, org_ids: list) -> List[Branch]:
+    def get_proj_tag_updates(self, org_ids: list, repos: Optional[Iterable[Repo]] = None) -> List[Branch]:
+        """
+        Returns the projects in org_ids that are missing tags, from self.repos or the repos given,
+        which can be a generator so the repos are looked at as they are loaded
+        """
+        if repos is None:
+            repos = self.repos
 
-        has_tags = [r for r in self.repos if r.has_tags()]
+        has_tags = (r for r in repos if r.has_tags())
 
         needs_tags = list()
 
-        repo_branches: List[Dict[Any, Any]] = list()
-
+        # only the projects missing tags are kept, not the repos they came from
         for repo in has_tags:
             branches = repo.get_reimport(self.default_org, self.snyk_orgs)
 
             in_group = [b for b in branches if b.org_id in org_ids]
 
-            if in_group:
-                repo_branch = {"repo": repo, "branches": in_group}
-                repo_branches.append(repo_branch)
-
-        for repo in repo_branches:
-
-            for branch in repo["branches"]:
+            for branch in in_group:
 
                 for project in branch.projects:
 
@@ -220,6 +287,34 @@ class SnykWatchList(BaseModel):
 
         return org
 
+    def needs_full_crawl(self, gh_org: str, interval: float) -> bool:
+        """
+        An org can only be crawled incrementally if we have a watermark for it and the last full crawl,
+        which is what catches deleted repos, is less than interval hours old
+        """
+        if gh_org not in self.watermarks or self.last_full_sync == "":
+            return True
+
+        last_full = datetime.strptime(self.last_full_sync, "%Y-%m-%dT%H:%M:%S.%f")
+
+        return last_full < datetime.utcnow() - timedelta(hours=interval)
+
+    def update_watermark(self, gh_org: str, updated_at: str):
+        if updated_at > self.watermarks.get(gh_org, ""):
+            self.watermarks[gh_org] = updated_at
+
     # removes repositories that don't exist in github anymore
-    def prune(self, repo_ids: list):
-        self.repos = [r for r in self.repos if r.id in repo_ids]
+    def prune(self, repo_ids: list, gh_orgs: Optional[List[str]] = None):
+        """
+        Drops the repos that aren't in repo_ids, with gh_orgs only the repos owned by those github orgs are
+        looked at, for when only some of the orgs were crawled in full
+        """
+        keep_ids = set(repo_ids)
+
+        if gh_orgs is None:
+            self.repos = [r for r in self.repos if r.id in keep_ids]
+        else:
+            # github logins are case insensitive, the config may not use the same case github does
+            pruned_orgs = {o.lower() for o in gh_orgs}
+
+            self.repos = [r for r in self.repos if r.id in keep_ids or r.source.owner.lower() not in pruned_orgs]
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import os
+import shutil
+from typing import TYPE_CHECKING
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+
+# the cli imports this module at startup, the models are only needed once a plan is saved
+if TYPE_CHECKING:
+    from models.repositories import Repo
+
+
+# version of the plan files, a plan in any other version is ignored and targets / tags work it out again
+PLAN_SCHEMA = 1
+
+PLAN_KINDS = ["targets", "tags"]
+
+
+def plan_fingerprint(default_org: str, snyk_orgs: dict, groups: List[dict]) -> str:
+    """
+    Identifies the configuration a plan was worked out for, the groups are reduced to their names and ids
+    since by the time we're called they also hold their tokens
+    """
+    config = {
+        "default_org": default_org,
+        "snyk_orgs": snyk_orgs,
+        "groups": [{"id": str(g["id"]), "name": g["name"]} for g in groups],
+    }
+
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def plan_targets(repo: "Repo", default_org: str, snyk_orgs: dict) -> Iterator[dict]:
+    """
+    Yields a record for each of the repo's branches that has no projects, these are what targets outputs
+    when it isn't forcing a refresh, with what's needed to apply its filters without the repo
+    """
+    for branch in repo.get_reimport(default_org, snyk_orgs):
+        if branch.project_count() == 0:
+            source = repo.source.get_target()
+
+            source["branch"] = branch.name
+
+            yield {
+                "target": source,
+                "org_id": branch.org_id,
+                "integrations": branch.integrations,
+                "archived": repo.archived is True,
+                "has_import": repo.import_sha != "",
+            }
+
+
+def save_plans(cache_dir, repos: Iterable["Repo"], default_org: str, snyk_orgs: dict, groups: List[dict], org_groups):
+    """
+    Writes the branches needing an import and the projects needing tags, per group, to cache/plan, so
+    targets and tags can read just the slice they output instead of working it out across every repo
+    org_groups maps an org id to the id of its group, repos in orgs outside every group are left out
+    The plan is tied to the sync.json written by the same sync and the configuration it was worked out for
+    """
+    from models.sync import SnykWatchList
+
+    plan_dir = f"{cache_dir}/plan"
+    tmp_dir = f"{plan_dir}.tmp"
+
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    for kind in PLAN_KINDS:
+        os.makedirs(f"{tmp_dir}/{kind}")
+
+    plan_files = {
+        (kind, str(g["id"])): open(f"{tmp_dir}/{kind}/{g['id']}.ndjson", "w") for kind in PLAN_KINDS for g in groups
+    }
+
+    tagger = SnykWatchList(default_org=default_org, snyk_orgs=snyk_orgs)
+
+    try:
+        for repo in repos:
+            for record in plan_targets(repo, default_org, snyk_orgs):
+                group_id = org_groups.get(str(record["org_id"]))
+
+                if group_id is not None:
+                    plan_files[("targets", group_id)].write(json.dumps(record, separators=(",", ":")) + "\n")
+
+            if repo.has_tags():
+                for fix_project in tagger.get_proj_tag_updates(org_groups.keys(), [repo]):
+                    group_id = org_groups[fix_project["org_id"]]
+                    plan_files[("tags", group_id)].write(json.dumps(fix_project, separators=(",", ":")) + "\n")
+    finally:
+        for plan_file in plan_files.values():
+            plan_file.close()
+
+    with open(f"{cache_dir}/sync.json", "r") as sync_file:
+        last_sync = json.load(sync_file)["last_sync"]
+
+    header = {
+        "schema": PLAN_SCHEMA,
+        "last_sync": last_sync,
+        "fingerprint": plan_fingerprint(default_org, snyk_orgs, groups),
+    }
+
+    with open(f"{tmp_dir}/plan.json", "w") as header_file:
+        json.dump(header, header_file, indent=4)
+
+    # swap the whole directory in, so a plan is never half written
+    shutil.rmtree(plan_dir, ignore_errors=True)
+    os.replace(tmp_dir, plan_dir)
+
+
+def load_plan(cache_dir, fingerprint: str) -> Optional[Dict]:
+    """
+    Returns the plan's header if there is a plan for the current cache and configuration, otherwise None
+    """
+    plan_dir = f"{cache_dir}/plan"
+
+    if not os.path.isfile(f"{plan_dir}/plan.json") or not os.path.isfile(f"{cache_dir}/sync.json"):
+        return None
+
+    with open(f"{plan_dir}/plan.json", "r") as header_file:
+        header = json.load(header_file)
+
+    with open(f"{cache_dir}/sync.json", "r") as sync_file:
+        last_sync = json.load(sync_file)["last_sync"]
+
+    if header.get("schema") != PLAN_SCHEMA or header.get("fingerprint") != fingerprint:
+        return None
+
+    # a sync that was stopped after saving the cache but before writing the plan
+    if header.get("last_sync") != last_sync:
+        return None
+
+    return header
+
+
+def iter_plan(cache_dir, kind: str, group_id) -> Iterator[Dict]:
+    """
+    Yields the records of one group's slice of the plan
+    """
+    path = f"{cache_dir}/plan/{kind}/{group_id}.ndjson"
+
+    if not os.path.isfile(path):
+        return
+
+    with open(path, "r") as plan_file:
+        for line in plan_file:
+            yield json.loads(line)
@@ -0,0 +1,540 @@
+import base64
+import json
+import sqlite3
+import threading
+import time
+from datetime import date
+from datetime import datetime
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+
+# stored in the database's user_version once it has been written by the current models, a database in this
+# version holds the json() of validated models and is loaded back without validation
+CACHE_SCHEMA = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repos (
+    id INTEGER PRIMARY KEY,
+    full_name TEXT NOT NULL,
+    archived INTEGER NOT NULL,
+    fork INTEGER NOT NULL,
+    import_sha TEXT NOT NULL,
+    has_tags INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS repos_archived ON repos (archived);
+CREATE INDEX IF NOT EXISTS repos_has_tags ON repos (has_tags);
+
+CREATE TABLE IF NOT EXISTS orgs (
+    id TEXT PRIMARY KEY,
+    slug TEXT NOT NULL,
+    group_id TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    integrations TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orgs_group_id ON orgs (group_id);
+
+CREATE TABLE IF NOT EXISTS targets (
+    id TEXT PRIMARY KEY,
+    org_id TEXT NOT NULL,
+    repo_id TEXT,
+    name TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS targets_org_id ON targets (org_id);
+CREATE INDEX IF NOT EXISTS targets_repo_id ON targets (repo_id);
+CREATE INDEX IF NOT EXISTS targets_name ON targets (name);
+
+CREATE TABLE IF NOT EXISTS projects (
+    id TEXT PRIMARY KEY,
+    org_id TEXT NOT NULL,
+    target_id TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS projects_org_id ON projects (org_id);
+CREATE INDEX IF NOT EXISTS projects_target_id ON projects (target_id);
+
+CREATE TABLE IF NOT EXISTS tags (
+    project_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tags_project_id ON tags (project_id);
+
+CREATE TABLE IF NOT EXISTS saved (
+    kind TEXT PRIMARY KEY
+);
+"""
+
+
+class SQLiteCache:
+    """
+    SQLite backed store for the watchlist and the Snyk org data, as an alternative to data.json and the per
+    org files. Everything goes in and out as the same dicts the json cache uses, the models do the parsing
+
+    Each save is a single transaction, so a sync that dies part way through leaves the previous cache intact
+    """
+
+    def __init__(self, cache_dir):
+        self.path = f"{cache_dir}/cache.sqlite"
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _keep_ids(self, ids: List) -> str:
+        """
+        Loads a temp table with the ids we just wrote, so stale rows can be deleted without a huge IN (...)
+        """
+        self.conn.execute("CREATE TEMP TABLE IF NOT EXISTS keep_ids (id PRIMARY KEY)")
+        self.conn.execute("DELETE FROM keep_ids")
+        self.conn.executemany("INSERT OR IGNORE INTO keep_ids (id) VALUES (?)", [(i,) for i in ids])
+
+        return "SELECT id FROM keep_ids"
+
+    def is_current(self) -> bool:
+        return self.conn.execute("PRAGMA user_version").fetchone()[0] == CACHE_SCHEMA
+
+    def _mark_current(self):
+        self.conn.execute(f"PRAGMA user_version = {CACHE_SCHEMA}")
+
+    def _mark_saved(self, kind: str):
+        self.conn.execute("INSERT OR IGNORE INTO saved (kind) VALUES (?)", (kind,))
+
+    def _has_saved(self, kind: str) -> bool:
+        """
+        Whether kind was ever saved here, an empty table after a save means there's nothing, not a new database
+        Databases from before saves were recorded count as saved once they have rows
+        """
+        if self.conn.execute("SELECT 1 FROM saved WHERE kind = ?", (kind,)).fetchone() is not None:
+            return True
+
+        return self.conn.execute(f"SELECT 1 FROM {kind} LIMIT 1").fetchone() is not None
+
+    def has_saved_repos(self) -> bool:
+        return self._has_saved("repos")
+
+    def has_saved_orgs(self) -> bool:
+        return self._has_saved("orgs")
+
+    def save_repos(self, repos: List[Dict]):
+        """
+        Upserts every repo and removes the ones that are no longer in the watchlist
+        """
+        with self.conn:
+            self.conn.executemany(
+                """
+                INSERT INTO repos (id, full_name, archived, fork, import_sha, has_tags, data)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    full_name = excluded.full_name,
+                    archived = excluded.archived,
+                    fork = excluded.fork,
+                    import_sha = excluded.import_sha,
+                    has_tags = excluded.has_tags,
+                    data = excluded.data
+                """,
+                [
+                    (
+                        r["id"],
+                        r["full_name"],
+                        int(bool(r["archived"])),
+                        int(bool(r["fork"])),
+                        r["import_sha"],
+                        int(len(r["tags"]) > 0),
+                        json.dumps(r, separators=(",", ":")),
+                    )
+                    for r in repos
+                ],
+            )
+
+            keep = self._keep_ids([r["id"] for r in repos])
+
+            self.conn.execute(f"DELETE FROM repos WHERE id NOT IN ({keep})")
+
+            self._mark_saved("repos")
+            self._mark_current()
+
+    def load_repos(
+        self, include_archived: bool = True, require_import: bool = False, require_tags: bool = False
+    ) -> Iterator[Dict]:
+        """
+        Yields the repos matching the filters, the filtering happens in the query
+        """
+        query = "SELECT data FROM repos WHERE 1 = 1"
+
+        if not include_archived:
+            query += " AND archived = 0"
+
+        if require_import:
+            query += " AND import_sha != ''"
+
+        if require_tags:
+            query += " AND has_tags = 1"
+
+        for (data,) in self.conn.execute(f"{query} ORDER BY rowid"):
+            yield json.loads(data)
+
+    def save_org(self, metadata: Dict, integrations: Dict, targets: List[Dict], projects: List[Dict]):
+        """
+        Upserts an org with its targets, projects and their tags, and removes targets / projects of this org
+        that weren't in this refresh
+        """
+        org_id = metadata["id"]
+
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO orgs (id, slug, group_id, metadata, integrations) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    slug = excluded.slug,
+                    group_id = excluded.group_id,
+                    metadata = excluded.metadata,
+                    integrations = excluded.integrations
+                """,
+                (org_id, metadata["slug"], metadata["group_id"], json.dumps(metadata), json.dumps(integrations)),
+            )
+
+            self.conn.executemany(
+                """
+                INSERT INTO targets (id, org_id, repo_id, name, data) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    org_id = excluded.org_id,
+                    repo_id = excluded.repo_id,
+                    name = excluded.name,
+                    data = excluded.data
+                """,
+                [
+                    (
+                        t["id"],
+                        org_id,
+                        t["repo_id"],
+                        str(t["name"]).lower(),
+                        json.dumps(t, separators=(",", ":")),
+                    )
+                    for t in targets
+                ],
+            )
+
+            keep = self._keep_ids([t["id"] for t in targets])
+
+            self.conn.execute(f"DELETE FROM targets WHERE org_id = ? AND id NOT IN ({keep})", (org_id,))
+
+            # tags are rewritten wholesale for the org's projects, this also clears them off stale projects
+            self.conn.execute(
+                "DELETE FROM tags WHERE project_id IN (SELECT id FROM projects WHERE org_id = ?)", (org_id,)
+            )
+
+            project_rows = list()
+            tag_rows = list()
+
+            for p in projects:
+                p = dict(p)
+                for tag in p.pop("tags"):
+                    tag_rows.append((p["id"], tag["key"], tag["value"]))
+
+                project_rows.append((p["id"], org_id, str(p["target"]).lower(), json.dumps(p, separators=(",", ":"))))
+
+            self.conn.executemany(
+                """
+                INSERT INTO projects (id, org_id, target_id, data) VALUES (?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    org_id = excluded.org_id,
+                    target_id = excluded.target_id,
+                    data = excluded.data
+                """,
+                project_rows,
+            )
+
+            keep = self._keep_ids([p["id"] for p in projects])
+
+            self.conn.execute(f"DELETE FROM projects WHERE org_id = ? AND id NOT IN ({keep})", (org_id,))
+
+            self.conn.executemany("INSERT INTO tags (project_id, key, value) VALUES (?, ?, ?)", tag_rows)
+
+            self._mark_saved("orgs")
+            self._mark_current()
+
+    def load_orgs(
+        self, group_ids: Optional[List[str]] = None, with_projects: bool = True
+    ) -> Iterator[Tuple[Dict, Dict, List[Dict], List[Dict]]]:
+        """
+        Yields (metadata, integrations, targets, projects) for each org, optionally only for some groups
+        With with_projects False only the orgs table is read and targets / projects come back empty
+        """
+        query = "SELECT id, metadata, integrations FROM orgs"
+        params: Tuple = tuple()
+
+        if group_ids is not None:
+            query += f" WHERE group_id IN ({', '.join('?' for _ in group_ids)})"
+            params = tuple(str(g) for g in group_ids)
+
+        for org_id, metadata, integrations in self.conn.execute(query, params).fetchall():
+            targets: List[Dict] = list()
+            projects: List[Dict] = list()
+
+            if with_projects:
+                targets = [
+                    json.loads(data)
+                    for (data,) in self.conn.execute(
+                        "SELECT data FROM targets WHERE org_id = ? ORDER BY rowid", (org_id,)
+                    )
+                ]
+
+                tags: Dict[str, List[Dict]] = dict()
+
+                for project_id, key, value in self.conn.execute(
+                    "SELECT tags.project_id, tags.key, tags.value FROM tags "
+                    "JOIN projects ON projects.id = tags.project_id WHERE projects.org_id = ? ORDER BY tags.rowid",
+                    (org_id,),
+                ):
+                    tags.setdefault(project_id, list()).append({"key": key, "value": value})
+
+                for (data,) in self.conn.execute(
+                    "SELECT data FROM projects WHERE org_id = ? ORDER BY rowid", (org_id,)
+                ):
+                    project = json.loads(data)
+                    project["tags"] = tags.get(project["id"], list())
+                    projects.append(project)
+
+            yield json.loads(metadata), json.loads(integrations), targets, projects
+
+
+# stored in http.sqlite's user_version, a file in any other version is thrown away as it's only a cache
+HTTP_CACHE_SCHEMA = 1
+
+HTTP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    headers TEXT NOT NULL,
+    body TEXT NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at);
+"""
+
+# responses nothing has asked for in this long are dropped, like those of repos that have since been deleted
+HTTP_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+# past this many bytes of bodies the least recently used responses are dropped
+HTTP_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+class HTTPCache:
+    """
+    Keeps the last response for each GitHub GET with its ETag / Last-Modified, so it can be replayed as a
+    conditional request. Lives in its own file as it's shared by every worker thread, hence the lock
+
+    Every time a response is stored or replayed it's marked as used, and when the cache is opened the
+    responses that are too old, or that push it over max_bytes, are evicted
+    """
+
+    def __init__(self, cache_dir, max_age: float = HTTP_CACHE_MAX_AGE, max_bytes: int = HTTP_CACHE_MAX_BYTES):
+        self.path = f"{cache_dir}/http.sqlite"
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != HTTP_CACHE_SCHEMA:
+            self.conn.execute("DROP TABLE IF EXISTS responses")
+            self.conn.execute(f"PRAGMA user_version = {HTTP_CACHE_SCHEMA}")
+
+        self.conn.executescript(HTTP_SCHEMA)
+
+        self.evict(max_age, max_bytes)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def evict(self, max_age: float, max_bytes: int):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM responses WHERE used_at < ?", (time.time() - max_age,))
+
+            # running total of the body sizes, newest first, everything after it passes max_bytes goes
+            self.conn.execute(
+                """
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(LENGTH(body)) OVER (ORDER BY used_at DESC, key) AS total FROM responses
+                    ) WHERE total > ?
+                )
+                """,
+                (max_bytes,),
+            )
+
+    def get(self, key: str) -> Optional[Tuple[Optional[str], Optional[str], Dict, str]]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, headers, body FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        etag, last_modified, headers, body = row
+
+        return etag, last_modified, json.loads(headers), body
+
+    def put(self, key: str, etag: Optional[str], last_modified: Optional[str], headers: Dict, body: str):
+        with self.lock, self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO responses (key, etag, last_modified, headers, body, used_at) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    etag = excluded.etag,
+                    last_modified = excluded.last_modified,
+                    headers = excluded.headers,
+                    body = excluded.body,
+                    used_at = excluded.used_at
+                """,
+                (key, etag, last_modified, json.dumps(headers), body, time.time()),
+            )
+
+    def touch(self, key: str):
+        """
+        Marks a response as used, for when it's replayed after a 304
+        """
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE responses SET used_at = ? WHERE key = ?", (time.time(), key))
+
+
+# stored in imports.sqlite's user_version, a file in any other version is thrown away as it's only a cache
+IMPORT_CACHE_SCHEMA = 3
+
+IMPORT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS imports (
+    sha TEXT PRIMARY KEY,
+    document TEXT NOT NULL
+);
+"""
+
+# yaml types json has no place for are stored as {"!yaml": <type>, "value": ...}, so a document comes back
+# exactly as yaml.safe_load returned it, dates, integer keys and all
+YAML_TYPE = "!yaml"
+
+
+def dump_yaml_value(value: Any) -> Any:
+    """
+    Turns a document read by yaml.safe_load into one json can hold without changing any of its types
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+
+    if isinstance(value, list):
+        return [dump_yaml_value(v) for v in value]
+
+    if isinstance(value, dict):
+        if YAML_TYPE not in value and all(isinstance(k, str) for k in value):
+            return {k: dump_yaml_value(v) for k, v in value.items()}
+
+        return {YAML_TYPE: "map", "value": [[dump_yaml_value(k), dump_yaml_value(v)] for k, v in value.items()]}
+
+    # a datetime is also a date
+    if isinstance(value, datetime):
+        return {YAML_TYPE: "timestamp", "value": value.isoformat()}
+
+    if isinstance(value, date):
+        return {YAML_TYPE: "date", "value": value.isoformat()}
+
+    if isinstance(value, bytes):
+        return {YAML_TYPE: "binary", "value": base64.b64encode(value).decode()}
+
+    if isinstance(value, set):
+        return {YAML_TYPE: "set", "value": [dump_yaml_value(v) for v in value]}
+
+    raise TypeError(f"Unable to store {type(value).__name__} from a yaml document")
+
+
+def load_yaml_value(value: Any) -> Any:
+    """
+    The reverse of dump_yaml_value
+    """
+    if isinstance(value, list):
+        return [load_yaml_value(v) for v in value]
+
+    if not isinstance(value, dict):
+        return value
+
+    if YAML_TYPE not in value:
+        return {k: load_yaml_value(v) for k, v in value.items()}
+
+    kind = value[YAML_TYPE]
+
+    if kind == "map":
+        return {load_yaml_value(k): load_yaml_value(v) for k, v in value["value"]}
+
+    if kind == "timestamp":
+        return datetime.fromisoformat(value["value"])
+
+    if kind == "date":
+        return date.fromisoformat(value["value"])
+
+    if kind == "binary":
+        return base64.b64decode(value["value"])
+
+    if kind == "set":
+        return {load_yaml_value(v) for v in value["value"]}
+
+    raise ValueError(f"Unknown yaml type in the import cache: {kind}")
+
+
+class ImportCache:
+    """
+    Keeps every import.yaml we've downloaded, as parsed, by its git blob SHA. A blob never changes, so a SHA
+    that's in here is never downloaded or parsed again, however many repos share it. The parsed document is
+    stored with its yaml types, so it goes through Repo.resolve_import exactly like one that was just parsed
+    Shared by every worker thread, hence the lock
+    """
+
+    def __init__(self, cache_dir):
+        self.path = f"{cache_dir}/imports.sqlite"
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != IMPORT_CACHE_SCHEMA:
+            self.conn.execute("DROP TABLE IF EXISTS imports")
+            self.conn.execute(f"PRAGMA user_version = {IMPORT_CACHE_SCHEMA}")
+
+        self.conn.executescript(IMPORT_SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def get(self, sha: str) -> Optional[Any]:
+        """
+        The parsed document of a blob, None when it isn't cached
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT document FROM imports WHERE sha = ?", (sha,)).fetchone()
+
+        if row is None:
+            return None
+
+        return load_yaml_value(json.loads(row[0]))
+
+    def put(self, sha: str, document: Any):
+        """
+        Stores the parsed document of a blob, an empty document isn't stored as it couldn't be told from a miss
+        """
+        if document is None:
+            return
+
+        dumped = json.dumps(dump_yaml_value(document), separators=(",", ":"))
+
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO imports (sha, document) VALUES (?, ?)", (sha, dumped))
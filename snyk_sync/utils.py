@@ -1,29 +1,48 @@
+import copy
+import glob
 import json
+import os
+import re
 from datetime import datetime
 from logging import exception
 from os import environ
 from os import path
 from pathlib import Path
+from typing import TYPE_CHECKING
 from typing import Any
 from typing import Callable
 from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
 from typing import Optional
+from typing import TextIO
+from typing import Tuple
 from typing import Union
 from typing import cast
 
-import requests
-import yaml
-from github import Github
-from models.sync import Repo
-from models.sync import Settings
-from models.sync import SnykWatchList
-from retry.api import retry_call
 from typer import Context
 
 
+# yaml, the models (pydantic) and the sqlite cache are imported where they are used, as the cli imports this module
+# for its option callbacks and --help shouldn't pay for them
+if TYPE_CHECKING:
+    from github import Github
+    from models.sync import Repo
+    from models.sync import Settings
+    from models.sync import SnykWatchList
+    from sqlite_cache import SQLiteCache
+
+
 V3_VERS = "2021-08-20~beta"
 USER_AGENT = "pysnyk/snyk_services/snyk_sync"
 
+# what can follow a number, true, false or null in an array, see jstream
+_scalar_end = re.compile(r"[\s,\]]")
+
+# parsed yaml files by path and modification time, see yopen
+_yaml_cache: Dict[Tuple[str, int], Any] = dict()
+
 
 def jprint(something):
     print(json.dumps(something, indent=2))
@@ -35,6 +54,59 @@ def jopen(filename):
     return json.loads(data)
 
 
+def jstream(filename, chunk_size: int = 65536) -> Iterator[Any]:
+    """
+    Yields the items of the JSON array in filename one at a time, reading the file in chunks
+    so that only the item being decoded is held in memory, not the whole document
+    """
+    decoder = json.JSONDecoder()
+
+    with open(filename, "r") as the_file:
+        buffer = ""
+        pos = 0
+        eof = False
+        started = False
+
+        while True:
+            # skip the whitespace and separators between items
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+
+            if pos < len(buffer):
+                if not started:
+                    if buffer[pos] != "[":
+                        raise ValueError(f"{filename} does not contain a JSON array")
+                    started = True
+                    pos += 1
+                    continue
+
+                if buffer[pos] == "]":
+                    return
+
+                # objects, arrays and strings only decode once their closing character is in the buffer, but a
+                # number decodes from whatever digits have been read so far, so it waits for what comes after it
+                complete = eof or buffer[pos] in '{["' or _scalar_end.search(buffer, pos) is not None
+
+                if complete:
+                    try:
+                        item, end = decoder.raw_decode(buffer, pos)
+                    except json.JSONDecodeError:
+                        # cut short by the end of the buffer, unless there's nothing left to read
+                        if eof:
+                            raise
+                    else:
+                        yield item
+                        pos = end
+                        continue
+            elif eof:
+                raise ValueError(f"{filename} ended before its JSON array was closed")
+
+            chunk = the_file.read(chunk_size)
+            eof = chunk == ""
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+
 def jwrite(data, filename, minimize: bool = False):
     try:
         with open(filename, "w") as the_file:
@@ -48,9 +120,22 @@ def jwrite(data, filename, minimize: bool = False):
 
 
 def yopen(filename):
-    with open(filename, "r") as the_file:
-        data = the_file.read()
-    return yaml.safe_load(data)
+    """
+    Parses a yaml file, once per process: snyk-sync.yaml is looked at by every option's callback, so the parsed
+    file is kept until it changes on disk. Callers get their own copy, as they're free to modify it
+    """
+    key = (str(Path(filename).resolve()), Path(filename).stat().st_mtime_ns)
+
+    if key not in _yaml_cache:
+        import yaml
+
+        with open(filename, "r") as the_file:
+            data = the_file.read()
+
+        # the C loader, when PyYAML was built with it, parses the large generated snyk-orgs.yaml much faster
+        _yaml_cache[key] = yaml.load(data, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+    return copy.deepcopy(_yaml_cache[key])
 
 
 def newer(cached: str, remote: str) -> bool:
@@ -64,8 +149,101 @@ def newer(cached: str, remote: str) -> bool:
     return bool(remote_ts < cache_ts)
 
 
+class TargetWriter:
+    """
+    Writes a group's targets to disk as they're generated, so the group never has to be held in memory whole
+    Without a batch size they go to <name>.json, with one they're sharded into <name>-0001.json, <name>-0002.json...
+    of batch_size targets each, which snyk-api-import can work through in parallel and rerun one at a time
+    With ndjson each target is a line of <name>.ndjson / <name>-0001.ndjson instead
+    """
+
+    # files with more targets than this are written compact, the same as targets always has
+    INDENT_LIMIT = 50
+
+    def __init__(self, targets_dir, name: str, batch_size: int = 0, ndjson: bool = False):
+        self.prefix = f"{targets_dir}/{name}"
+        self.batch_size = batch_size
+        self.ndjson = ndjson
+        # targets not written yet, a file is only indented if it turns out to be small enough
+        self.pending: List[dict] = list()
+        self.file: Optional[TextIO] = None
+        self.in_file = 0
+        self.written: List[str] = list()
+
+        # shards from an earlier run would otherwise be picked up along with this run's
+        for ext in ["json", "ndjson"]:
+            for stale in glob.glob(f"{glob.escape(self.prefix)}-[0-9][0-9][0-9][0-9].{ext}"):
+                os.remove(stale)
+
+    def path(self) -> str:
+        ext = "ndjson" if self.ndjson else "json"
+
+        if self.batch_size > 0:
+            return f"{self.prefix}-{len(self.written) + 1:04d}.{ext}"
+
+        return f"{self.prefix}.{ext}"
+
+    def stream(self) -> TextIO:
+        if self.file is None:
+            self.file = open(f"{self.path()}.tmp", "w")
+
+        return self.file
+
+    def add(self, target: dict):
+        compact = (",", ":")
+
+        if self.ndjson:
+            self.stream().write(json.dumps(target, separators=compact) + "\n")
+        elif self.file is not None:
+            self.file.write("," + json.dumps(target, separators=compact))
+        else:
+            self.pending.append(target)
+
+            if self.batch_size == 0 and len(self.pending) > self.INDENT_LIMIT:
+                # too many to indent, so the rest of the file is written compact as we go
+                self.stream().write('{"targets":[' + ",".join(json.dumps(t, separators=compact) for t in self.pending))
+                self.pending = list()
+
+        self.in_file += 1
+
+        if self.batch_size > 0 and self.in_file >= self.batch_size:
+            self.finish()
+
+    def finish(self):
+        path = self.path()
+
+        if self.ndjson:
+            self.stream()
+
+        if self.file is not None:
+            if not self.ndjson:
+                self.file.write("]}")
+
+            self.file.close()
+            self.file = None
+
+            # written to a temp file first, so a half written file is never picked up
+            os.replace(f"{path}.tmp", path)
+        elif not jwrite({"targets": self.pending}, path, len(self.pending) > self.INDENT_LIMIT):
+            raise Exception(f"Failed to Write {path}")
+
+        self.pending = list()
+        self.in_file = 0
+        self.written.append(path)
+
+    def close(self) -> List[str]:
+        """
+        Writes out what's left and returns the files written, a group without targets still gets its file,
+        unless it's being sharded
+        """
+        if self.in_file > 0 or self.batch_size == 0:
+            self.finish()
+
+        return self.written
+
+
 class RateLimit:
-    def __init__(self, gh: Github):
+    def __init__(self, gh: "Github"):
         self.core_limit = gh.get_rate_limit().core.limit
         self.search_limit = gh.get_rate_limit().search.limit
         # we want to know how many calls had been made before we created this object
@@ -95,6 +273,8 @@ class RateLimit:
 
 
 def make_v3_get(endpoint, token):
+    import requests
+
     V3_API = "https://api.snyk.io/v3"
     USER_AGENT = "pysnyk/snyk_services/target_sync"
 
@@ -107,6 +287,8 @@ def make_v3_get(endpoint, token):
 
 
 def v3_get(endpoint, token, delay=1):
+    from retry.api import retry_call
+
     result = retry_call(make_v3_get, fkwargs={"endpoint": endpoint, "token": token}, tries=3, delay=delay)
     return result
 
@@ -175,7 +357,7 @@ def to_camel_case(snake_str):
 
 def default_settings(
     name: Optional[str], value: str, default: Union[Any, Callable[[], Any], None], context: Context
-) -> Settings:
+) -> "Settings":
     """
     We want a self / auto configuring experience for Snyk Sync, but also allow for options to be passed from ENV, CLI, OR a config file.
     CLI overrides ENV, and typer handles that for us. But we want CLI and ENV to override the config file, so we need to load that value
@@ -189,6 +371,8 @@ def default_settings(
     if context.invoked_subcommand == "autoconf":
         if name == "conf":
             if Path(value).exists is False:
+                import yaml
+
                 new_conf = {"schema": 2}
                 Path(value).write_text(yaml.safe_dump(new_conf))
             elif Path(value).is_dir():
@@ -258,6 +442,10 @@ def default_settings(
 
     if name == "github_token":
 
+        # a GitHub App can stand in for a token
+        if "github_token_env_name" not in s.keys() and "github_app" in s.keys():
+            return default
+
         token_env_name = s["github_token_env_name"]
 
         if token_env_name in environ.keys():
@@ -296,20 +484,92 @@ def ensure_dir(directory: Path) -> bool:
         return True
 
 
-def load_watchlist(cache_dir: Path) -> SnykWatchList:
+def iter_watchlist(
+    cache_dir: Path,
+    backend: str = "json",
+    include_archived: bool = True,
+    require_import: bool = False,
+    require_tags: bool = False,
+) -> Iterator["Repo"]:
+    """
+    Yields the cached repos one at a time, optionally only the ones a command needs
+    With the sqlite backend the filtering is done by the query, with json it is done as data.json is streamed,
+    before a repo is parsed, so filtered out repos never become Repo objects
+    A cache written in the current schema was validated before it was saved and is rehydrated without validation
+    """
+    from models.sync import WATCHLIST_CACHE_SCHEMA
+    from models.sync import Repo
+    from sqlite_cache import SQLiteCache
+
+    cache_data: Iterable[dict] = list()
+
+    cache: Optional[SQLiteCache] = None
+
+    trusted = False
+
+    if backend == "sqlite":
+        cache = SQLiteCache(cache_dir)
+
+        # first run after switching backends, carry on from data.json until the first save, after that
+        # an empty table is an empty watchlist
+        if not cache.has_saved_repos() and path.exists(f"{cache_dir}/data.json"):
+            cache.close()
+            yield from iter_watchlist(cache_dir, "json", include_archived, require_import, require_tags)
+            return
+
+        cache_data = cache.load_repos(include_archived, require_import, require_tags)
+
+        trusted = cache.is_current()
+
+    elif path.exists(f"{cache_dir}/data.json"):
+        cache_data = jstream(f"{cache_dir}/data.json")
+
+        if path.exists(f"{cache_dir}/sync.json"):
+            trusted = jopen(f"{cache_dir}/sync.json").get("schema") == WATCHLIST_CACHE_SCHEMA
+
+    try:
+        for r in cache_data:
+            if not include_archived and r.get("archived") is True:
+                continue
+            if require_import and r.get("import_sha", "") == "":
+                continue
+            if require_tags and len(r.get("tags", [])) == 0:
+                continue
+
+            try:
+                repo = Repo.from_cache(r) if trusted else Repo.parse_obj(r)
+            except Exception as e:
+                exception(f"Error {e} attempting to parse {r}")
+                continue
+
+            yield repo
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+def load_watchlist(
+    cache_dir: Path,
+    backend: str = "json",
+    include_archived: bool = True,
+    require_import: bool = False,
+    require_tags: bool = False,
+) -> "SnykWatchList":
+    """
+    Loads the watchlist from the cache, optionally only the repos a command needs
+    Commands that look at one repo at a time should use iter_watchlist instead, which doesn't hold them all
+    """
+    from models.sync import SnykWatchList
+
     tmp_watchlist = SnykWatchList()
 
-    if path.exists(f"{cache_dir}/data.json"):
-        try:
-            cache_data = jopen(f"{cache_dir}/data.json")
-            for r in cache_data:
-                try:
-                    tmp_watchlist.repos.append(Repo.parse_obj(r))
-                except Exception as e:
-                    exception(f"Error {e} attempting to parse {r}")
+    # assigning the list in one go builds the id index once
+    tmp_watchlist.repos = list(iter_watchlist(cache_dir, backend, include_archived, require_import, require_tags))
 
-        except KeyError as e:
-            print(e)
+    if path.exists(f"{cache_dir}/sync.json"):
+        sync_data = jopen(f"{cache_dir}/sync.json")
+        tmp_watchlist.watermarks = sync_data.get("watermarks", dict())
+        tmp_watchlist.last_full_sync = sync_data.get("last_full_sync", "")
 
     return tmp_watchlist
 
@@ -320,3 +580,14 @@ def update_client(old_client, token):
     old_client.api_post_headers = old_client.api_headers
 
     return old_client
+
+
+def clone_client(old_client, token):
+    """
+    Returns a copy of a SnykClient using a different token, so the original can keep being used elsewhere
+    (update_client changes the client in place, which isn't safe once it's shared between threads)
+    """
+    new_client = copy.copy(old_client)
+    new_client.api_headers = dict(old_client.api_headers)
+
+    return update_client(new_client, token)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+
+# the modules in snyk_sync import each other by name, the same as when cli.py is run from its own directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "snyk_sync"))
@@ -0,0 +1,556 @@
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from types import SimpleNamespace
+
+import api
+import pytest
+import requests
+from api import CachedResponse
+from api import RateBucket
+from api import RateLimit
+from api import RateLimitMixin
+from api import TokenPool
+from api import get_repos_graphql
+from api import graphql_repo
+from api import is_retryable
+from api import snyk_request
+from api import snyk_status
+from snyk.errors import SnykHTTPError
+
+
+def snyk_error(status: int, body: bytes = b'{"message": "error"}') -> SnykHTTPError:
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = body
+
+    return SnykHTTPError(resp)
+
+
+def failing(error: SnykHTTPError):
+    calls = list()
+
+    def func(*args):
+        calls.append(args)
+        raise error
+
+    return func, calls
+
+
+@pytest.mark.parametrize("status", [429, 500, 502, 503])
+def test_retries_rate_limits_and_server_errors(status):
+    func, calls = failing(snyk_error(status))
+
+    with pytest.raises(SnykHTTPError):
+        snyk_request(func, "org/x", retries=3, backoff=0)
+
+    assert len(calls) == 4
+
+
+@pytest.mark.parametrize("status", [400, 401, 403, 404, 422])
+def test_raises_client_errors_straight_away(status):
+    func, calls = failing(snyk_error(status))
+
+    with pytest.raises(SnykHTTPError):
+        snyk_request(func, "org/x", retries=3, backoff=0)
+
+    assert len(calls) == 1
+
+
+def test_status_comes_from_the_response_not_the_body():
+    # the body's code is what pysnyk exposes, but it's the response's status that decides
+    error = snyk_error(401, b'{"code": 500, "message": "unauthorized"}')
+
+    assert error.code == 500
+    assert snyk_status(error) == 401
+    assert not is_retryable(error)
+
+
+def test_unknown_status_is_not_retried():
+    error = SnykHTTPError.__new__(SnykHTTPError)
+
+    assert snyk_status(error) is None
+    assert not is_retryable(error)
+
+    func, calls = failing(error)
+
+    with pytest.raises(SnykHTTPError):
+        snyk_request(func, retries=3, backoff=0)
+
+    assert len(calls) == 1
+
+
+def test_returns_once_a_retry_succeeds():
+    attempts = list()
+
+    def func(path):
+        attempts.append(path)
+
+        if len(attempts) < 3:
+            raise snyk_error(503)
+
+        return "ok"
+
+    assert snyk_request(func, "org/x", retries=3, backoff=0) == "ok"
+    assert len(attempts) == 3
+
+
+class SlowInstallations:
+    """
+    Stands in for the GitHub App, the installation lookup for slow_org takes until release is set
+    """
+
+    def __init__(self, slow_org: str):
+        self.slow_org = slow_org
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def create_jwt(self):
+        return "jwt"
+
+    def get_access_token(self, installation_id):
+        expires_at = datetime.utcnow() + timedelta(hours=1)
+
+        return SimpleNamespace(token=f"app-token-{installation_id}", expires_at=expires_at)
+
+    def get(self, url, headers):
+        org = url.split("/")[-2]
+
+        if org == self.slow_org:
+            self.started.set()
+            self.release.wait(5)
+
+        return SimpleNamespace(status_code=200, json=lambda: {"id": org})
+
+
+def test_slow_installation_token_only_holds_up_its_org(monkeypatch):
+    app = SlowInstallations("slow-org")
+
+    pool = TokenPool(["pat"])
+    pool.integration = app  # type: ignore
+
+    monkeypatch.setattr(api.requests, "get", app.get)
+
+    slow = threading.Thread(target=pool.tokens_for, args=("slow-org",))
+    slow.start()
+
+    assert app.started.wait(5)
+
+    try:
+        assert pool.tokens_for(None) == ["pat"]
+        assert pool.tokens_for("other-org") == ["pat", "app-token-other-org"]
+    finally:
+        app.release.set()
+        slow.join()
+
+    assert pool.tokens_for("slow-org") == ["pat", "app-token-slow-org"]
+
+
+def test_expiring_installation_token_is_used_while_its_renewed(monkeypatch):
+    app = SlowInstallations("slow-org")
+
+    pool = TokenPool(["pat"])
+    pool.integration = app  # type: ignore
+    pool.installations["slow-org"] = ("old-token", time.time() + TokenPool.RENEW_BEFORE / 2)
+
+    monkeypatch.setattr(api.requests, "get", app.get)
+
+    renew = threading.Thread(target=pool.installation_token, args=("slow-org",))
+    renew.start()
+
+    assert app.started.wait(5)
+
+    try:
+        assert pool.installation_token("slow-org") == "old-token"
+    finally:
+        app.release.set()
+        renew.join()
+
+    assert pool.installation_token("slow-org") == "app-token-slow-org"
+
+
+def test_app_only_pool_has_no_token_where_the_app_is_not_installed(monkeypatch):
+    app = SlowInstallations("")
+
+    def get(url, headers):
+        if "/uninstalled-org/" in url:
+            return SimpleNamespace(status_code=404, json=lambda: {"message": "Not Found"})
+
+        return app.get(url, headers)
+
+    pool = TokenPool([])
+    pool.integration = app  # type: ignore
+
+    monkeypatch.setattr(api.requests, "get", get)
+
+    assert pool.has_token("installed-org")
+    assert pool.tokens_for("installed-org") == ["app-token-installed-org"]
+
+    # rather than going out anonymously
+    assert not pool.has_token("uninstalled-org")
+
+    with pytest.raises(Exception, match="uninstalled-org"):
+        pool.tokens_for("uninstalled-org")
+
+    with pytest.raises(Exception, match="No GitHub token"):
+        RateLimit(pool).pick("core", None)
+
+    # a plain token can be used anywhere
+    assert TokenPool(["pat"]).has_token("uninstalled-org")
+
+
+def test_rate_limit_check_while_buckets_are_added():
+    rate_limit = RateLimit()
+    errors = list()
+
+    def add_buckets():
+        for i in range(0, 20000):
+            rate_limit.bucket("core", f"token-{i}")
+
+    adder = threading.Thread(target=add_buckets)
+    adder.start()
+
+    try:
+        while adder.is_alive():
+            rate_limit.check()
+    except RuntimeError as e:
+        errors.append(e)
+    finally:
+        adder.join()
+
+    assert errors == []
+
+
+NOW = 1_000_000.0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Freezes api's clock at NOW and records the sleeps instead of taking them
+    """
+    sleeps = list()
+
+    monkeypatch.setattr(api.time, "time", lambda: NOW)
+    monkeypatch.setattr(api.time, "sleep", sleeps.append)
+
+    return sleeps
+
+
+def rate_headers(remaining: int, limit: int = 5000, reset: float = NOW + 1000) -> dict:
+    return {
+        "x-ratelimit-limit": str(limit),
+        "x-ratelimit-remaining": str(remaining),
+        "x-ratelimit-reset": str(int(reset)),
+    }
+
+
+def test_bucket_goes_freely_until_the_budget_runs_low(clock):
+    bucket = RateBucket()
+
+    assert bucket.delay() == 0
+
+    bucket.observe(rate_headers(remaining=501))
+
+    assert (bucket.limit, bucket.remaining, bucket.reset, bucket.calls) == (5000, 501, NOW + 1000, 1)
+    assert bucket.delay() == 0
+    assert bucket.remaining == 500
+
+    # under a tenth of the budget left, what remains is spread over the time until the reset
+    bucket.observe(rate_headers(remaining=400))
+
+    assert bucket.delay() == 0
+    assert bucket.delay() == pytest.approx(1000 / 400)
+    assert bucket.delay(consume=False) == pytest.approx(1000 / 400 + 1000 / 399)
+    assert bucket.remaining == 398
+
+
+def test_bucket_waits_for_the_reset_once_its_empty(clock):
+    bucket = RateBucket()
+
+    bucket.observe(rate_headers(remaining=0, reset=NOW + 120))
+
+    assert bucket.delay() == 120
+
+    # after the reset the whole budget is back
+    bucket.observe(rate_headers(remaining=0, reset=NOW - 1))
+
+    assert bucket.delay() == 0
+    assert bucket.remaining == 4999
+
+
+def test_a_304_is_not_counted(clock):
+    bucket = RateBucket()
+
+    bucket.observe(rate_headers(remaining=10), counted=False)
+
+    assert (bucket.calls, bucket.remaining) == (0, 10)
+
+
+@pytest.mark.parametrize(
+    "status, headers, body, attempt, wait",
+    [
+        (403, {"retry-after": "30"}, "", 0, 30),
+        (429, {"retry-after": "5"}, "", 2, 5),
+        (403, rate_headers(remaining=0, reset=NOW + 300), "", 0, 301),
+        (403, rate_headers(remaining=0, reset=NOW - 10), "", 0, 1),
+        (403, {}, '{"message": "You have exceeded a secondary rate limit"}', 0, 60),
+        (403, {}, '{"message": "You have triggered an abuse detection mechanism"}', 2, 240),
+        (403, rate_headers(remaining=10), '{"message": "Resource not accessible by integration"}', 0, None),
+        (404, {"retry-after": "30"}, "", 0, None),
+        (200, rate_headers(remaining=0), "", 0, None),
+    ],
+)
+def test_backoff(clock, status, headers, body, attempt, wait):
+    rate_limit = RateLimit()
+
+    assert rate_limit.backoff("core", "pat", status, headers, body, attempt) == wait
+
+    # only the token that was turned away is held back
+    expected = wait if wait is not None else 0
+
+    assert rate_limit.bucket("core", "pat").delay(consume=False) == expected
+    assert rate_limit.bucket("core", "other").delay(consume=False) == 0
+    assert rate_limit.bucket("search", "pat").delay(consume=False) == 0
+
+
+def test_pick_prefers_the_token_that_can_go_soonest(clock):
+    rate_limit = RateLimit(TokenPool(["a", "b", "c"]))
+
+    # a token we haven't heard back on is assumed to have its whole budget
+    assert rate_limit.pick("core", "org") == "a"
+
+    rate_limit.bucket("core", "a").observe(rate_headers(remaining=100))
+    rate_limit.bucket("core", "b").observe(rate_headers(remaining=3000))
+    rate_limit.bucket("core", "c").observe(rate_headers(remaining=2000))
+
+    assert rate_limit.pick("core", "org") == "b"
+
+    rate_limit.backoff("core", "b", 429, {"retry-after": "60"}, "", 0)
+
+    assert rate_limit.pick("core", "org") == "c"
+
+    # each resource has its own budget
+    rate_limit.bucket("search", "c").observe(rate_headers(remaining=0, limit=30, reset=NOW + 30))
+
+    assert rate_limit.pick("search", "org") == "a"
+
+    assert RateLimit().pick("core", "org") == ""
+
+
+class Responses:
+    """
+    Stands in for PyGithub's connection, answers each request with the next canned response
+    """
+
+    def __init__(self, url: str, responses: list):
+        self.url = url
+        self.input = None
+        self.headers = {"Authorization": "token default"}
+        self.responses = responses
+        self.sent = list()
+
+    def getresponse(self):
+        self.sent.append(self.headers["Authorization"])
+
+        status, headers, body = self.responses.pop(0)
+
+        return CachedResponse(status, headers, body)
+
+
+class RateLimitedResponses(RateLimitMixin, Responses):
+    pass
+
+
+def test_connection_retries_a_rate_limited_request_on_another_token(clock, monkeypatch):
+    rate_limit = RateLimit(TokenPool(["a", "b"]))
+    monkeypatch.setattr(RateLimitMixin, "rate_limit", rate_limit)
+
+    connection = RateLimitedResponses(
+        "/repos/org/repo",
+        [
+            (403, {**rate_headers(remaining=0, reset=NOW + 600), "x-ratelimit-resource": "core"}, "rate limited"),
+            (200, {**rate_headers(remaining=4000), "x-ratelimit-resource": "core"}, "{}"),
+        ],
+    )
+
+    assert connection.getresponse().status == 200
+
+    # a is held back until its reset, so the retry goes out on b straight away
+    assert connection.sent == ["token a", "token b"]
+    assert clock == []
+    assert rate_limit.bucket("core", "a").delay(consume=False) == 601
+    assert rate_limit.bucket("core", "b").remaining == 4000
+
+
+def test_connection_waits_out_retry_after_with_a_single_token(clock, monkeypatch):
+    rate_limit = RateLimit()
+    monkeypatch.setattr(RateLimitMixin, "rate_limit", rate_limit)
+
+    connection = RateLimitedResponses(
+        "/search/code?q=org:org",
+        [
+            (429, {"retry-after": "20"}, "slow down"),
+            (403, {}, "You have exceeded a secondary rate limit"),
+            (200, rate_headers(remaining=29, limit=30), "{}"),
+        ],
+    )
+
+    assert connection.getresponse().status == 200
+
+    # with no pool the request keeps the Github object's own token
+    assert connection.sent == ["token default"] * 3
+    assert clock == [20, 120]
+    assert rate_limit.bucket("search").calls == 3
+
+
+def test_connection_gives_up_after_its_retries(clock, monkeypatch):
+    monkeypatch.setattr(RateLimitMixin, "rate_limit", RateLimit())
+
+    connection = RateLimitedResponses(
+        "/orgs/org", [(429, {"retry-after": "1"}, "")] * (RateLimit.RETRIES + 1) + [(200, {}, "{}")]
+    )
+
+    assert connection.getresponse().status == 429
+    assert len(connection.sent) == RateLimit.RETRIES + 1
+
+
+def repo_node(repo_id: int, name: str, updated_at: str = "2022-06-01T00:00:00Z", **fields) -> dict:
+    node = {
+        "databaseId": repo_id,
+        "name": name,
+        "nameWithOwner": f"snyk-playground/{name}",
+        "url": f"https://github.com/snyk-playground/{name}",
+        "isFork": False,
+        "isArchived": False,
+        "visibility": "PRIVATE",
+        "updatedAt": updated_at,
+        "pushedAt": "2022-05-01T00:00:00Z",
+        "owner": {"login": "snyk-playground"},
+        "defaultBranchRef": {"name": "develop"},
+        "repositoryTopics": {"nodes": [{"topic": {"name": "python"}}, {"topic": {"name": "api"}}]},
+        "importYaml": None,
+    }
+    node.update(fields)
+
+    return node
+
+
+class GraphQLPages:
+    """
+    Stands in for PyGithub's Requester, answers each GraphQL query with the next canned response
+    """
+
+    def __init__(self, responses: list):
+        self.responses = responses
+        self.queries = list()
+
+    def requestJsonAndCheck(self, verb, url, input=None):
+        self.queries.append((verb, url, input["variables"]))
+
+        return {}, self.responses.pop(0)
+
+    def github(self):
+        return SimpleNamespace(_Github__requester=self)
+
+
+def repos_page(nodes: list, end_cursor=None) -> dict:
+    return {
+        "data": {
+            "organization": {
+                "repositories": {
+                    "pageInfo": {"hasNextPage": end_cursor is not None, "endCursor": end_cursor},
+                    "nodes": nodes,
+                }
+            }
+        }
+    }
+
+
+def test_graphql_repo_matches_the_rest_fields():
+    repo, import_yaml = graphql_repo(GraphQLPages([]), repo_node(42, "goof", isArchived=True))  # type: ignore
+
+    assert repo.id == 42
+    assert repo.name == "goof"
+    assert repo.full_name == "snyk-playground/goof"
+    assert repo.owner.login == "snyk-playground"
+    assert repo.html_url == "https://github.com/snyk-playground/goof"
+    assert repo.fork is False
+    assert repo.archived is True
+    assert repo.visibility == "private"
+    assert repo.default_branch == "develop"
+    assert repo.updated_at == datetime(2022, 6, 1)
+    assert repo.pushed_at == datetime(2022, 5, 1)
+    assert repo.topics == ["python", "api"]
+    assert import_yaml is None
+
+
+def test_graphql_repo_import_yaml():
+    text = "schema: 1\norgs:\n  - name: ie-playground\n"
+
+    node = repo_node(42, "goof", importYaml={"oid": "abc123", "text": text}, defaultBranchRef=None)
+
+    repo, import_yaml = graphql_repo(GraphQLPages([]), node)  # type: ignore
+
+    # an empty repo has no default branch
+    assert repo.default_branch == "main"
+
+    assert import_yaml is not None
+    assert import_yaml.sha == "abc123"
+    assert import_yaml.path == ".snyk.d/import.yaml"
+    assert import_yaml.decoded_content == text.encode()
+    assert import_yaml.repository.full_name == "snyk-playground/goof"
+
+    # a binary blob has no text
+    _, import_yaml = graphql_repo(GraphQLPages([]), repo_node(42, "goof", importYaml={"oid": "abc123", "text": None}))
+
+    assert import_yaml is None
+
+
+def test_get_repos_graphql_follows_the_cursor():
+    requester = GraphQLPages(
+        [
+            repos_page([repo_node(1, "a"), repo_node(2, "b")], end_cursor="cursor-1"),
+            repos_page([repo_node(3, "c")], end_cursor="cursor-2"),
+            repos_page([repo_node(4, "d")]),
+        ]
+    )
+
+    repos = get_repos_graphql(requester.github(), "snyk-playground")  # type: ignore
+
+    assert [r.id for r, _ in repos] == [1, 2, 3, 4]
+    assert requester.queries == [
+        ("POST", "/graphql", {"org": "snyk-playground", "cursor": None}),
+        ("POST", "/graphql", {"org": "snyk-playground", "cursor": "cursor-1"}),
+        ("POST", "/graphql", {"org": "snyk-playground", "cursor": "cursor-2"}),
+    ]
+
+
+def test_get_repos_graphql_stops_at_since():
+    requester = GraphQLPages(
+        [
+            repos_page([repo_node(1, "a", "2022-06-03T00:00:00Z"), repo_node(2, "b", "2022-06-02T00:00:00Z")], "c1"),
+            repos_page([repo_node(3, "c", "2022-06-01T00:00:00Z")], "c2"),
+            repos_page([repo_node(4, "d", "2022-05-01T00:00:00Z")]),
+        ]
+    )
+
+    repos = get_repos_graphql(requester.github(), "snyk-playground", since="2022-06-01 12:00:00")  # type: ignore
+
+    # the page that reaches since is kept whole, the ones after it aren't asked for
+    assert [r.id for r, _ in repos] == [1, 2, 3]
+    assert len(requester.queries) == 2
+
+
+def test_get_repos_graphql_errors():
+    requester = GraphQLPages([{"data": {"organization": None}, "errors": [{"message": "Could not resolve"}]}])
+
+    with pytest.raises(Exception, match="Could not resolve"):
+        get_repos_graphql(requester.github(), "missing-org")  # type: ignore
+
+    # partial errors are only logged
+    page = repos_page([repo_node(1, "a")])
+    page["errors"] = [{"message": "Resource limits exceeded for topics"}]
+
+    assert [r.id for r, _ in get_repos_graphql(GraphQLPages([page]).github(), "snyk-playground")] == [1]
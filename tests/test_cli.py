@@ -0,0 +1,210 @@
+import json
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from types import SimpleNamespace
+
+from cli import apply_import_hits
+from cli import autoconf_fingerprint
+from cli import load_autoconf_progress
+from cli import save_autoconf_progress
+from cli import start_autoconf_progress
+from cli import update_project_tags
+from models.sync import SnykWatchList
+from test_api import snyk_error
+from test_sync import make_repo
+
+
+ORGS = [{"id": "org-1", "slug": "one"}, {"id": "org-2", "slug": "two"}]
+
+
+def test_autoconf_progress_resumes_the_same_run(tmp_path):
+    progress_path = tmp_path / ".autoconf-group.ndjson"
+    fingerprint = autoconf_fingerprint(ORGS)
+
+    with open(progress_path, "w") as progress:
+        start_autoconf_progress(progress, fingerprint)
+        save_autoconf_progress(progress, ORGS[0], {"github-enterprise": "int-1"})
+        # stopped part way through writing the next one
+        progress.write('{"id": "org-2", "integ')
+
+    assert load_autoconf_progress(progress_path, fingerprint) == {"org-1": {"github-enterprise": "int-1"}}
+
+
+def test_autoconf_progress_for_other_orgs_is_ignored(tmp_path):
+    progress_path = tmp_path / ".autoconf-group.ndjson"
+
+    with open(progress_path, "w") as progress:
+        start_autoconf_progress(progress, autoconf_fingerprint(ORGS))
+        save_autoconf_progress(progress, ORGS[0], {"github-enterprise": "int-1"})
+
+    assert autoconf_fingerprint(list(reversed(ORGS))) == autoconf_fingerprint(ORGS)
+    assert load_autoconf_progress(progress_path, autoconf_fingerprint(ORGS[:1])) == dict()
+
+
+def test_stale_autoconf_progress_is_ignored(tmp_path):
+    progress_path = tmp_path / ".autoconf-group.ndjson"
+    fingerprint = autoconf_fingerprint(ORGS)
+
+    started = datetime.isoformat(datetime.utcnow() - timedelta(days=3))
+
+    with open(progress_path, "w") as progress:
+        progress.write(json.dumps({"started": started, "orgs": fingerprint}) + "\n")
+        save_autoconf_progress(progress, ORGS[0], {"github-enterprise": "int-1"})
+
+    assert load_autoconf_progress(progress_path, fingerprint) == dict()
+
+
+def test_autoconf_progress_without_a_header_is_ignored(tmp_path):
+    progress_path = tmp_path / ".autoconf-group.ndjson"
+
+    with open(progress_path, "w") as progress:
+        save_autoconf_progress(progress, ORGS[0], {"github-enterprise": "int-1"})
+
+    assert load_autoconf_progress(progress_path, autoconf_fingerprint(ORGS)) == dict()
+    assert load_autoconf_progress(tmp_path / "missing.ndjson", autoconf_fingerprint(ORGS)) == dict()
+
+
+TAG = {"key": "team", "value": "a"}
+
+PROJECT = {"org_id": "org-1", "project_id": "project-1", "tags": [TAG]}
+
+
+class TagClient:
+    """
+    Stands in for the v1 SnykClient, posting a tag fails with post_error
+    """
+
+    def __init__(self, live_tags: list, post_error=None):
+        self.live_tags = live_tags
+        self.post_error = post_error
+        self.gets = list()
+        self.posts = list()
+
+    def get(self, path):
+        self.gets.append(path)
+        return SimpleNamespace(json=lambda: {"name": "project", "tags": self.live_tags})
+
+    def post(self, path, body):
+        self.posts.append(body)
+        if self.post_error is not None:
+            raise self.post_error
+
+
+def test_trusted_tags_are_checked_again_on_a_422():
+    # pysnyk takes the code from the body, which doesn't have to match the status
+    client = TagClient([TAG], snyk_error(422, b'{"code": 400, "message": "exists"}'))
+
+    assert update_project_tags(client, "g1", PROJECT, trusted=True) == "skipped"
+    assert len(client.gets) == 1
+
+
+def test_tag_already_on_the_project(capsys):
+    client = TagClient([], snyk_error(422, b'{"message": "exists"}'))
+
+    assert update_project_tags(client, "g1", PROJECT) == "applied"
+    assert "already exists" in capsys.readouterr().out
+
+
+def test_tag_failure_reports_the_status(capsys):
+    client = TagClient([], snyk_error(403, b'{"code": 422, "message": "forbidden"}'))
+
+    assert update_project_tags(client, "g1", PROJECT, trusted=True) == "failed"
+    assert len(client.gets) == 0
+    assert "returned code: 403" in capsys.readouterr().out
+
+
+def import_hit(repo_id: int, sha: str) -> SimpleNamespace:
+    return SimpleNamespace(sha=sha, repository=SimpleNamespace(id=repo_id))
+
+
+class SlowImports:
+    """
+    Stands in for sync's load_import, every file takes until release is set
+    """
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.fetched = list()
+
+    def __call__(self, import_yaml):
+        with self.lock:
+            self.fetched.append(import_yaml.sha)
+
+        self.release.wait(5)
+
+        return {"orgName": f"org-{import_yaml.sha}", "tags": {"sha": import_yaml.sha}}, False
+
+
+def test_import_hits_sharing_a_file_fetch_it_once():
+    watched = SnykWatchList(repos=[make_repo(i, "snyk-playground", f"repo-{i}") for i in range(0, 6)])
+    watched.repos[5].import_sha = "unchanged"
+
+    load_import = SlowImports()
+
+    hits = [
+        import_hit(0, "shared"),
+        import_hit(1, "other"),
+        import_hit(2, "shared"),
+        import_hit(3, "shared"),
+        import_hit(4, "other"),
+        import_hit(5, "unchanged"),
+        import_hit(99, "not-watched"),
+    ]
+
+    load_import.release.set()
+
+    counts = apply_import_hits(hits, watched, load_import, workers=4)
+
+    assert sorted(load_import.fetched) == ["other", "shared"]
+    assert counts == {"loaded": 5, "cached": 0, "unchanged": 1, "errors": 0}
+    assert [r.org for r in watched.repos] == [
+        "org-shared",
+        "org-other",
+        "org-shared",
+        "org-shared",
+        "org-other",
+        "default",
+    ]
+    assert [r.import_sha for r in watched.repos] == ["shared", "other", "shared", "shared", "other", "unchanged"]
+
+    # each repo has its own copy of the file's lists
+    assert watched.repos[0].tags is not watched.repos[2].tags
+
+
+def test_import_hits_in_flight_are_bounded():
+    workers = 2
+    watched = SnykWatchList(repos=[make_repo(i, "snyk-playground", f"repo-{i}") for i in range(0, 20)])
+
+    load_import = SlowImports()
+
+    read = list()
+
+    def hits():
+        for i in range(0, 20):
+            read.append(i)
+            # every other hit shares the file of the one before it, and doesn't count against the bound
+            yield import_hit(i, f"sha-{i // 2}")
+
+    result = dict()
+    dispatch = threading.Thread(target=lambda: result.update(apply_import_hits(hits(), watched, load_import, workers)))
+    dispatch.start()
+
+    try:
+        # workers * 2 files in flight, and the hit for the next one read before waiting for one to finish
+        deadline = time.time() + 5
+        while len(read) < workers * 2 * 2 + 1 and time.time() < deadline:
+            time.sleep(0.01)
+
+        time.sleep(0.1)
+
+        assert len(read) == workers * 2 * 2 + 1
+        assert len(load_import.fetched) == workers
+    finally:
+        load_import.release.set()
+        dispatch.join()
+
+    assert sorted(load_import.fetched) == sorted(f"sha-{i}" for i in range(0, 10))
+    assert result == {"loaded": 20, "cached": 0, "unchanged": 0, "errors": 0}
@@ -0,0 +1,350 @@
+import json
+import os
+from uuid import UUID
+
+import pytest
+from models.organizations import Org
+from models.organizations import Orgs
+from models.organizations import Target
+from models.repositories import Project
+
+
+ORG_ID = "39ddc762-b1b9-41ce-ab42-defbe4575bd6"
+GROUP_ID = "5a9f2b5c-7d2e-4b7a-9a53-1f0d7f6a3c21"
+INTEGRATION_ID = "b2c1e2a4-5c1f-4e4b-8d0f-6a2e9c3f7b10"
+
+
+def api_org(org_id: str = ORG_ID, slug: str = "ie-playground") -> dict:
+    """
+    An org as it comes back from the v1 group orgs endpoint, with the group Orgs.refresh_orgs adds
+    """
+    return {
+        "name": slug.replace("-", " ").title(),
+        "id": org_id,
+        "slug": slug,
+        "url": f"https://app.snyk.io/org/{slug}",
+        "created": "2021-06-07T00:00:00.000Z",
+        "group_id": GROUP_ID,
+        "group_name": "Snyk Playground",
+    }
+
+
+def api_target(target_id: str, name: str) -> dict:
+    """
+    A target as it comes back from the v3 targets endpoint
+    """
+    return {
+        "id": target_id,
+        "type": "target",
+        "attributes": {
+            "displayName": name,
+            "origin": "github-enterprise",
+            "remoteUrl": f"http://github.com/{name}",
+            "isPrivate": True,
+        },
+    }
+
+
+def make_target(target_id: str, name: str, repo_id=None) -> Target:
+    target = Target.parse_obj(api_target(target_id, name))
+    target.org_id = UUID(ORG_ID)
+    target.org_slug = "ie-playground"
+    target.repo_id = repo_id
+
+    return target
+
+
+def api_project(project_id: str, target_id: str, tags: tuple = (), branch: str = "main") -> dict:
+    """
+    A project as it comes back from the v3 projects endpoint, with the org Org.refresh_projects adds
+    """
+    return {
+        "id": project_id,
+        "type": "project",
+        "attributes": {
+            "name": "snyk-playground/goof:package.json",
+            "type": "npm",
+            "status": "active",
+            "origin": "github-enterprise",
+            "targetReference": branch,
+            "tags": list(tags),
+        },
+        "relationships": {"target": {"data": {"id": target_id, "type": "target"}}},
+        "org_id": ORG_ID,
+        "org_slug": "ie-playground",
+    }
+
+
+def cached(model) -> dict:
+    """
+    The record a cache keeps for a model
+    """
+    return json.loads(model.json())
+
+
+def test_org_from_cache_matches_parse_obj():
+    org = Org.parse_obj(api_org())
+    org.integrations = {"github-enterprise": UUID(INTEGRATION_ID)}
+
+    metadata = org.get_metadata()
+    integrations = json.loads(json.dumps(org.integrations, default=str))
+
+    from_cache = Org.from_cache(metadata, integrations)
+
+    assert from_cache == Org.parse_obj({**metadata, "integrations": integrations})
+    assert from_cache.id == UUID(ORG_ID)
+    assert from_cache.group_id == UUID(GROUP_ID)
+    assert from_cache.integrations == {"github-enterprise": UUID(INTEGRATION_ID)}
+
+
+def test_target_from_cache_matches_parse_obj():
+    for target in [
+        make_target("f3b4c5d6-1a2b-4c3d-8e9f-0a1b2c3d4e5f", "snyk-playground/goof", repo_id="123456"),
+        make_target("a4b4c5d6-1a2b-4c3d-8e9f-0a1b2c3d4e5f", "snyk-playground/java-goof"),
+    ]:
+        from_cache = Target.from_cache(cached(target))
+
+        assert from_cache == Target.parse_obj(cached(target))
+        assert from_cache.json() == target.json()
+        assert from_cache.id == target.id
+        assert from_cache.org_id == UUID(ORG_ID)
+
+
+def test_project_from_cache_matches_parse_obj():
+    project = Project.parse_obj(
+        api_project(
+            "0c7b2b9e-3a1d-4d5e-9f2a-6b8c1d0e2f3a",
+            "f3b4c5d6-1a2b-4c3d-8e9f-0a1b2c3d4e5f",
+            tags=[{"key": "team", "value": "a"}, {"key": "component", "value": "api"}],
+        )
+    )
+
+    from_cache = Project.from_cache(cached(project))
+
+    assert from_cache == Project.parse_obj(cached(project))
+    assert from_cache.json() == project.json()
+    assert from_cache.id == UUID("0c7b2b9e-3a1d-4d5e-9f2a-6b8c1d0e2f3a")
+    assert from_cache.org_id == UUID(ORG_ID)
+    assert [(t.key, t.value) for t in from_cache.tags] == [("team", "a"), ("component", "api")]
+    assert from_cache.target_path == "package.json"
+
+
+TARGET_A = "f3b4c5d6-1a2b-4c3d-8e9f-0a1b2c3d4e5f"
+TARGET_B = "a4b4c5d6-1a2b-4c3d-8e9f-0a1b2c3d4e5f"
+PROJECT_1 = "0c7b2b9e-3a1d-4d5e-9f2a-6b8c1d0e2f3a"
+PROJECT_2 = "1d7b2b9e-3a1d-4d5e-9f2a-6b8c1d0e2f3a"
+PROJECT_3 = "2e7b2b9e-3a1d-4d5e-9f2a-6b8c1d0e2f3a"
+
+
+def make_project(project_id: str, target_id: str, branch: str = "main") -> Project:
+    return Project.parse_obj(api_project(project_id, target_id, branch=branch))
+
+
+def project_ids(projects: list) -> list:
+    return [str(p.id) for p in projects]
+
+
+def target_ids(targets: list) -> list:
+    return [str(t.id) for t in targets]
+
+
+def test_add_target_appends_and_replaces():
+    org = Org.parse_obj(api_org())
+
+    org.add_target(make_target(TARGET_A, "snyk-playground/goof", repo_id="1"))
+    org.add_target(make_target(TARGET_B, "snyk-playground/java-goof"))
+
+    assert target_ids(org.targets) == [TARGET_A, TARGET_B]
+    assert target_ids(org.find_targets_by_repo("Snyk-Playground/GOOF", 0)) == [TARGET_A]
+    assert target_ids(org.find_targets_by_repo("", 1)) == [TARGET_A]
+
+    # the same target again, renamed and with another repo id, replaces it in place
+    org.add_target(make_target(TARGET_A, "snyk-playground/goof-renamed", repo_id="2"))
+
+    assert target_ids(org.targets) == [TARGET_A, TARGET_B]
+    assert org.targets[0].name == "snyk-playground/goof-renamed"
+    assert org.get_target_info(UUID(TARGET_A)) is org.targets[0]
+    assert org.find_targets_by_repo("snyk-playground/goof", 1) == []
+    assert target_ids(org.find_targets_by_repo("snyk-playground/goof-renamed", 2)) == [TARGET_A]
+
+    # matching both by repo id and by name only finds it once
+    assert target_ids(org.find_targets_by_repo("snyk-playground/java-goof", 2)) == [TARGET_A, TARGET_B]
+
+
+def test_add_project_appends_and_replaces():
+    org = Org.parse_obj(api_org())
+
+    org.add_project(make_project(PROJECT_1, TARGET_A))
+    org.add_project(make_project(PROJECT_2, TARGET_A))
+
+    assert project_ids(org.projects) == [PROJECT_1, PROJECT_2]
+    assert project_ids(org.find_projects_by_target(TARGET_A)) == [PROJECT_1, PROJECT_2]
+
+    # the same project again, moved to another target, replaces it in place
+    org.add_project(make_project(PROJECT_1, TARGET_B, branch="release"))
+
+    assert project_ids(org.projects) == [PROJECT_1, PROJECT_2]
+    assert org.projects[0].branch == "release"
+    assert project_ids(org.find_projects_by_target(TARGET_A)) == [PROJECT_2]
+    assert project_ids(org.find_projects_by_target(TARGET_B.upper())) == [PROJECT_1]
+
+
+def test_reindex_collapses_duplicates_to_the_last_one():
+    org = Org.parse_obj(
+        {
+            **api_org(),
+            "targets": [
+                make_target(TARGET_A, "snyk-playground/goof"),
+                make_target(TARGET_B, "snyk-playground/java-goof"),
+                make_target(TARGET_A, "snyk-playground/goof-renamed"),
+            ],
+            "projects": [
+                make_project(PROJECT_1, TARGET_A),
+                make_project(PROJECT_2, TARGET_B),
+                make_project(PROJECT_1, TARGET_B),
+            ],
+        }
+    )
+
+    assert target_ids(org.targets) == [TARGET_A, TARGET_B]
+    assert org.targets[0].name == "snyk-playground/goof-renamed"
+    assert org.find_targets_by_repo("snyk-playground/goof", 0) == []
+    assert project_ids(org.projects) == [PROJECT_1, PROJECT_2]
+    assert org.find_projects_by_target(TARGET_A) == []
+    assert sorted(project_ids(org.find_projects_by_target(TARGET_B))) == [PROJECT_1, PROJECT_2]
+
+    # lists assigned directly aren't indexed until reindex is called
+    org.projects = [make_project(PROJECT_3, TARGET_A)]
+    org.reindex()
+
+    assert project_ids(org.find_projects_by_target(TARGET_A)) == [PROJECT_3]
+    assert org.find_projects_by_target(TARGET_B) == []
+
+
+def test_assign_projects():
+    # test_sync builds its projects from api_project, so this one can't be imported at the top
+    from test_sync import make_repo
+
+    first = Org.parse_obj(api_org())
+    first.add_target(make_target(TARGET_A, "snyk-playground/goof", repo_id="1"))
+    first.add_project(make_project(PROJECT_1, TARGET_A))
+
+    # the second org only knows the repo by name
+    second = Org.parse_obj(api_org("4e6a1c1e-8f7d-4a3b-9c2e-5d1f0b7a6e93", "ie-playground-2"))
+    second.add_target(make_target(TARGET_B, "Snyk-Playground/Goof"))
+    second.add_project(make_project(PROJECT_2, TARGET_B))
+    second.add_project(make_project(PROJECT_3, TARGET_B, branch="release"))
+
+    orgs = Orgs(orgs=[first, second])
+
+    goof = make_repo(1, "snyk-playground", "goof")
+    renamed = make_repo(1, "snyk-playground", "goof-renamed")
+    unknown = make_repo(3, "snyk-playground", "unknown")
+
+    orgs.assign_projects([goof, renamed, unknown])
+
+    assert project_ids(goof.projects) == [PROJECT_1, PROJECT_2, PROJECT_3]
+    assert project_ids(renamed.projects) == [PROJECT_1]
+    assert unknown.projects == []
+
+    # the same as looking each repo up
+    assert project_ids(goof.projects) == project_ids(orgs.find_projects_by_repo("snyk-playground/goof", 1))
+
+    # assigning again replaces the projects rather than adding them twice
+    second.add_project(make_project(PROJECT_2, TARGET_B, branch="develop"))
+
+    orgs.assign_projects([goof])
+
+    assert project_ids(goof.projects) == [PROJECT_1, PROJECT_2, PROJECT_3]
+    assert goof.projects[1].branch == "develop"
+
+
+def write_legacy_org(org_path, org: Org, targets: list, projects: list):
+    """
+    Writes an org the way older versions did, a directory with a json file per target and per project
+    """
+    os.makedirs(f"{org_path}/targets")
+    os.makedirs(f"{org_path}/projects")
+
+    with open(f"{org_path}/integrations.json", "w") as the_file:
+        json.dump({"github-enterprise": INTEGRATION_ID}, the_file, indent=4)
+
+    with open(f"{org_path}/metadata.json", "w") as the_file:
+        json.dump(org.get_metadata(), the_file, indent=4)
+
+    for target in targets:
+        with open(f"{org_path}/targets/{target.id}.json", "w") as the_file:
+            json.dump(cached(target), the_file, indent=4)
+
+    for project in projects:
+        with open(f"{org_path}/projects/{project.id}.json", "w") as the_file:
+            json.dump(cached(project), the_file, indent=4)
+
+
+def test_legacy_org_is_migrated(tmp_path):
+    org = Org.parse_obj(api_org())
+    targets = [make_target(TARGET_A, "snyk-playground/goof", repo_id="1"), make_target(TARGET_B, "snyk-playground/b")]
+    projects = [
+        make_project(PROJECT_1, TARGET_A),
+        make_project(PROJECT_2, TARGET_B),
+        make_project(PROJECT_3, TARGET_A),
+    ]
+
+    write_legacy_org(tmp_path / "org" / "ie-playground", org, targets, projects)
+
+    orgs = Orgs(cache=str(tmp_path))
+    orgs.load()
+
+    # the directory is replaced by the single file layout
+    assert os.listdir(tmp_path / "org") == ["ie-playground.ndjson"]
+
+    migrated = orgs.orgs[0]
+
+    assert migrated.get_metadata() == org.get_metadata()
+    assert migrated.integrations == {"github-enterprise": UUID(INTEGRATION_ID)}
+    assert sorted(target_ids(migrated.targets)) == sorted([TARGET_A, TARGET_B])
+    assert sorted(project_ids(migrated.projects)) == sorted([PROJECT_1, PROJECT_2, PROJECT_3])
+    assert {str(t.id): t for t in migrated.targets} == {str(t.id): t for t in targets}
+    assert {str(p.id): p for p in migrated.projects} == {str(p.id): p for p in projects}
+
+    # and indexed
+    assert sorted(project_ids(migrated.find_projects_by_repo("snyk-playground/goof", 1))) == [PROJECT_1, PROJECT_3]
+
+    # the next load reads the migrated file back the same
+    reloaded = Orgs(cache=str(tmp_path))
+    reloaded.load()
+
+    assert reloaded.orgs == orgs.orgs
+
+
+def test_legacy_org_left_behind_by_a_migration(tmp_path):
+    org = Org.parse_obj(api_org())
+
+    write_legacy_org(tmp_path / "org" / "ie-playground", org, [make_target(TARGET_A, "snyk-playground/old")], [])
+
+    org.add_target(make_target(TARGET_B, "snyk-playground/new"))
+    org.save(tmp_path / "org" / "ie-playground.ndjson")
+
+    orgs = Orgs(cache=str(tmp_path))
+    orgs.load()
+
+    # a migration that didn't get to remove the directory, the file it wrote wins
+    assert os.listdir(tmp_path / "org") == ["ie-playground.ndjson"]
+    assert len(orgs.orgs) == 1
+    assert target_ids(orgs.orgs[0].targets) == [TARGET_B]
+
+
+def test_legacy_org_missing_files(tmp_path):
+    org_path = tmp_path / "org" / "ie-playground"
+
+    write_legacy_org(org_path, Org.parse_obj(api_org()), [], [])
+
+    os.remove(org_path / "integrations.json")
+
+    with pytest.raises(Exception, match="integrations.json does not exist"):
+        Orgs(cache=str(tmp_path)).load()
+
+    os.remove(org_path / "metadata.json")
+
+    with pytest.raises(Exception, match="metadata.json does not exist"):
+        Orgs(cache=str(tmp_path)).load()
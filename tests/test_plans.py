@@ -0,0 +1,109 @@
+import json
+
+import plans
+from test_sync import make_repo
+
+
+ORG_ID = "39ddc762-b1b9-41ce-ab42-defbe4575bd6"
+
+GROUP_ID = "22222222-2222-4222-8222-222222222222"
+
+SNYK_ORGS = {
+    "ie-playground": {
+        "orgId": ORG_ID,
+        "integrations": {"github-enterprise": "b87e1473-37ab-4f09-a4e3-a0139a50e81e"},
+    }
+}
+
+GROUPS = [{"id": GROUP_ID, "name": "g1", "snyk_token": "secret"}]
+
+FINGERPRINT = plans.plan_fingerprint("ie-playground", SNYK_ORGS, GROUPS)
+
+
+def write_sync(cache_dir, last_sync: str = "2022-01-01T00:00:00.000000"):
+    (cache_dir / "sync.json").write_text(json.dumps({"last_sync": last_sync}))
+
+
+def save(cache_dir):
+    repos = [make_repo(1, "org-a", "one"), make_repo(2, "org-a", "two")]
+
+    plans.save_plans(cache_dir, repos, "ie-playground", SNYK_ORGS, GROUPS, {ORG_ID: GROUP_ID})
+
+
+def test_fingerprint_ignores_group_tokens():
+    groups = [{"id": GROUP_ID, "name": "g1", "snyk_token": "rotated"}]
+
+    assert plans.plan_fingerprint("ie-playground", SNYK_ORGS, groups) == FINGERPRINT
+
+
+def test_save_and_load(tmp_path):
+    write_sync(tmp_path)
+    save(tmp_path)
+
+    header = plans.load_plan(tmp_path, FINGERPRINT)
+
+    assert header is not None
+    assert header["schema"] == plans.PLAN_SCHEMA
+
+    records = list(plans.iter_plan(tmp_path, "targets", GROUP_ID))
+
+    assert [r["target"]["name"] for r in records] == ["one", "two"]
+    assert all(r["org_id"] == ORG_ID for r in records)
+    assert list(plans.iter_plan(tmp_path, "tags", GROUP_ID)) == []
+
+
+def test_save_replaces_the_previous_plan(tmp_path):
+    write_sync(tmp_path)
+    save(tmp_path)
+
+    stale = tmp_path / "plan" / "targets" / "old-group.ndjson"
+    stale.write_text("{}\n")
+
+    save(tmp_path)
+
+    assert not stale.exists()
+    assert not (tmp_path / "plan.tmp").exists()
+
+
+def test_load_without_a_plan(tmp_path):
+    write_sync(tmp_path)
+
+    assert plans.load_plan(tmp_path, FINGERPRINT) is None
+
+
+def test_load_with_another_configuration(tmp_path):
+    write_sync(tmp_path)
+    save(tmp_path)
+
+    other = plans.plan_fingerprint("other-org", SNYK_ORGS, GROUPS)
+
+    assert plans.load_plan(tmp_path, other) is None
+
+
+def test_load_after_another_sync(tmp_path):
+    write_sync(tmp_path)
+    save(tmp_path)
+
+    # the cache was saved again but the plan wasn't
+    write_sync(tmp_path, "2022-01-02T00:00:00.000000")
+
+    assert plans.load_plan(tmp_path, FINGERPRINT) is None
+
+
+def test_load_another_schema(tmp_path):
+    write_sync(tmp_path)
+    save(tmp_path)
+
+    header_file = tmp_path / "plan" / "plan.json"
+    header = json.loads(header_file.read_text())
+    header["schema"] = plans.PLAN_SCHEMA + 1
+    header_file.write_text(json.dumps(header))
+
+    assert plans.load_plan(tmp_path, FINGERPRINT) is None
+
+
+def test_iter_plan_of_an_unknown_group(tmp_path):
+    write_sync(tmp_path)
+    save(tmp_path)
+
+    assert list(plans.iter_plan(tmp_path, "targets", "unknown")) == []
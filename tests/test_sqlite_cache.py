@@ -0,0 +1,349 @@
+import sqlite3
+import time
+from datetime import date
+
+import pytest
+import yaml
+from models.repositories import Repo
+from models.sync import SnykWatchList
+from pydantic import ValidationError
+from sqlite_cache import HTTPCache
+from sqlite_cache import ImportCache
+from sqlite_cache import SQLiteCache
+from test_sync import make_repo
+from utils import iter_watchlist
+
+
+def repo_record(repo_id: int, name: str, archived: bool = False, import_sha: str = "", tags: tuple = ()) -> dict:
+    return {
+        "id": repo_id,
+        "full_name": f"snyk-playground/{name}",
+        "archived": archived,
+        "fork": False,
+        "import_sha": import_sha,
+        "tags": list(tags),
+    }
+
+
+def org_records(org_id: str, group_id: str, targets: list, projects: dict) -> tuple:
+    metadata = {"id": org_id, "slug": org_id, "group_id": group_id}
+    integrations = {"github-enterprise": f"{org_id}-integration"}
+    target_rows = [{"id": t, "repo_id": "1", "name": t.upper()} for t in targets]
+    project_rows = [
+        {"id": p, "target": target.upper(), "tags": [{"key": "team", "value": f"team-{p}"}]}
+        for p, target in projects.items()
+    ]
+    return metadata, integrations, target_rows, project_rows
+
+
+def test_sqlite_cache_repos_round_trip(tmp_path):
+    repos = [
+        repo_record(1, "plain"),
+        repo_record(2, "archived", archived=True, import_sha="abc"),
+        repo_record(3, "imported", import_sha="def"),
+        repo_record(4, "tagged", tags=({"key": "team", "value": "a"},)),
+    ]
+
+    with SQLiteCache(tmp_path) as cache:
+        cache.save_repos(repos)
+
+    with SQLiteCache(tmp_path) as cache:
+        assert cache.is_current()
+        assert list(cache.load_repos()) == repos
+        assert [r["id"] for r in cache.load_repos(include_archived=False)] == [1, 3, 4]
+        assert [r["id"] for r in cache.load_repos(require_import=True)] == [2, 3]
+        assert [r["id"] for r in cache.load_repos(include_archived=False, require_import=True)] == [3]
+        assert [r["id"] for r in cache.load_repos(require_tags=True)] == [4]
+
+
+def test_sqlite_cache_removes_repos_no_longer_saved(tmp_path):
+    with SQLiteCache(tmp_path) as cache:
+        cache.save_repos([repo_record(1, "a"), repo_record(2, "b"), repo_record(3, "c")])
+        cache.save_repos([repo_record(3, "c-renamed"), repo_record(4, "d")])
+
+        assert [(r["id"], r["full_name"]) for r in cache.load_repos()] == [
+            (3, "snyk-playground/c-renamed"),
+            (4, "snyk-playground/d"),
+        ]
+
+        cache.save_repos([])
+
+        assert list(cache.load_repos()) == []
+        assert cache.has_saved_repos()
+
+
+def test_sqlite_cache_orgs_round_trip(tmp_path):
+    first = org_records("org-a", "group-1", ["t1", "t2"], {"p1": "t1", "p2": "t2"})
+    second = org_records("org-b", "group-2", ["t3"], {"p3": "t3"})
+
+    with SQLiteCache(tmp_path) as cache:
+        cache.save_org(*first)
+        cache.save_org(*second)
+
+    with SQLiteCache(tmp_path) as cache:
+        loaded = list(cache.load_orgs())
+
+    # targets and projects come back as saved, the target's name is only lower cased in the index
+    assert loaded == [first, second]
+
+
+def test_sqlite_cache_filters_orgs_by_group(tmp_path):
+    with SQLiteCache(tmp_path) as cache:
+        cache.save_org(*org_records("org-a", "group-1", ["t1"], {"p1": "t1"}))
+        cache.save_org(*org_records("org-b", "group-2", ["t2"], {"p2": "t2"}))
+        cache.save_org(*org_records("org-c", "group-1", ["t3"], {"p3": "t3"}))
+
+        assert [m["id"] for m, *_ in cache.load_orgs(group_ids=["group-1"])] == ["org-a", "org-c"]
+        assert [m["id"] for m, *_ in cache.load_orgs(group_ids=["group-2", "group-3"])] == ["org-b"]
+        assert list(cache.load_orgs(group_ids=[])) == []
+
+        metadata, integrations, targets, projects = next(cache.load_orgs(group_ids=["group-2"], with_projects=False))
+
+        assert (metadata["id"], integrations, targets, projects) == (
+            "org-b",
+            {"github-enterprise": "org-b-integration"},
+            [],
+            [],
+        )
+
+
+def test_sqlite_cache_removes_an_orgs_stale_targets_projects_and_tags(tmp_path):
+    with SQLiteCache(tmp_path) as cache:
+        cache.save_org(*org_records("org-a", "group-1", ["t1", "t2"], {"p1": "t1", "p2": "t2"}))
+        cache.save_org(*org_records("org-b", "group-1", ["t3"], {"p3": "t3"}))
+
+        # p1 loses its tags, t2 and p2 are gone
+        metadata, integrations, _, _ = org_records("org-a", "group-1", [], {})
+        cache.save_org(
+            metadata,
+            integrations,
+            [{"id": "t1", "repo_id": "1", "name": "T1"}],
+            [{"id": "p1", "target": "T1", "tags": []}],
+        )
+
+        _, _, targets, projects = next(cache.load_orgs(group_ids=["group-1"]))
+
+        assert [t["id"] for t in targets] == ["t1"]
+        assert projects == [{"id": "p1", "target": "T1", "tags": []}]
+        assert cache.conn.execute("SELECT project_id FROM tags ORDER BY rowid").fetchall() == [("p3",)]
+
+        # the other org in the group is untouched
+        assert list(cache.load_orgs())[1] == org_records("org-b", "group-1", ["t3"], {"p3": "t3"})
+
+
+def test_an_empty_sqlite_watchlist_does_not_read_data_json(tmp_path):
+    SnykWatchList(repos=[make_repo(1, "snyk-playground", "stale")]).save(tmp_path)
+
+    # before anything was saved to sqlite the json cache is carried on from
+    assert [r.full_name for r in iter_watchlist(tmp_path, "sqlite")] == ["snyk-playground/stale"]
+
+    SnykWatchList(repos=[]).save(tmp_path, "sqlite")
+
+    assert list(iter_watchlist(tmp_path, "sqlite")) == []
+
+    SnykWatchList(repos=[make_repo(2, "snyk-playground", "fresh")]).save(tmp_path, "sqlite")
+
+    assert [r.full_name for r in iter_watchlist(tmp_path, "sqlite")] == ["snyk-playground/fresh"]
+
+
+def test_a_sqlite_cache_from_before_saves_were_recorded(tmp_path):
+    with SQLiteCache(tmp_path) as cache:
+        assert not cache.has_saved_repos()
+        assert not cache.has_saved_orgs()
+
+        cache.save_repos([repo_record(1, "a")])
+        cache.save_org(*org_records("org-a", "group-1", [], {}))
+
+        with cache.conn:
+            cache.conn.execute("DELETE FROM saved")
+
+        # the rows themselves show it was saved to
+        assert cache.has_saved_repos()
+        assert cache.has_saved_orgs()
+
+
+def set_used_at(cache: HTTPCache, key: str, used_at: float):
+    with cache.conn:
+        cache.conn.execute("UPDATE responses SET used_at = ? WHERE key = ?", (used_at, key))
+
+
+def test_http_cache_round_trip(tmp_path):
+    cache = HTTPCache(tmp_path)
+
+    cache.put("api.github.com:443/orgs/a", '"etag"', None, {"etag": '"etag"'}, '{"login": "a"}')
+
+    assert cache.get("api.github.com:443/orgs/a") == ('"etag"', None, {"etag": '"etag"'}, '{"login": "a"}')
+    assert cache.get("api.github.com:443/orgs/b") is None
+
+
+def test_http_cache_expires_unused_responses(tmp_path):
+    cache = HTTPCache(tmp_path)
+
+    cache.put("old", '"1"', None, {}, "old")
+    cache.put("replayed", '"2"', None, {}, "replayed")
+    cache.put("new", '"3"', None, {}, "new")
+
+    a_week_ago = time.time() - 8 * 24 * 60 * 60
+    set_used_at(cache, "old", a_week_ago)
+    set_used_at(cache, "replayed", a_week_ago)
+
+    # a response replayed after a 304 counts as used
+    cache.touch("replayed")
+    cache.close()
+
+    cache = HTTPCache(tmp_path)
+
+    assert cache.get("old") is None
+    assert cache.get("replayed") is not None
+    assert cache.get("new") is not None
+
+
+def test_http_cache_evicts_least_recently_used_past_max_bytes(tmp_path):
+    cache = HTTPCache(tmp_path)
+
+    for i in range(0, 4):
+        cache.put(f"key-{i}", None, "yesterday", {}, "x" * 100)
+        set_used_at(cache, f"key-{i}", 1000.0 + i)
+
+    cache.evict(max_age=time.time(), max_bytes=250)
+
+    assert [cache.get(f"key-{i}") is not None for i in range(0, 4)] == [False, False, True, True]
+
+
+def test_http_cache_from_another_schema_is_dropped(tmp_path):
+    conn = sqlite3.connect(f"{tmp_path}/http.sqlite")
+    conn.execute(
+        "CREATE TABLE responses (key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, headers TEXT, body TEXT)"
+    )
+    conn.execute("INSERT INTO responses VALUES ('key', '\"1\"', NULL, '{}', 'body')")
+    conn.commit()
+    conn.close()
+
+    cache = HTTPCache(tmp_path)
+
+    assert cache.get("key") is None
+
+    cache.put("key", '"2"', None, {}, "body")
+
+    assert cache.get("key") is not None
+
+
+IMPORT_YAML = b"""
+orgName: team-a
+tags:
+  1: numbered
+  released: 2022-01-31
+branches:
+  - main
+  - release
+instance:
+  ghe:
+    tags:
+      since: 2021-12-01 10:00:00
+"""
+
+PLAIN_YAML = b"orgName: team-a\ntags:\n  1: numbered\nbranches:\n  - main\n  - release\n"
+
+
+def test_import_cache_resolves_the_same_as_the_file(tmp_path):
+    cache = ImportCache(tmp_path)
+
+    cache.put("abc123", Repo.read_import(IMPORT_YAML))
+    cache.close()
+
+    cached = ImportCache(tmp_path).get("abc123")
+
+    # dates and integer keys come back as yaml read them, not as the strings json would have made them
+    assert cached == Repo.read_import(IMPORT_YAML)
+    assert cached["tags"]["released"] == date(2022, 1, 31)
+
+    for instance in [None, "ghe"]:
+        assert Repo.resolve_import(cached, instance) == Repo.resolve_import(Repo.read_import(IMPORT_YAML), instance)
+
+    assert Repo.resolve_import(cached, "ghe")["orgName"] == "default"
+
+
+def test_import_cache_is_not_parsed_again(tmp_path, monkeypatch):
+    cache = ImportCache(tmp_path)
+    cache.put("abc123", Repo.read_import(PLAIN_YAML))
+
+    def no_parsing(*args, **kwargs):
+        raise AssertionError("a cached import.yaml was parsed again")
+
+    monkeypatch.setattr(yaml, "safe_load", no_parsing)
+    monkeypatch.setattr(yaml, "load", no_parsing)
+
+    assert Repo.resolve_import(cache.get("abc123"))["orgName"] == "team-a"
+
+
+def test_import_cache_keeps_every_yaml_type(tmp_path):
+    document = Repo.read_import(
+        b"""
+        when: 2021-12-01 10:00:00+01:00
+        blob: !!binary aGVsbG8=
+        names: !!set {a, b}
+        1.5: float key
+        null: null key
+        "!yaml": a key like our own
+        nested:
+          - {2022-01-31: dated key, true: yes}
+        """
+    )
+    cache = ImportCache(tmp_path)
+    cache.put("types", document)
+
+    cached = cache.get("types")
+
+    assert cached == document
+    assert [type(k) for k in cached] == [type(k) for k in document]
+    assert cached["when"].utcoffset() == document["when"].utcoffset()
+    assert cached["blob"] == b"hello"
+
+
+def test_import_cache_misses(tmp_path):
+    cache = ImportCache(tmp_path)
+
+    # an empty file parses to None, which can't be told from a miss so isn't kept
+    cache.put("empty", Repo.read_import(b""))
+
+    assert cache.get("empty") is None
+    assert cache.get("missing") is None
+
+    with pytest.raises(yaml.YAMLError):
+        Repo.read_import(b"orgName: [oops\n")
+
+
+def test_applying_a_cached_import(tmp_path):
+    cache = ImportCache(tmp_path)
+    cache.put("good", Repo.read_import(PLAIN_YAML))
+    cache.put("dated", Repo.read_import(IMPORT_YAML))
+
+    from_cache = make_repo(1, "org-a", "a")
+    from_cache.apply_import(Repo.resolve_import(cache.get("good")), "good")
+
+    from_file = make_repo(1, "org-a", "a")
+    from_file.apply_import(Repo.resolve_import(Repo.read_import(PLAIN_YAML)), "good")
+
+    assert from_cache == from_file
+    assert from_cache.org == "team-a"
+    assert from_cache.branches == ["main", "release"]
+    assert [(t.key, t.value) for t in from_cache.tags] == [("1", "numbered")]
+
+    # a tag yaml reads as a date isn't a valid Tag, and that mustn't change because the file came from the cache
+    with pytest.raises(ValidationError):
+        make_repo(2, "org-a", "b").apply_import(Repo.resolve_import(cache.get("dated")), "dated")
+
+    with pytest.raises(ValidationError):
+        make_repo(2, "org-a", "b").apply_import(Repo.resolve_import(Repo.read_import(IMPORT_YAML)), "dated")
+
+
+def test_import_cache_from_another_schema_is_dropped(tmp_path):
+    conn = sqlite3.connect(f"{tmp_path}/imports.sqlite")
+    # the raw files the cache used to hold
+    conn.execute("CREATE TABLE imports (sha TEXT PRIMARY KEY, content BLOB NOT NULL)")
+    conn.execute("INSERT INTO imports VALUES ('abc123', 'orgName: team-a')")
+    conn.execute("PRAGMA user_version = 2")
+    conn.commit()
+    conn.close()
+
+    assert ImportCache(tmp_path).get("abc123") is None
@@ -0,0 +1,230 @@
+import json
+from datetime import datetime
+from datetime import timedelta
+from uuid import UUID
+
+from models.repositories import Project
+from models.repositories import Repo
+from models.repositories import Tag
+from models.sync import SnykWatchList
+from test_organizations import api_project
+
+
+def make_repo(repo_id: int, owner: str, name: str) -> Repo:
+    return Repo(
+        source={
+            "fork": False,
+            "name": name,
+            "owner": owner,
+            "branch": "main",
+            "url": f"https://github.com/{owner}/{name}",
+            "project_base": f"{owner}/{name}",
+        },
+        url=f"https://github.com/{owner}/{name}",
+        fork=False,
+        id=repo_id,
+        branches=["main"],
+        updated_at="2022-01-01 00:00:00",
+        full_name=f"{owner}/{name}",
+    )
+
+
+def make_project(project_id: str, branch: str = "main") -> Project:
+    return Project.construct(
+        id=project_id,
+        org_id="39ddc762-b1b9-41ce-ab42-defbe4575bd6",
+        branch=branch,
+        tags=[],
+    )
+
+
+def hours_ago(hours: float) -> str:
+    return datetime.isoformat(datetime.utcnow() - timedelta(hours=hours))
+
+
+def test_needs_full_crawl_without_a_watermark():
+    watchlist = SnykWatchList(last_full_sync=hours_ago(1))
+
+    assert watchlist.needs_full_crawl("org-a", 24)
+
+
+def test_needs_full_crawl_without_a_full_sync():
+    watchlist = SnykWatchList(watermarks={"org-a": "2022-01-01 00:00:00"})
+
+    assert watchlist.needs_full_crawl("org-a", 24)
+
+
+def test_needs_full_crawl_once_the_interval_has_passed():
+    watchlist = SnykWatchList(watermarks={"org-a": "2022-01-01 00:00:00"}, last_full_sync=hours_ago(25))
+
+    assert watchlist.needs_full_crawl("org-a", 24)
+    assert not watchlist.needs_full_crawl("org-a", 26)
+
+
+def test_incremental_within_the_interval():
+    watchlist = SnykWatchList(watermarks={"org-a": "2022-01-01 00:00:00"}, last_full_sync=hours_ago(1))
+
+    assert not watchlist.needs_full_crawl("org-a", 24)
+    assert watchlist.needs_full_crawl("org-b", 24)
+
+
+def test_update_watermark_only_moves_forward():
+    watchlist = SnykWatchList()
+
+    watchlist.update_watermark("org-a", "2022-01-02 00:00:00")
+    watchlist.update_watermark("org-a", "2022-01-01 00:00:00")
+    watchlist.update_watermark("org-b", "2022-01-01 00:00:00")
+
+    assert watchlist.watermarks == {"org-a": "2022-01-02 00:00:00", "org-b": "2022-01-01 00:00:00"}
+
+    watchlist.update_watermark("org-a", "2022-01-03 00:00:00")
+
+    assert watchlist.watermarks["org-a"] == "2022-01-03 00:00:00"
+
+
+def test_prune_every_org():
+    watchlist = SnykWatchList(repos=[make_repo(1, "org-a", "a"), make_repo(2, "org-b", "b")])
+
+    watchlist.prune([1])
+
+    assert [r.id for r in watchlist.repos] == [1]
+    assert not watchlist.has_repo(2)
+
+
+def test_prune_only_the_orgs_crawled_in_full():
+    watchlist = SnykWatchList(
+        repos=[make_repo(1, "org-a", "a"), make_repo(2, "Org-A", "gone"), make_repo(3, "org-b", "unchanged")]
+    )
+
+    # org-b was crawled incrementally, so its unchanged repo isn't among the ids we saw
+    watchlist.prune([1], gh_orgs=["ORG-A"])
+
+    assert [r.id for r in watchlist.repos] == [1, 3]
+
+
+SNYK_ORGS = {
+    "ie-playground": {
+        "orgId": "39ddc762-b1b9-41ce-ab42-defbe4575bd6",
+        "integrations": {"github-enterprise": "b87e1473-37ab-4f09-a4e3-a0139a50e81e"},
+    }
+}
+
+
+def count_parses(monkeypatch) -> list:
+    calls = list()
+    parse_branches = Repo.parse_branches
+
+    def counted(self, *args):
+        calls.append(args)
+        return parse_branches(self, *args)
+
+    monkeypatch.setattr(Repo, "parse_branches", counted)
+
+    return calls
+
+
+def test_get_reimport_is_kept(monkeypatch):
+    repo = make_repo(1, "org-a", "one")
+    calls = count_parses(monkeypatch)
+
+    first = repo.get_reimport("ie-playground", SNYK_ORGS)
+    second = repo.get_reimport("ie-playground", SNYK_ORGS)
+
+    assert len(calls) == 1
+    assert [b.name for b in second] == [b.name for b in first] == ["main"]
+
+    # callers get their own list
+    second.clear()
+    assert len(repo.get_reimport("ie-playground", SNYK_ORGS)) == 1
+
+
+def test_get_reimport_with_another_mapping(monkeypatch):
+    repo = make_repo(1, "org-a", "one")
+    calls = count_parses(monkeypatch)
+
+    repo.get_reimport("ie-playground", SNYK_ORGS)
+    repo.get_reimport("ie-playground", dict(SNYK_ORGS))
+
+    assert len(calls) == 2
+
+
+def test_get_reimport_after_changes(monkeypatch):
+    repo = make_repo(1, "org-a", "one")
+    calls = count_parses(monkeypatch)
+
+    repo.get_reimport("ie-playground", SNYK_ORGS)
+
+    repo.branches = ["main", "develop"]
+
+    assert [b.name for b in repo.get_reimport("ie-playground", SNYK_ORGS)] == ["main", "develop"]
+
+    repo.add_project(make_project("33333333-3333-4333-8333-333333333333"))
+
+    branches = {b.name: b for b in repo.get_reimport("ie-playground", SNYK_ORGS)}
+
+    assert branches["main"].project_count() == 1
+    assert branches["develop"].project_count() == 0
+    assert len(calls) == 3
+
+
+def test_project_index_follows_add_project():
+    repo = make_repo(1, "org-a", "one")
+    a = make_project("33333333-3333-4333-8333-333333333333")
+    b = make_project("44444444-4444-4444-8444-444444444444")
+
+    repo.add_project(a)
+    repo.add_project(b)
+
+    # adding a project that's already there replaces it
+    a2 = make_project(str(a.id), "develop")
+    repo.add_project(a2)
+
+    assert len(repo.projects) == 2
+    assert repo.get_project(a.id) is a2
+    assert repo.get_project(b.id) is b
+
+
+def test_project_index_after_the_list_is_replaced():
+    repo = make_repo(1, "org-a", "one")
+    a = make_project("33333333-3333-4333-8333-333333333333")
+    b = make_project("44444444-4444-4444-8444-444444444444")
+
+    repo.add_project(a)
+
+    # the same length as before, so the length alone can't tell the index is stale
+    repo.projects = [b]
+
+    assert not repo.has_project(a.id)
+    assert repo.get_project(b.id) is b
+
+
+def test_repo_from_cache_matches_parse_obj():
+    repo = make_repo(123456, "snyk-playground", "goof")
+    repo.pushed_at = "2022-01-02 00:00:00"
+    repo.import_sha = "2f1e8d4c"
+    repo.org = "ie-playground"
+    repo.branches = ["main", "release"]
+    repo.topics = ["python", "api"]
+    repo.visibility = "private"
+    repo.tags = [Tag(key="team", value="a")]
+
+    for project_id, branch in [
+        ("0c7b2b9e-3a1d-4d5e-9f2a-6b8c1d0e2f3a", "main"),
+        ("1d7b2b9e-3a1d-4d5e-9f2a-6b8c1d0e2f3a", "release"),
+    ]:
+        project = Project.parse_obj(
+            api_project(project_id, "f3b4c5d6-1a2b-4c3d-8e9f-0a1b2c3d4e5f", [{"key": "team", "value": "a"}], branch)
+        )
+        repo.add_project(project)
+
+    # the record the watchlist cache keeps
+    record = json.loads(repo.json(by_alias=False))
+
+    from_cache = Repo.from_cache(record)
+
+    assert from_cache == Repo.parse_obj(record)
+    assert from_cache.json() == repo.json()
+    assert from_cache.source == repo.source
+    assert [type(p.id) for p in from_cache.projects] == [UUID, UUID]
+    assert [p.branch for p in from_cache.projects] == ["main", "release"]
+    assert [(t.key, t.value) for t in from_cache.projects[1].tags] == [("team", "a")]
@@ -0,0 +1,127 @@
+import json
+
+import pytest
+from utils import TargetWriter
+from utils import jstream
+
+
+def make_target(n: int) -> dict:
+    return {"target": {"owner": "org-a", "name": f"repo-{n}", "branch": "main"}, "orgId": "org"}
+
+
+def read_targets(path) -> list:
+    return json.loads(path.read_text())["targets"]
+
+
+def test_single_file(tmp_path):
+    writer = TargetWriter(tmp_path, "g1")
+
+    for n in range(3):
+        writer.add(make_target(n))
+
+    assert writer.close() == [f"{tmp_path}/g1.json"]
+    assert read_targets(tmp_path / "g1.json") == [make_target(n) for n in range(3)]
+
+
+def test_large_single_file(tmp_path):
+    writer = TargetWriter(tmp_path, "g1")
+
+    count = TargetWriter.INDENT_LIMIT + 10
+
+    for n in range(count):
+        writer.add(make_target(n))
+
+    writer.close()
+
+    assert read_targets(tmp_path / "g1.json") == [make_target(n) for n in range(count)]
+    assert not (tmp_path / "g1.json.tmp").exists()
+
+
+def test_empty_group_gets_a_file(tmp_path):
+    writer = TargetWriter(tmp_path, "g1")
+
+    assert writer.close() == [f"{tmp_path}/g1.json"]
+    assert read_targets(tmp_path / "g1.json") == []
+
+
+def test_batches(tmp_path):
+    writer = TargetWriter(tmp_path, "g1", batch_size=2)
+
+    for n in range(5):
+        writer.add(make_target(n))
+
+    assert writer.close() == [f"{tmp_path}/g1-{i:04d}.json" for i in [1, 2, 3]]
+    assert read_targets(tmp_path / "g1-0001.json") == [make_target(0), make_target(1)]
+    assert read_targets(tmp_path / "g1-0003.json") == [make_target(4)]
+
+
+def test_batches_of_an_empty_group(tmp_path):
+    writer = TargetWriter(tmp_path, "g1", batch_size=2)
+
+    assert writer.close() == []
+
+
+def test_ndjson_batches(tmp_path):
+    writer = TargetWriter(tmp_path, "g1", batch_size=2, ndjson=True)
+
+    for n in range(3):
+        writer.add(make_target(n))
+
+    assert writer.close() == [f"{tmp_path}/g1-0001.ndjson", f"{tmp_path}/g1-0002.ndjson"]
+
+    lines = (tmp_path / "g1-0002.ndjson").read_text().splitlines()
+
+    assert [json.loads(line) for line in lines] == [make_target(2)]
+
+
+def test_stale_shards_are_removed(tmp_path):
+    for stale in ["g1-0001.json", "g1-0002.json", "g1-0003.ndjson"]:
+        (tmp_path / stale).write_text("{}")
+
+    # another group's shards and files that aren't shards are left alone
+    for kept in ["g10-0001.json", "g1.json", "g1-notes.json"]:
+        (tmp_path / kept).write_text("{}")
+
+    writer = TargetWriter(tmp_path, "g1", batch_size=2)
+    writer.add(make_target(0))
+    writer.close()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["g1-0001.json", "g1-notes.json", "g1.json", "g10-0001.json"]
+    assert read_targets(tmp_path / "g1-0001.json") == [make_target(0)]
+
+
+def test_group_name_with_glob_characters(tmp_path):
+    (tmp_path / "g[1]-0001.json").write_text("{}")
+    (tmp_path / "g1-0001.json").write_text("{}")
+
+    TargetWriter(tmp_path, "g[1]", batch_size=2).close()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["g1-0001.json"]
+
+
+JSON_ARRAYS = [
+    "[]",
+    "[123456789, 2.5]",
+    '[-12, 1e-07, 3.0E+10, 0, true, false, null, "x", 45]',
+    '[{"id": 1, "name": "a, \\"quoted\\" ]"}, [1, [2, 3]], {"nested": {"list": [1.25, null]}}]',
+    '\n[\n  {"id": 100000},\n  12345\n]\n',
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64, 65536])
+@pytest.mark.parametrize("document", JSON_ARRAYS)
+def test_jstream_across_chunk_sizes(tmp_path, document, chunk_size):
+    path = tmp_path / "data.json"
+    path.write_text(document)
+
+    assert list(jstream(path, chunk_size)) == json.loads(document)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 65536])
+@pytest.mark.parametrize("document", ['{"id": 1}', "[1, 2", '[{"id": 1}, {"id"', "[1, 2.]"])
+def test_jstream_rejects_broken_arrays(tmp_path, document, chunk_size):
+    path = tmp_path / "data.json"
+    path.write_text(document)
+
+    with pytest.raises(ValueError):
+        list(jstream(path, chunk_size))